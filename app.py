@@ -1,113 +1,235 @@
 import streamlit as st
-import pandas as pd
-from streamlit_gsheets import GSheetsConnection
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import datetime
 import re
 from zoneinfo import ZoneInfo
 import streamlit.components.v1 as components
 import time
 from streamlit_local_storage import LocalStorage
-import smtplib
-from email.message import EmailMessage
 import re
+import importlib
+import os
+import sys
+import cProfile
+import random
+import threading
+import asyncio
+import hashlib
+import uuid
+import copy
+from abc import ABC, abstractmethod
+import json
+import sqlite3
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+class LazyModule:
+    """
+    Moduł importowany przy pierwszym użyciu atrybutu (np. pd.DataFrame).
+    Ekran logowania nie potrzebuje pandas/numpy, więc nie płaci za ich import.
+    Pierwszy import pod blokadą - wątki puli nie widzą w połowie zainicjowanego modułu.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Biblioteki Google, arkusze i SMTP importujemy w funkcjach, które ich używają
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
 
 st.set_page_config(page_title="Wózki Ujeścisko Wschód", page_icon="👥", layout="centered")
 
 CALENDAR_ID = st.secrets["calendar_id"]
+# Lokalizacje wózków: sekcja [locations] w secrets (nazwa = "id kalendarza").
+# Bez tej sekcji jest jedna lokalizacja na kalendarzu CALENDAR_ID.
+LOCATIONS = {str(name): str(cal) for name, cal in dict(st.secrets.get("locations", {})).items()} or {"Piotrkowska": CALENDAR_ID}
 SHEET_ID = st.secrets["sheet_id"]
 STORAGE_USER = 'wozki_stored_user'
+STORAGE_AUTH = 'wozki_auth_status'
+# Klucz komponentu localStorage w session_state (domyślny klucz LocalStorage)
+STORAGE_STATE_KEY = 'storage_init'
 IGNORED_EMAILS = [
     CALENDAR_ID.lower()
-]
+] + [cal.lower() for cal in LOCATIONS.values() if cal.lower() != CALENDAR_ID.lower()]
+
+# --- STYLE (PLIKI STATYCZNE) ---
+
+# Arkusz i ikony leżą w static/ (server.enableStaticServing) - przeglądarka pobiera je raz,
+# a rerun wysyła tylko krótki @import z wersją z treści pliku.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+@st.cache_resource
+def static_url(name):
+    """Adres pliku ze static/ z ?v=<skrót treści>; zmiana pliku zmienia adres i omija cache przeglądarki."""
+    with open(os.path.join(STATIC_DIR, name), "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:10]
+    return f"app/static/{name}?v={digest}"
+
+st.markdown(f'<style>@import url("{static_url("app.css")}");</style>', unsafe_allow_html=True)
+
+# --- SKRYPT KLIENTA (JEDEN NA SESJĘ) ---
+
+# Działa w dokumencie strony, nie w iframe: przeżywa reruny i zniknięcie iframe'a, który go wstrzyknął.
+# Zamiast odpytywać DOM co 500 ms, MutationObserver łata tylko nowo dodane węzły.
+CLIENT_SCRIPT = """
+(function () {
+    if (window.__wozkiClient) { return; }
+    window.__wozkiClient = true;
+
+    const HIDDEN = '[data-testid="stAppHeader"], [data-testid="stStatusWidget"], '
+        + 'button[aria-label="Manage app"], [data-testid="stDecoration"]';
+    // Bez klawiatury ekranowej: pola daty/liczb i listy wyboru (poza hasłem)
+    const NO_KEYBOARD = 'div[data-baseweb="base-input"] input:not([type="password"]), '
+        + 'div[data-baseweb="select"] input';
+
+    function within(node, selector) {
+        const found = Array.from(node.querySelectorAll(selector));
+        if (node.matches(selector)) { found.push(node); }
+        return found;
+    }
 
-st.markdown("""
-    <style>
+    function patch(node) {
+        if (node.nodeType !== Node.ELEMENT_NODE) { return; }
+        within(node, HIDDEN).forEach(el => { el.style.display = 'none'; });
+        within(node, NO_KEYBOARD).forEach(input => {
+            input.setAttribute('readonly', 'readonly');
+            input.setAttribute('inputmode', 'none');
+        });
+    }
 
-[data-testid="stAppHeader"] {
-    display: none;
-}
+    patch(document.body);
+    new MutationObserver(mutations => {
+        mutations.forEach(m => m.addedNodes.forEach(patch));
+    }).observe(document.body, { childList: true, subtree: true });
+})();
+"""
 
-[data-testid="stStatusWidget"] {
-    display: none !important;
-}
+def install_client_script():
+    """Raz na sesję wstrzykuje CLIENT_SCRIPT do strony; kolejne reruny nie dodają żadnego iframe'a."""
+    if st.session_state.get('client_script_installed'):
+        return
+    components.html(f"""
+    <script>
+        const doc = window.parent.document;
+        const script = doc.createElement('script');
+        script.textContent = {json.dumps(CLIENT_SCRIPT)};
+        doc.head.appendChild(script);
+    </script>
+    """, height=0)
+    st.session_state['client_script_installed'] = True
 
-[data-testid="stDecoration"] {
-    display: none !important;
-}
+install_client_script()
 
-[data-testid="stMainMenu"] {
-    display: none !important;
-}
+def get_sheets_connection():
+    """Połączenie z Arkuszem (st.connection samo je cache'uje); import dopiero przy pierwszym użyciu."""
+    from streamlit_gsheets import GSheetsConnection
+    return st.connection("gsheets", type=GSheetsConnection)
 
+# Wersje streamlit-local-storage, w których sprawdzono prywatny komponent _st_local_storage
+LOCAL_STORAGE_TESTED_VERSIONS = ("0.0.25",)
 
+@st.cache_resource
+def local_storage_component():
+    """
+    Jedyne miejsce, które sięga po prywatny _st_local_storage: tylko dla sprawdzonej wersji
+    pakietu. Dla innej (albo gdy go zabraknie) None - zostaje publiczne LocalStorage().
+    """
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        installed = version("streamlit-local-storage")
+    except PackageNotFoundError:
+        return None
+    if installed not in LOCAL_STORAGE_TESTED_VERSIONS:
+        print(f"streamlit-local-storage {installed} nie był sprawdzany - start sesji przez publiczne LocalStorage")
+        return None
+    try:
+        from streamlit_local_storage import _st_local_storage
+    except ImportError:
+        return None
+    return _st_local_storage
 
-    .stButton>button {
-        background-color: #5d3b87;
-        color: white;
-        width: 100%;
-        border-radius: 8px;
-        height: 3em;
-    }
-    .stButton>button:hover {
-        background-color: #4c3170;
-        color: white;
-    }
-    [data-testid="stHeaderActionElements"] {
-        display: none !important;
-    }
-    h1, h2, h3 { color: #5d3b87; }
-    .block-container { padding-top: 2rem; }
-    
-    @media (max-width: 768px) {
-        h1 {
-            font-size: 1.8rem !important;
-        }
-        h2 {
-            font-size: 1.4rem !important;
-        }
-        h3 {
-            font-size: 1.2rem !important;
-        }
+def bootstrap_session():
+    """
+    Jeden odczyt localStorage (getAll) na sesję: przywraca naraz logowanie i zapamiętaną osobę.
+    Zwraca None, dopóki przeglądarka nie odeśle danych - komponent sam wywoła wtedy rerun.
+    """
+    # Pomiar czasu do interakcji (mark_interactive); None = już zmierzony w tej sesji
+    startup = st.session_state.setdefault('startup', {'started_at': time.time(), 'passes': 0, 'restored': False})
+    if startup is not None:
+        startup['passes'] += 1
+
+    component = local_storage_component()
+    if st.session_state.get(STORAGE_STATE_KEY) is None and component is not None:
+        # Bez pętli oczekiwania z LocalStorage(): pierwszy przebieg kończymy od razu
+        if component(method="getAll", key=STORAGE_STATE_KEY, default=None) is None:
+            return None
+
+    ls = LocalStorage(STORAGE_STATE_KEY)
+    if not st.session_state.get('session_restored'):
+        st.session_state['session_restored'] = True
+        if ls.getItem(STORAGE_AUTH) == "true":
+            st.session_state["password_correct"] = True
+        # Tożsamość odtwarza main() po wczytaniu bazy, w tym samym przebiegu
+        st.session_state['stored_email'] = ls.getItem(STORAGE_USER)
+        if startup is not None:
+            # Mierzymy tylko powracających: bez wpisywania hasła i wyboru osoby
+            startup['restored'] = bool(st.session_state.get("password_correct") and st.session_state['stored_email'])
+    return ls
+
+class StartupTimings:
+    """
+    Czas do interakcji sesji: od pierwszego przebiegu skryptu do pierwszego przebiegu
+    z formularzem (wlicza rundy komponentu localStorage przez sieć klienta). Ostatnie próbki na proces.
+    """
 
-        .block-container {
-            padding-top: 0.5rem;
-            padding-left: 1.25rem;
-            padding-right: 1.25rem;
+    def __init__(self, maxlen=200):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=maxlen)
+
+    def record(self, seconds, passes):
+        with self.lock:
+            self.samples.append((seconds, passes))
+
+    def snapshot(self):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return {'sessions': 0}
+        return {
+            'sessions': len(samples),
+            'p50_s': round(samples[len(samples) // 2][0], 3),
+            'p90_s': round(samples[min(len(samples) - 1, int(len(samples) * 0.9))][0], 3),
+            'max_passes': max(passes for _, passes in samples),
         }
-     }
-    </style>
-""", unsafe_allow_html=True)
-
-components.html("""
-<script>
-window.addEventListener('load', function() {
 
-    const header = document.querySelector('[data-testid="stAppHeader"]');
-    if(header) { header.style.display = 'none'; }
+@st.cache_resource
+def get_startup_timings():
+    return StartupTimings()
 
-    const status = document.querySelector('[data-testid="stStatusWidget"]');
-    if(status) { status.style.display = 'none'; }
-
-    const manageBtn = document.querySelector('button[aria-label="Manage app"]');
-    if(manageBtn) { manageBtn.style.display = 'none'; }
-
-    const brand = document.querySelector('[data-testid="stDecoration"]');
-    if(brand) { brand.style.display = 'none'; }
-});
-</script>
-""", height=0)
-
-conn = st.connection("gsheets", type=GSheetsConnection)
+def mark_interactive():
+    """
+    Pierwszy przebieg z formularzem w tej sesji: zapisuje czas i liczbę przebiegów od startu
+    (tylko dla sesji odtworzonych z localStorage - czas wpisywania hasła by go zafałszował).
+    """
+    startup = st.session_state.get('startup')
+    if startup is None:
+        return
+    st.session_state['startup'] = None
+    if startup['restored']:
+        get_startup_timings().record(time.time() - startup['started_at'], startup['passes'])
 
-def check_password():
+def check_password(ls):
     """Obsługuje ekran logowania głównego (Globalne hasło)."""
-    ls = LocalStorage()
-    stored_auth = ls.getItem("wozki_auth_status")
-    
-    if st.session_state.get("password_correct", False) or stored_auth == "true":
-        st.session_state["password_correct"] = True
+    if st.session_state.get("password_correct", False):
         return True
 
     # --- EKRAN LOGOWANIA ---
@@ -125,7 +247,7 @@ def check_password():
     if st.button("Zaloguj"):
         if password == st.secrets["passwords"]["app_password"]:
             st.session_state["password_correct"] = True
-            ls.setItem("wozki_auth_status", "true")
+            ls.setItem(STORAGE_AUTH, "true")
             st.success("Hasło poprawne!")
             time.sleep(0.5)
             st.rerun()
@@ -138,14 +260,74 @@ def normalize_string(s):
     """Pomocnicza: zamienia na małe litery i usuwa zbędne spacje."""
     return str(s).strip().lower()
 
-def get_participants_from_title(title, df_users):
+class TitleResolutionCache:
+    """LRU wyników (emails, has_unknown) wspólne dla procesu; klucz: (tytuł, odcisk bazy ACL)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+            self.stats['misses'] += 1
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def snapshot(self):
+        with self.lock:
+            total = self.stats['hits'] + self.stats['misses']
+            hit_rate = round(self.stats['hits'] / total, 3) if total else 0.0
+            return {**self.stats, 'size': len(self.entries), 'maxsize': self.maxsize, 'hit_rate': hit_rate}
+
+@st.cache_resource
+def get_title_cache():
+    maxsize = int(dict(st.secrets.get("cache", {})).get("title_cache_size", 4096))
+    return TitleResolutionCache(maxsize)
+
+def users_fingerprint(df_users):
+    """
+    Odcisk kolumn używanych do identyfikacji (Email, Imię, Nazwisko), zawsze liczony
+    z bieżącej zawartości ramki. Pętle liczą go raz i podają dalej jako fingerprint=.
+    """
+    cols = [c for c in ('Email', 'Imię', 'Nazwisko') if c in df_users.columns]
+    hashed = pd.util.hash_pandas_object(df_users[cols].astype(str), index=False) if cols else pd.Series(dtype='uint64')
+    return hashlib.sha1(hashed.to_numpy().tobytes()).hexdigest()
+
+def get_participants_from_title(title, df_users, fingerprint=None):
+    """
+    Identyfikuje osoby w tytule (wynik z pamięci podręcznej, jeśli był już liczony
+    dla tej samej wersji bazy ACL). Logika dopasowania: resolve_participants_from_title.
+    fingerprint: users_fingerprint(df_users) policzony przez wywołującego (bez niego liczony tutaj).
+    """
+    if not title:
+        return [], False
+
+    key = (re.sub(r'\s+', ' ', title.strip()), fingerprint or users_fingerprint(df_users))
+    emails, has_unknown = get_title_cache().get_or_compute(
+        key, lambda: resolve_participants_from_title(title, df_users)
+    )
+    return list(emails), has_unknown
+
+def resolve_participants_from_title(title, df_users):
     """
     Identyfikuje osoby w tytule na podstawie:
     1. Pełnego nazwiska (musi wystąpić w całości).
     2. Dwóch pierwszych liter imienia (musi pasować początek słowa).
     """
     if not title:
-        return [], False
+        return (), False
         
     parts = re.split(r'\s+(?:i|\+|&|,)\s+', title)
     
@@ -187,7 +369,32 @@ def get_participants_from_title(title, df_users):
         else:
             if len(clean_part) > 2 and not re.search(r'\d:', clean_part):
                 has_unknown = True
-    return list(set(found_emails)), has_unknown
+    return tuple(set(found_emails)), has_unknown
+
+PARTICIPANTS_PROPERTY = 'participants'
+
+def get_event_participant_emails(event):
+    """Emaile zapisane w extendedProperties.private (None dla wydarzeń dodanych ręcznie)."""
+    raw = event.get('extendedProperties', {}).get('private', {}).get(PARTICIPANTS_PROPERTY)
+    if raw is None:
+        return None
+    return [e for e in raw.split(',') if e]
+
+def set_event_participant_emails(event, emails):
+    """Zapisuje listę emaili uczestników (w kolejności z tytułu) w extendedProperties.private."""
+    private = event.setdefault('extendedProperties', {}).setdefault('private', {})
+    private[PARTICIPANTS_PROPERTY] = ",".join(dict.fromkeys(str(e).strip().lower() for e in emails if e))
+
+def get_event_participants(event, df_users, fingerprint=None):
+    """
+    Zwraca (emails, has_unknown) dla wydarzenia. Najpierw czyta pole strukturalne;
+    tytuł parsujemy tylko dla wydarzeń dodanych (lub przerobionych) ręcznie.
+    """
+    title = event.get('summary', '')
+    emails = get_event_participant_emails(event)
+    if emails is not None and len(emails) == len(re.split(r'\s+(?:i|\+|&|,)\s+', title)):
+        return emails, False
+    return get_participants_from_title(title, df_users, fingerprint)
 
 def make_sort_key(text):
     """Zamienia polskie znaki na takie, które sortują się poprawnie."""
@@ -202,9 +409,34 @@ def make_sort_key(text):
         s = s.replace(pol, lat)
     return s.lower()
 
-def get_users_db():
+# Ważność odczytu arkusza ACL w cache; z nią zgrane jest odświeżanie w tle (refresh_users_cache)
+USERS_SHEET_TTL = 60
+
+@st.cache_data(ttl=USERS_SHEET_TTL, show_spinner=False)
+def read_users_sheet():
+    """
+    Czyta arkusz ACL przez limiter; cache własny, więc token zużywa tylko prawdziwy odczyt.
+    Zawsze prawdziwy arkusz - snapshot nigdy nie trafia do tego cache'u (patrz get_users_db).
+    """
+    return get_single_flight().do(
+        ("sheet", SHEET_ID, "ACL"),
+        lambda: call_api("sheets", get_sheets_connection().read, worksheet="ACL", usecols=[0, 1, 2, 3, 4, 5, 6], ttl=0)
+    )
+
+def get_users_db(allow_snapshot=False):
+    """
+    Baza ACL po oczyszczeniu. allow_snapshot=True (tylko rejestr do wyświetlania): pierwszy
+    odczyt po starcie bierze bazę ze snapshotu i odświeża ją w tle; ramka ma wtedy
+    attrs['from_snapshot'] i nie może służyć do synchronizacji ani zapisu całej bazy.
+    """
     try:
-        df = conn.read(worksheet="ACL", usecols=[0, 1, 2, 3, 4, 5, 6], ttl=60)
+        df = get_warm_start().take_users() if allow_snapshot else None
+        from_snapshot = df is not None
+        if from_snapshot:
+            # Jednorazowo (take_users oddaje snapshot raz) przez wspólną pulę, nie osobny wątek
+            submit_task(refresh_users_cache)
+        else:
+            df = read_users_sheet()
 
         df['Imię'] = df['Imię'].astype(str).str.strip()
         df['Nazwisko'] = df['Nazwisko'].astype(str).str.strip()
@@ -228,30 +460,590 @@ def get_users_db():
         
         del df['_sort_key']
 
+        df.attrs['from_snapshot'] = from_snapshot
         return df
     except Exception as e:
         st.error(f"Błąd bazy danych: {e}")
         return pd.DataFrame()
 
 def update_user_db(df):
+    if df.attrs.get('from_snapshot'):
+        # Toast przetrwa st.rerun() po kliknięciu serca
+        st.toast("Baza jest jeszcze wczytywana z arkusza - spróbuj zapisać za chwilę.", icon="⏳")
+        return
     try:
-        conn.update(worksheet="ACL", data=df)
+        call_api("sheets", get_sheets_connection().update, worksheet="ACL", data=df)
         st.cache_data.clear()
+        get_user_registry_cache().invalidate()
+        publish_invalidation("users")
         st.toast("Zapisano zmiany w bazie!", icon="✅")
     except Exception as e:
         st.error(f"Błąd zapisu: {e}")
 
 def get_calendar_service():
     """Tworzy klienta API Kalendarza używając credentials z secrets.toml."""
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+
     creds_dict = dict(st.secrets["connections"]["gsheets"])
     
     creds = service_account.Credentials.from_service_account_info(
         creds_dict,
         scopes=['https://www.googleapis.com/auth/calendar']
     )
-    service = build('calendar', 'v3', credentials=creds)
+    # Krótki timeout HTTP: przy awarii Google nie wisimy domyślnych 60 s
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=get_breaker_settings()['http_timeout']))
+    service = build('calendar', 'v3', http=http)
     return service
 
+# --- LIMITY API ---
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+def get_quota_settings():
+    """
+    Limity z sekcji [quota] w secrets.toml. Domyślne wartości są nieco poniżej
+    limitów projektu (Calendar: 600/min na użytkownika, Sheets: 60 odczytów/min).
+    """
+    cfg = dict(st.secrets.get("quota", {}))
+    return {
+        'calendar_per_minute': float(cfg.get("calendar_per_minute", 500)),
+        'sheets_per_minute': float(cfg.get("sheets_per_minute", 55)),
+        'burst': int(cfg.get("burst", 10)),
+        'max_retries': int(cfg.get("max_retries", 4)),
+        'base_backoff': float(cfg.get("base_backoff", 0.5)),
+        'max_backoff': float(cfg.get("max_backoff", 16)),
+    }
+
+class TokenBucket:
+    """Wiadro tokenów: `rate` tokenów na sekundę, maksymalnie `capacity` na zapas."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {'acquired': 0, 'throttled': 0, 'wait_seconds': 0.0, 'retries': 0, 'failures': 0}
+
+    def acquire(self):
+        """Pobiera token; przy pustym wiadrze czeka na swoją kolej (rezerwacja z wyprzedzeniem)."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.stats['acquired'] += 1
+            if wait:
+                self.stats['throttled'] += 1
+                self.stats['wait_seconds'] += wait
+        if wait:
+            time.sleep(wait)
+
+    def record(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            return {**self.stats, 'tokens': round(tokens, 2), 'rate_per_minute': self.rate * 60}
+
+@st.cache_resource
+def get_rate_limiters():
+    """Wspólne dla wszystkich sesji limitery (po jednym na API)."""
+    return {}
+
+def get_rate_limiter(api):
+    limiters = get_rate_limiters()
+    if api not in limiters:
+        settings = get_quota_settings()
+        per_minute = settings.get(f"{api}_per_minute", settings['calendar_per_minute'])
+        limiters.setdefault(api, TokenBucket(per_minute / 60.0, settings['burst']))
+    return limiters[api]
+
+def http_status(e):
+    """Kod HTTP błędu googleapiclient albo gspread; None dla innych wyjątków."""
+    status = getattr(getattr(e, 'resp', None), 'status', None)          # googleapiclient
+    if status is None:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)  # gspread
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable_error(e):
+    """Limity (429, 403 rateLimitExceeded), błędy 5xx i zerwane połączenia warto ponowić."""
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+
+    status = http_status(e)
+    if status is None:
+        return False
+
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status == 403:
+        content = getattr(e, 'content', b'') or b''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'ignore')
+        details = f"{content} {e}"
+        return any(reason in details for reason in RATE_LIMIT_REASONS)
+    return False
+
+# --- BEZPIECZNIK (CIRCUIT BREAKER) ---
+
+SERVICE_NAMES = {'calendar': "Kalendarz Google", 'sheets': "Arkusz Google"}
+
+class ServiceUnavailableError(Exception):
+    """Usługa Google jest chwilowo niedostępna - bezpiecznik jest otwarty."""
+
+    def __init__(self, api, retry_after=0):
+        self.api = api
+        self.retry_after = retry_after
+        name = SERVICE_NAMES.get(api, api)
+        super().__init__(f"{name} chwilowo nie odpowiada. Spróbuj ponownie za ok. {max(int(retry_after), 1)} s.")
+
+def get_breaker_settings():
+    cfg = dict(st.secrets.get("circuit_breaker", {}))
+    return {
+        'failure_threshold': int(cfg.get("failure_threshold", 3)),
+        'reset_timeout': float(cfg.get("reset_timeout", 30)),
+        'http_timeout': float(cfg.get("http_timeout", 10)),
+    }
+
+class CircuitBreaker:
+    """
+    Klasyczny bezpiecznik: po `failure_threshold` kolejnych awariach otwiera się
+    na `reset_timeout` sekund, potem przepuszcza jedno żądanie próbne (half-open).
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    def retry_after(self):
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and self.retry_after() == 0:
+                self.state = "half_open"
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats['opened'] += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'state': self.state, 'failures': self.failures,
+                    'retry_after': round(self.retry_after(), 1) if self.state == "open" else 0}
+
+@st.cache_resource
+def get_circuit_breakers():
+    """Wspólne dla wszystkich sesji bezpieczniki (po jednym na API)."""
+    return {}
+
+def get_circuit_breaker(api):
+    breakers = get_circuit_breakers()
+    if api not in breakers:
+        settings = get_breaker_settings()
+        breakers.setdefault(api, CircuitBreaker(settings['failure_threshold'], settings['reset_timeout']))
+    return breakers[api]
+
+def call_api(api, func, *args, **kwargs):
+    """
+    Wywołuje func przez wspólny limiter danego API.
+    Błędy przejściowe ponawia z wykładniczym backoffem i losowym jitterem.
+    Przy otwartym bezpieczniku od razu rzuca ServiceUnavailableError.
+    """
+    breaker = get_circuit_breaker(api)
+    if not breaker.allow():
+        raise ServiceUnavailableError(api, breaker.retry_after())
+
+    limiter = get_rate_limiter(api)
+    settings = get_quota_settings()
+
+    for attempt in range(settings['max_retries'] + 1):
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+            breaker.record_success()
+            return result
+        except Exception as e:
+            retryable = is_retryable_error(e)
+            if attempt >= settings['max_retries'] or not retryable:
+                limiter.record('failures')
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+            limiter.record('retries')
+            backoff = min(settings['max_backoff'], settings['base_backoff'] * 2 ** attempt)
+            time.sleep(random.uniform(0, backoff))
+
+def execute_api(request, api="calendar", done_statuses=()):
+    """
+    Wykonuje żądanie googleapiclient (`.execute()`) przez call_api.
+    done_statuses: kody, które przy ponowionej próbie znaczą "pierwsza próba doszła, zginęła
+    tylko odpowiedź" (insert z własnym id -> 409, delete -> 404/410) - wtedy zwraca None.
+    """
+    if not done_statuses:
+        return call_api(api, request.execute)
+
+    attempts = 0
+
+    def run():
+        nonlocal attempts
+        attempts += 1
+        try:
+            return request.execute()
+        except Exception as e:
+            if attempts > 1 and http_status(e) in done_statuses:
+                return None
+            raise
+    return call_api(api, run)
+
+def collect_metrics():
+    """Zbiera stan wewnętrznych mechanizmów do podglądu w Ustawieniach."""
+    return {
+        'limiter': {api: bucket.snapshot() for api, bucket in get_rate_limiters().items()},
+        'circuit_breaker': {api: breaker.snapshot() for api, breaker in get_circuit_breakers().items()},
+        'schedule_cache': get_schedule_cache().snapshot(),
+        'single_flight': get_single_flight().snapshot(),
+        'title_cache': get_title_cache().snapshot(),
+        'participant_index': get_participant_index().snapshot(),
+        'store': get_calendar_store().snapshot() if get_calendar_store() is not None else None,
+        'stats_cache': get_stats_cache().snapshot(),
+        'user_registry': get_user_registry_cache().snapshot(),
+        'shared_cache': get_shared_cache().snapshot() if get_shared_cache() is not None else None,
+        'gateway': get_calendar_gateway().snapshot(),
+        'backfill': get_backfill_progress().snapshot(),
+        'startup': get_startup_timings().snapshot(),
+        'scheduler': get_scheduler().snapshot() if get_scheduler_settings()['enabled'] else None,
+    }
+
+# --- ŁĄCZENIE IDENTYCZNYCH ODCZYTÓW (SINGLE-FLIGHT) ---
+
+class SingleFlight:
+    """
+    Równoległe wywołania z tym samym kluczem czekają na jedno żądanie w locie
+    i dostają jego wynik (lub wyjątek). Wynik jest współdzielony - tylko do odczytu.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self.calls[key] = call
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call['done'].set()
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'in_flight': len(self.calls)}
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+def fetch_events(time_min, time_max, order_by=None, calendar_id=None):
+    """
+    Lista wydarzeń z zakresu [time_min, time_max] (ISO). Identyczne zapytania
+    z wielu sesji naraz idą do Google tylko raz. Wyniku nie należy modyfikować.
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+
+    def fetch():
+        params = {'calendarId': calendar_id, 'timeMin': time_min, 'timeMax': time_max, 'singleEvents': True}
+        if order_by:
+            params['orderBy'] = order_by
+        service = get_calendar_service()
+        return execute_api(service.events().list(**params)).get('items', [])
+
+    return get_single_flight().do(("events", calendar_id, time_min, time_max, order_by), fetch)
+
+def iter_event_pages(time_min, time_max, calendar_id=None, **params):
+    """Kolejne strony wydarzeń z zakresu (nextPageToken) - bez trzymania całego zakresu naraz."""
+    calendar_id = calendar_id or CALENDAR_ID
+    service = get_calendar_service()
+    page_token = None
+    while True:
+        result = execute_api(service.events().list(
+            calendarId=calendar_id, timeMin=time_min, timeMax=time_max,
+            singleEvents=True, maxResults=2500, pageToken=page_token, **params
+        ))
+        yield result.get('items', [])
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return
+
+def list_all_events(time_min, time_max, calendar_id=None, **params):
+    """
+    Wszystkie wydarzenia z zakresu, strona po stronie (nextPageToken).
+    Równoległe identyczne zapytania są łączone jak w fetch_events.
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+
+    def fetch():
+        items = []
+        for page in iter_event_pages(time_min, time_max, calendar_id, **params):
+            items.extend(page)
+        return items
+
+    key = ("events_all", calendar_id, time_min, time_max, tuple(sorted(params.items())))
+    return get_single_flight().do(key, fetch)
+
+# --- WSPÓLNA PULA WĄTKÓW ---
+
+@st.cache_resource
+def get_thread_pool():
+    """Mała pula wątków współdzielona przez sesje (rozmiar: [concurrency] max_workers)."""
+    max_workers = int(dict(st.secrets.get("concurrency", {})).get("max_workers", 8))
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wozki")
+
+def submit_task(func, *args, **kwargs):
+    """
+    Zleca niezależny odczyt do puli i zwraca Future.
+    Zadania w puli nie rysują UI - wywołania z st.error zostają w wątku skryptu.
+    """
+    return get_thread_pool().submit(func, *args, **kwargs)
+
+# --- ASYNCHRONICZNA BRAMKA KALENDARZA ---
+
+def get_gateway_settings():
+    cfg = dict(st.secrets.get("gateway", {}))
+    return {
+        'max_concurrency': int(cfg.get("max_concurrency", 4)),
+        'chunk_days': int(cfg.get("chunk_days", 7)),
+    }
+
+class CalendarGateway:
+    """
+    Odczyt wielu zakresów naraz: asyncio.gather nad asyncio.to_thread(list_all_events)
+    z semaforem - najwyżej max_concurrency zapytań do Google w locie na jedno wywołanie.
+    Limiter, bezpiecznik i single-flight działają jak przy zwykłym list_all_events.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.lock = threading.Lock()
+        self.stats = {'batches': 0, 'ranges': 0, 'in_flight': 0, 'peak_in_flight': 0}
+
+    def _track(self, delta):
+        with self.lock:
+            self.stats['in_flight'] += delta
+            self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self.stats['in_flight'])
+
+    async def _fetch(self, semaphore, time_min, time_max, calendar_id, params):
+        async with semaphore:
+            self._track(1)
+            try:
+                return await asyncio.to_thread(list_all_events, time_min, time_max, calendar_id=calendar_id, **params)
+            finally:
+                self._track(-1)
+
+    async def gather(self, ranges, **params):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(*(
+            self._fetch(semaphore, time_min, time_max, calendar_id, params)
+            for time_min, time_max, calendar_id in ranges
+        ))
+
+    def fetch_ranges(self, ranges, **params):
+        """
+        ranges: lista (time_min, time_max, calendar_id). Zwraca listy wydarzeń w tej samej kolejności;
+        pierwszy błąd (np. ServiceUnavailableError) przerywa całość. Wejście synchroniczne dla skryptu.
+        """
+        ranges = list(ranges)
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['ranges'] += len(ranges)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.gather(ranges, **params))
+        # Wątek z działającą pętlą zdarzeń - osobny wątek z własną pętlą
+        with ThreadPoolExecutor(max_workers=1) as runner:
+            return runner.submit(asyncio.run, self.gather(ranges, **params)).result()
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'max_concurrency': self.max_concurrency}
+
+@st.cache_resource
+def get_calendar_gateway():
+    return CalendarGateway(get_gateway_settings()['max_concurrency'])
+
+def day_ranges(first_day, last_day, chunk_days, calendar_id=None):
+    """Zakres dni pocięty na kawałki po `chunk_days` (pełne doby czasu warszawskiego) dla fetch_ranges."""
+    tz = ZoneInfo("Europe/Warsaw")
+    ranges = []
+    first = first_day
+    while first <= last_day:
+        last = min(first + datetime.timedelta(days=chunk_days - 1), last_day)
+        ranges.append((
+            datetime.datetime.combine(first, datetime.time(0, 0), tzinfo=tz).isoformat(),
+            datetime.datetime.combine(last, datetime.time(23, 59, 59), tzinfo=tz).isoformat(),
+            calendar_id,
+        ))
+        first = last + datetime.timedelta(days=1)
+    return ranges
+
+def merge_event_lists(event_lists):
+    """Łączy wyniki kawałków; wydarzenie na granicy dwóch zakresów zostaje raz."""
+    seen, merged = set(), []
+    for events in event_lists:
+        for event in events:
+            event_id = event.get('id')
+            if event_id is not None and event_id in seen:
+                continue
+            seen.add(event_id)
+            merged.append(event)
+    return merged
+
+# --- GRAFIK: OSTATNI ZNANY STAN (STALE-WHILE-REVALIDATE) ---
+
+class ScheduleCache:
+    """
+    Ostatnio pobrane wydarzenia dla (kalendarz, dzień) - serwowane, gdy Google nie odpowiada.
+    Gdy działa rozgrzewanie w tle, max_age > 0 i wpisy młodsze niż max_age
+    są serwowane od razu, bez odczytu z Kalendarza.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.max_age = 0
+        self.warm_keys = set()
+        self.stats = {'stale_served': 0, 'refreshed': 0, 'fresh_served': 0, 'warm_served': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[0] if entry else None
+
+    def get_fresh(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[1] >= self.max_age:
+                return None
+            self.stats['fresh_served'] += 1
+            return entry[0]
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.warm_keys.discard(key)
+
+    def load_warm(self, entries, saved_at):
+        """Wpisy ze snapshotu: każdy serwowany raz od razu, z odświeżeniem w tle (take_warm)."""
+        with self.lock:
+            for key, events in entries.items():
+                if key not in self.entries:
+                    self.entries[key] = (events, saved_at)
+                    self.warm_keys.add(key)
+
+    def take_warm(self, key):
+        with self.lock:
+            if key not in self.warm_keys:
+                return None
+            self.warm_keys.discard(key)
+            self.stats['warm_served'] += 1
+            return self.entries[key][0]
+
+    def put(self, key, events):
+        with self.lock:
+            self.entries[key] = (events, time.time())
+            self.warm_keys.discard(key)
+
+    def refresh_in_background(self, key, fetch):
+        """Odświeża wpis w osobnym wątku (najwyżej jedno odświeżanie na klucz)."""
+        with self.lock:
+            self.stats['stale_served'] += 1
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def worker():
+            try:
+                time.sleep(get_circuit_breaker("calendar").retry_after())
+                self.put(key, fetch())
+                with self.lock:
+                    self.stats['refreshed'] += 1
+            except Exception as e:
+                print(f"Błąd odświeżania grafiku {key}: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'entries': len(self.entries), 'refreshing': len(self.refreshing),
+                    'warm': len(self.warm_keys)}
+
+    def entries_for(self, keys):
+        with self.lock:
+            return {key: self.entries[key][0] for key in keys if key in self.entries}
+
+@st.cache_resource
+def get_schedule_cache():
+    return ScheduleCache()
+
 def parse_hours_from_title(title):
     """
     Wyciąga godziny z tytułu wydarzenia (np. '7:00-18:00', '08:00 - 20:00').
@@ -266,93 +1058,324 @@ def parse_hours_from_title(title):
         return match.group(1), match.group(2)
     return None, None
 
-def get_slots_for_day(date_obj):
+def fetch_day_events(d, calendar_id=None):
+    """Pobiera z Kalendarza wszystkie wydarzenia danego dnia (posortowane po starcie)."""
+    tz = ZoneInfo("Europe/Warsaw")
+
+    start_of_day = datetime.datetime.combine(d, datetime.time(0, 0), tzinfo=tz)
+    end_of_day = datetime.datetime.combine(d, datetime.time(23, 59, 59), tzinfo=tz)
+
+    return fetch_events(start_of_day.isoformat(), end_of_day.isoformat(), order_by='startTime', calendar_id=calendar_id)
+
+def get_day_events(d, calendar_id=None):
+    """
+    Zwraca (events, is_stale). Gdy Kalendarz nie odpowiada, serwuje ostatni znany
+    grafik dnia (is_stale=True) i odświeża go w tle. Bez kopii rzuca ServiceUnavailableError.
+    Wpis ze snapshotu po restarcie też jest serwowany jako is_stale=True.
+    Przy działającym rozgrzewaniu w tle świeży wpis kopii jest serwowany bez odczytu.
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+    store = get_calendar_store()
+    if store is not None:
+        is_stale = sync_store_or_stale(calendar_id, d)
+        return store.day_events(calendar_id, d), is_stale
+
+    key = (calendar_id, d.isoformat())
+    cache = get_schedule_cache()
+    fresh = cache.get_fresh(key)
+    if fresh is not None:
+        return fresh, False
+    get_warm_start()
+    warm = cache.take_warm(key)
+    if warm is not None:
+        # Wpis ze snapshotu ma nieznany wiek względem Kalendarza - pokazujemy ostrzeżenie
+        cache.refresh_in_background(key, lambda: fetch_day_events(d, calendar_id))
+        return warm, True
+    # Inna replika mogła już pobrać ten dzień
+    shared = shared_cache_call("get", shared_day_key(calendar_id, d))
+    if shared is not None:
+        cache.put(key, shared)
+        return shared, False
+    try:
+        events = fetch_day_events(d, calendar_id)
+    except Exception as e:
+        cached = cache.get(key)
+        if cached is None:
+            if isinstance(e, ServiceUnavailableError):
+                raise
+            raise ServiceUnavailableError("calendar", get_circuit_breaker("calendar").retry_after()) from e
+        print(f"Serwuję zapamiętany grafik {d}: {e}")
+        cache.refresh_in_background(key, lambda: fetch_day_events(d, calendar_id))
+        return cached, True
+
+    cache.put(key, events)
+    shared_cache_call("set", shared_day_key(calendar_id, d), events, get_shared_cache_settings()['ttl'])
+    return events, False
+
+def get_slots_for_day(date_obj, df_users=None, calendar_id=None):
     """
     Sprawdza dostępność parsując Imiona i Nazwiska z tytułów.
+    Wydarzenia i baza użytkowników (jeśli nie podano df_users) są pobierane równolegle.
+    Jeśli grafik pochodzi z zapamiętanej kopii, ustawia st.session_state['schedule_stale'].
     """
-    service = get_calendar_service()
-    df_users = get_users_db() # Pobieramy bazę do identyfikacji
-    
     tz = ZoneInfo("Europe/Warsaw")
     d = date_obj.date() if isinstance(date_obj, datetime.datetime) else date_obj
-    
-    start_of_day = datetime.datetime.combine(d, datetime.time(0, 0), tzinfo=tz)
-    end_of_day = datetime.datetime.combine(d, datetime.time(23, 59, 59), tzinfo=tz)
 
-    events_result = service.events().list(
-        calendarId=CALENDAR_ID, 
-        timeMin=start_of_day.isoformat(), 
-        timeMax=end_of_day.isoformat(),
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    
-    events = events_result.get('items', [])
-    
-    main_event = None
-    start_h, end_h = None, None
-    for event in events:
-        s, e = parse_hours_from_title(event.get('summary', ''))
-        if s and e:
-            main_event = event
-            start_h, end_h = int(s.split(':')[0]), int(e.split(':')[0])
-            break
-    
-    if not main_event: return {}, []
+    events_future = submit_task(get_day_events, d, calendar_id)
+    if df_users is None:
+        df_users = get_users_db() # Pobieramy bazę do identyfikacji
+
+    events, is_stale = events_future.result()
+    st.session_state['schedule_stale'] = is_stale
 
-    all_slots = range(start_h, end_h)
-    available_slots = {}
-    my_booked_hours = []
-    slot_occupancy = {h: [] for h in all_slots}
-    
     current_user_email = st.session_state.get('user_email', '').strip().lower()
+    occupancy = compute_day_occupancy(events, df_users, current_user_email)
 
-    for event in events:
-        if event['id'] == main_event['id']: continue
-        
-        start_str = event['start'].get('dateTime')
-        if not start_str: continue 
-        
-        dt_obj = datetime.datetime.fromisoformat(start_str).astimezone(tz)
-        ev_hour = dt_obj.hour
-        
-        if ev_hour not in all_slots: continue
+    available_slots = {h: status for h, status in occupancy.items() if status not in (SLOT_FULL, SLOT_MINE)}
+    my_booked_hours = [h for h, status in occupancy.items() if status == SLOT_MINE]
+    return available_slots, my_booked_hours
 
-        title = event.get('summary', '')
-        
-        found_emails, has_unknown = get_participants_from_title(title, df_users)
-        
-        if not found_emails:
-            continue
+SLOT_FULL = "FULL"
+SLOT_MINE = "MINE"
 
-        if current_user_email in found_emails:
-            my_booked_hours.append(ev_hour)
-            continue
-            
-        people_count = len(found_emails) + (1 if has_unknown else 0)
-        
-        if people_count >= 2:
-            slot_occupancy[ev_hour] = "FULL"
-        elif people_count == 1:
-            slot_occupancy[ev_hour] = title
-
-    for h in all_slots:
-        status = slot_occupancy[h]
-        if h in my_booked_hours: continue
-        if status == "FULL": continue
-        
-        if status == []:
-            available_slots[h] = "Wolne"
+def compute_day_occupancy(events, df_users, user_email):
+    """
+    Reguły zajętości jednego dnia (events posortowane po starcie).
+    Zwraca {godzina: status} dla każdej godziny dyżuru; status to "Wolne",
+    "Dołącz do: <tytuł>", SLOT_FULL albo SLOT_MINE. Brak dyżuru - pusty słownik.
+    """
+    return {h: status for h, (status, _) in day_occupancy_details(events, df_users, user_email).items()}
+
+def day_occupancy_details(events, df_users, user_email):
+    """Jak compute_day_occupancy, ale z emailami osób zajmujących godzinę: {h: (status, emails)}."""
+    by_day = occupancy_details_by_day(build_event_table(events, df_users), user_email)
+    return next(iter(by_day.values()), {})
+
+# --- TABELA WYDARZEŃ (KOLUMNOWA) ---
+
+OVERVIEW_NONE, OVERVIEW_FREE, OVERVIEW_JOIN, OVERVIEW_FULL, OVERVIEW_MINE = -1, 0, 1, 2, 3
+
+SHIFT_HOURS_PATTERN = r'(\d{1,2}):\d{2}\s*[-–—]\s*(\d{1,2}):\d{2}'
+EVENT_TABLE_DTYPES = {
+    'id': object, 'start': 'datetime64[ns, Europe/Warsaw]', 'date': object, 'hour': int, 'shift_start': int, 'shift_end': int,
+    'title': object, 'emails': object, 'people': int,
+}
+
+def build_event_table(events, df_users):
+    """
+    Zamienia listę wydarzeń (jeden odczyt) na tabelę kolumnową - wiersz na wydarzenie,
+    kolejność zachowana. Czas i godziny dyżuru parsowane wektorowo; uczestników
+    rozpoznajemy raz na unikalną parę (tytuł, pole participants).
+    Kolumny: id, start, date, hour (-1 dla całodniowych), shift_start/shift_end (-1 poza
+    wydarzeniem dyżuru), title, emails (krotka), people (emaile + nierozpoznani).
+    """
+    if not events:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in EVENT_TABLE_DTYPES.items()})
+
+    tz = ZoneInfo("Europe/Warsaw")
+    raw = pd.json_normalize(events).reindex(
+        columns=['id', 'summary', 'start.dateTime', 'start.date', f'extendedProperties.private.{PARTICIPANTS_PROPERTY}']
+    )
+    raw.columns = ['id', 'title', 'start', 'all_day', 'participants']
+
+    start = pd.to_datetime(raw['start'], utc=True, format='ISO8601', errors='coerce').dt.tz_convert(tz)
+    all_day = pd.to_datetime(raw['all_day'], format='ISO8601', errors='coerce')
+    dates = start.dt.date.where(start.notna(), all_day.dt.date)
+
+    titles = raw['title'].fillna('').astype(object)
+    shift_hours = titles.astype(str).str.extract(SHIFT_HOURS_PATTERN).astype(float).fillna(-1).astype(int)
+
+    keys = list(zip(titles, raw['participants'].astype(object).where(raw['participants'].notna(), None)))
+    resolved = {}
+    fingerprint = users_fingerprint(df_users)
+    for title, participants in dict.fromkeys(keys):
+        event = {'summary': title}
+        if participants is not None:
+            event['extendedProperties'] = {'private': {PARTICIPANTS_PROPERTY: participants}}
+        emails, has_unknown = get_event_participants(event, df_users, fingerprint)
+        resolved[(title, participants)] = (tuple(emails), len(emails) + (1 if has_unknown and emails else 0))
+
+    participants = pd.Series(keys, dtype=object).map(resolved)
+    return pd.DataFrame({
+        'id': raw['id'],
+        'start': start,
+        'date': dates,
+        'hour': start.dt.hour.fillna(-1).astype(int),
+        'shift_start': shift_hours[0],
+        'shift_end': shift_hours[1],
+        'title': titles,
+        'emails': participants.str[0],
+        'people': participants.str[1].astype(int),
+    })
+
+def occupancy_frame(table, user_email):
+    """
+    Reguły zajętości dla wszystkich dni tabeli naraz (te same co dawniej w pętli):
+    dyżur dnia to pierwsze wydarzenie z godzinami w tytule; w każdej godzinie wygrywa
+    "mój" zapis, a wśród pozostałych ostatnie wydarzenie (2+ osoby = pełne).
+    Zwraca DataFrame z kolumnami date, hour, code (OVERVIEW_*), title, emails, event_id
+    (event_id = wydarzenie, do którego się dołącza; puste dla wolnych i "moich" godzin).
+    """
+    columns = ['date', 'hour', 'code', 'title', 'emails', 'event_id']
+    shifts = table[(table['shift_start'] >= 0) & table['date'].notna()].drop_duplicates('date')
+    lengths = (shifts['shift_end'] - shifts['shift_start']).clip(lower=0).to_numpy()
+    if not lengths.sum():
+        return pd.DataFrame(columns=columns)
+
+    # Wszystkie godziny dyżurów: dzień powtórzony tyle razy, ile ma godzin
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    slots = pd.DataFrame({
+        'date': np.repeat(shifts['date'].to_numpy(), lengths),
+        'hour': np.repeat(shifts['shift_start'].to_numpy(), lengths) + offsets,
+    })
+
+    bookings = table.merge(
+        shifts[['date', 'id', 'shift_start', 'shift_end']].rename(
+            columns={'id': 'shift_id', 'shift_start': 'first_hour', 'shift_end': 'end_hour'}),
+        on='date'
+    )
+    bookings = bookings[
+        (bookings['id'] != bookings['shift_id']) & (bookings['hour'] >= bookings['first_hour'])
+        & (bookings['hour'] < bookings['end_hour']) & (bookings['people'] > 0)
+    ].reset_index(drop=True)
+
+    exploded = bookings['emails'].explode()
+    bookings['mine'] = bookings.index.isin(exploded.index[exploded == user_email])
+    mine = bookings.loc[bookings['mine'], ['date', 'hour']].drop_duplicates().assign(is_mine=True)
+    last = bookings[~bookings['mine']].drop_duplicates(['date', 'hour'], keep='last')
+
+    frame = slots.merge(last[['date', 'hour', 'title', 'emails', 'people', 'id']].rename(columns={'id': 'event_id'}),
+                        on=['date', 'hour'], how='left')
+    frame = frame.merge(mine, on=['date', 'hour'], how='left')
+    is_mine = frame['is_mine'].eq(True).to_numpy()
+    people = frame['people'].fillna(0).to_numpy()
+
+    frame['code'] = np.select(
+        [is_mine, people >= 2, people == 1],
+        [OVERVIEW_MINE, OVERVIEW_FULL, OVERVIEW_JOIN],
+        default=OVERVIEW_FREE
+    )
+    frame['emails'] = frame['emails'].where(frame['people'].notna(), None)
+    frame.loc[is_mine, 'emails'] = pd.Series([(user_email,)] * int(is_mine.sum()), index=frame.index[is_mine], dtype=object)
+    return frame[columns]
+
+def occupancy_details_by_day(table, user_email, frame=None):
+    """{dzień: {godzina: (status, emails)}} z tabeli wydarzeń; status jak w compute_day_occupancy."""
+    if frame is None:
+        frame = occupancy_frame(table, user_email)
+    by_day = {}
+    for day, hour, code, title, emails in zip(frame['date'], frame['hour'], frame['code'], frame['title'], frame['emails']):
+        if code == OVERVIEW_MINE:
+            status = SLOT_MINE
+        elif code == OVERVIEW_FULL:
+            status = SLOT_FULL
+        elif code == OVERVIEW_JOIN:
+            status = f"Dołącz do: {title}"
         else:
-            available_slots[h] = f"Dołącz do: {status}"
-            
-    return available_slots, my_booked_hours
+            status = "Wolne"
+        by_day.setdefault(day, {})[int(hour)] = (status, list(emails) if isinstance(emails, tuple) else [])
+    return by_day
+
+# --- PRZEGLĄD DOSTĘPNOŚCI (KILKA TYGODNI) ---
+
+OVERVIEW_ICONS = {OVERVIEW_NONE: "", OVERVIEW_FREE: "🟢", OVERVIEW_JOIN: "🤝", OVERVIEW_FULL: "⛔", OVERVIEW_MINE: "✅"}
+WEEKDAY_NAMES = ['Pn', 'Wt', 'Śr', 'Cz', 'Pt', 'Sb', 'Nd']
+
+def get_availability_matrix(start_date, weeks=4, df_users=None, user_email=None, calendar_id=None):
+    """
+    Macierz dzień × godzina (kody OVERVIEW_*) na `weeks` tygodni od start_date.
+    Zakres czytany kawałkami ([gateway] chunk_days) równolegle przez bramkę, a reguły
+    zajętości są te same co w get_slots_for_day - liczone naraz dla całej tabeli (occupancy_frame).
+    """
+    days = [start_date + datetime.timedelta(days=i) for i in range(weeks * 7)]
+    ranges = day_ranges(days[0], days[-1], get_gateway_settings()['chunk_days'], calendar_id)
+
+    events_future = submit_task(get_calendar_gateway().fetch_ranges, ranges, orderBy='startTime')
+    if df_users is None:
+        df_users = get_users_db()
+    if user_email is None:
+        user_email = st.session_state.get('user_email', '').strip().lower()
+    frame = occupancy_frame(build_event_table(merge_event_lists(events_future.result()), df_users), user_email)
+
+    rows = pd.Index(days).get_indexer(frame['date'])
+    frame = frame[rows >= 0]
+    matrix = np.full((len(days), 24), OVERVIEW_NONE, dtype=np.int8)
+    matrix[rows[rows >= 0], frame['hour'].to_numpy(dtype=np.intp)] = frame['code'].to_numpy(dtype=np.int8)
+    return pd.DataFrame(matrix, index=pd.Index(days, name="Data"), columns=range(24))
+
+def format_availability_overview(matrix):
+    """Zamienia macierz kodów na tabelę z ikonami (tylko godziny, w których bywa dyżur)."""
+    active_hours = matrix.columns[(matrix != OVERVIEW_NONE).any(axis=0).to_numpy()]
+    view = matrix[active_hours].replace(OVERVIEW_ICONS)
+    view.columns = [f"{h}:00" for h in active_hours]
+    view.index = [f"{WEEKDAY_NAMES[d.weekday()]} {d.strftime('%d-%m')}" for d in matrix.index]
+    return view
+
+# --- WYSZUKIWANIE NAJBLIŻSZEGO TERMINU ---
+
+def build_free_hour_index(events, df_users, user_email):
+    """Indeks {dzień: {godzina: (status, emails)}} zawierający tylko godziny, na które można się zapisać."""
+    details = occupancy_details_by_day(build_event_table(events, df_users), user_email)
+    index = {}
+    for day, hours in details.items():
+        free = {h: v for h, v in hours.items() if v[0] not in (SLOT_FULL, SLOT_MINE)}
+        if free:
+            index[day] = free
+    return index
+
+def find_next_slots(start_date, favorites, limit=3, favorites_only=False, max_weeks=12, chunk_days=7,
+                    df_users=None, user_email=None, calendar_id=None):
+    """
+    Szuka najbliższych godzin: wolnych albo z jedną osobą z listy ulubionych.
+    Kalendarz czyta porcjami po `chunk_days` dni i kończy po znalezieniu `limit` wyników:
+    pierwsza porcja sama (zwykle wystarcza), kolejne falami przez bramkę, po max_concurrency naraz.
+    Zwraca listę słowników {date, hour, status, partner}.
+    """
+    tz = ZoneInfo("Europe/Warsaw")
+    if df_users is None:
+        df_users = get_users_db()
+    if user_email is None:
+        user_email = st.session_state.get('user_email', '').strip().lower()
+    favorites = {e.strip().lower() for e in favorites}
+    now = datetime.datetime.now(tz)
+
+    gateway = get_calendar_gateway()
+    pending = []
+    for offset in range(0, max_weeks * 7, chunk_days):
+        days = [start_date + datetime.timedelta(days=offset + i) for i in range(chunk_days)]
+        pending.append((days, day_ranges(days[0], days[-1], chunk_days, calendar_id)[0]))
+
+    matches = []
+    wave = 1
+    while pending:
+        batch, pending = pending[:wave], pending[wave:]
+        wave = gateway.max_concurrency
+        results = gateway.fetch_ranges([chunk_range for _, chunk_range in batch], orderBy='startTime')
+        for (days, _), events in zip(batch, results):
+            index = build_free_hour_index(events, df_users, user_email)
+
+            for day in days:
+                for hour, (status, emails) in sorted(index.get(day, {}).items()):
+                    if day == now.date() and hour <= now.hour:
+                        continue
+                    partner = emails[0] if len(emails) == 1 else None
+                    if status == "Wolne" and not favorites_only:
+                        matches.append({'date': day, 'hour': hour, 'status': status, 'partner': None})
+                    elif partner in favorites:
+                        matches.append({'date': day, 'hour': hour, 'status': status, 'partner': partner})
+                    else:
+                        continue
+                    if len(matches) >= limit:
+                        return matches
+    return matches
 
-def book_event(date_obj, hour, second_preacher_obj=None):
+def book_event(date_obj, hour, second_preacher_obj=None, df_users=None, calendar_id=None):
     """
     Tworzy lub aktualizuje wydarzenie, operując na TYTULE (Imię Nazwisko).
-    Nie używa pola 'description' do przechowywania emaili.
+    Nie używa pola 'description' do przechowywania emaili - te trafiają
+    do extendedProperties.private (patrz set_event_participant_emails).
     """
+    calendar_id = calendar_id or CALENDAR_ID
     service = get_calendar_service()
     user_email = st.session_state['user_email']
     user_name = st.session_state['user_name']
@@ -367,12 +1390,12 @@ def book_event(date_obj, hour, second_preacher_obj=None):
     start_dt = datetime.datetime.combine(d, datetime.time(hour, 0), tzinfo=tz)
     end_dt = start_dt + datetime.timedelta(hours=1)
     
-    events_existing = service.events().list(
-        calendarId=CALENDAR_ID,
+    events_existing = execute_api(service.events().list(
+        calendarId=calendar_id,
         timeMin=start_dt.isoformat(),
         timeMax=end_dt.isoformat(),
         singleEvents=True
-    ).execute().get('items', [])
+    )).get('items', [])
     
     target_event = None
     for ev in events_existing:
@@ -388,14 +1411,19 @@ def book_event(date_obj, hour, second_preacher_obj=None):
             sec_name = f"{second_preacher_obj['Imię']} {second_preacher_obj['Nazwisko']}"
             title += f" i {sec_name}"
 
+        # Własne id: wstawienie jest idempotentne, a indeks uczestników zna klucz od razu
         event_body = {
+            'id': uuid.uuid4().hex,
             'summary': title,
             'description': desc,
             'start': {'dateTime': start_dt.isoformat(), 'timeZone': 'Europe/Warsaw'},
             'end': {'dateTime': end_dt.isoformat(), 'timeZone': 'Europe/Warsaw'},
         }
+        set_event_participant_emails(event_body, [user_email, second_preacher_obj['Email'] if second_preacher_obj else None])
         try:
-            service.events().insert(calendarId=CALENDAR_ID, body=event_body).execute()
+            # 409 po ponowieniu: wydarzenie z naszym id już jest - zapis się udał
+            execute_api(service.events().insert(calendarId=calendar_id, body=event_body), done_statuses=(409,))
+            record_event_write(calendar_id, event_body)
 
             if second_preacher_obj:
                 subj = "Służba przy wózku - Nowy termin"
@@ -406,6 +1434,8 @@ def book_event(date_obj, hour, second_preacher_obj=None):
                         f"Do zobaczenia!")
                 send_notification_email(second_preacher_obj['Email'], subj, body)
             return True
+        except ServiceUnavailableError:
+            raise
         except Exception as e:
             print(f"Błąd insert: {e}")
             return False
@@ -419,14 +1449,18 @@ def book_event(date_obj, hour, second_preacher_obj=None):
         if re.search(r'\s+(?:i|\+|&)\s+', current_title):
             return False
             
+        # Organizatora znamy z pola strukturalnego - baza potrzebna tylko dla wydarzeń ręcznych
+        if get_event_participant_emails(target_event) is None and df_users is None:
+            df_users = get_users_db()
+        organizer_emails, _ = get_event_participants(target_event, df_users)
+
         new_title = f"{current_title} i {user_name}"
         target_event['summary'] = new_title
+        set_event_participant_emails(target_event, organizer_emails + [user_email])
         
         try:
-            service.events().update(calendarId=CALENDAR_ID, eventId=target_event['id'], body=target_event).execute()
-            
-            df_users = get_users_db()
-            organizer_emails, _ = get_participants_from_title(current_title, df_users)
+            execute_api(service.events().update(calendarId=calendar_id, eventId=target_event['id'], body=target_event))
+            record_event_write(calendar_id, target_event)
             
             if organizer_emails:
                 organizer_email = organizer_emails[0]
@@ -440,12 +1474,157 @@ def book_event(date_obj, hour, second_preacher_obj=None):
                 send_notification_email(organizer_email, subj, body)
                 
             return True
+        except ServiceUnavailableError:
+            raise
         except Exception as e:
             print(f"Błąd update: {e}")
             return False
 
-def cancel_booking(date_obj, hour, delete_entirely=False):
+def book_recurring(start_date, hour, weeks, second_preacher_obj=None, df_users=None, calendar_id=None):
+    """
+    Zapis cykliczny: ten sam dzień tygodnia i godzina przez `weeks` tygodni.
+    Dostępność wszystkich dat sprawdza jednym odczytem zakresu, wszystkie
+    wstawienia/dołączenia wysyła jednym batchem, a każda osoba dostaje jeden
+    zbiorczy e-mail. Zwraca {'booked', 'joined', 'skipped', 'failed'}.
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+    service = get_calendar_service()
+    user_email = st.session_state['user_email'].strip().lower()
+    user_name = st.session_state['user_name']
+
+    gender = st.session_state.get('user_gender', 'M')
+    verb_signed = "zapisała" if gender == "K" else "zapisał"
+    verb_joined = "dołączyła" if gender == "K" else "dołączył"
+    style_b = 'style="color: #000000; font-weight: bold;"'
+
+    tz = ZoneInfo("Europe/Warsaw")
+    d = start_date.date() if isinstance(start_date, datetime.datetime) else start_date
+    dates = [d + datetime.timedelta(weeks=i) for i in range(weeks)]
+
+    time_min = datetime.datetime.combine(dates[0], datetime.time(0, 0), tzinfo=tz)
+    time_max = datetime.datetime.combine(dates[-1], datetime.time(23, 59, 59), tzinfo=tz)
+    events_future = submit_task(list_all_events, time_min.isoformat(), time_max.isoformat(),
+                                calendar_id=calendar_id, orderBy='startTime')
+    if df_users is None:
+        df_users = get_users_db()
+    events = events_future.result()
+    table = build_event_table(events, df_users)
+    frame = occupancy_frame(table, user_email)
+    occupancy = occupancy_details_by_day(table, user_email, frame)
+    # Dołączamy do tego samego wydarzenia, które occupancy_frame uznało za zajmujące godzinę
+    join_targets = frame[frame['code'] == OVERVIEW_JOIN].set_index(['date', 'hour'])['event_id'].to_dict()
+    events_by_id = {ev.get('id'): ev for ev in events}
+
+    result = {'booked': [], 'joined': [], 'skipped': [], 'failed': []}
+    pending = {}
+    join_organizers = {}
+    failed_ids = set()
+
+    def on_response(request_id, response, exception):
+        # 409 przy ponowionym batchu = wydarzenie o tym id już istnieje
+        if exception is not None and getattr(getattr(exception, 'resp', None), 'status', None) != 409:
+            print(f"Błąd zapisu cyklicznego {request_id}: {exception}")
+            failed_ids.add(request_id)
+
+    batch = service.new_batch_http_request(callback=on_response)
+
+    for day in dates:
+        status, emails = occupancy.get(day, {}).get(hour, (None, []))
+        if status is None:
+            result['skipped'].append((day, "brak dyżuru"))
+            continue
+        if status == SLOT_MINE:
+            result['skipped'].append((day, "już jesteś zapisany"))
+            continue
+        if status == SLOT_FULL:
+            result['skipped'].append((day, "brak miejsc"))
+            continue
+
+        start_dt = datetime.datetime.combine(day, datetime.time(hour, 0), tzinfo=tz)
+        end_dt = start_dt + datetime.timedelta(hours=1)
+
+        if status == "Wolne":
+            title = user_name
+            participants = [user_email]
+            if second_preacher_obj:
+                title += f" i {second_preacher_obj['Imię']} {second_preacher_obj['Nazwisko']}"
+                participants.append(second_preacher_obj['Email'])
+            # Własne id czyni wstawienie idempotentnym, gdy batch zostanie ponowiony
+            event_body = {
+                'id': uuid.uuid4().hex,
+                'summary': title,
+                'description': "",
+                'start': {'dateTime': start_dt.isoformat(), 'timeZone': 'Europe/Warsaw'},
+                'end': {'dateTime': end_dt.isoformat(), 'timeZone': 'Europe/Warsaw'},
+            }
+            set_event_participant_emails(event_body, participants)
+            request = service.events().insert(calendarId=calendar_id, body=event_body)
+            pending[day.isoformat()] = (day, 'booked', event_body)
+        else:
+            if second_preacher_obj:
+                result['skipped'].append((day, "jest tylko 1 wolne miejsce"))
+                continue
+            target_event = events_by_id.get(join_targets.get((day, hour)))
+            if target_event is None:
+                result['skipped'].append((day, "brak wydarzenia"))
+                continue
+            # Lista wydarzeń jest współdzielona (single-flight) - modyfikujemy kopię
+            target_event = copy.deepcopy(target_event)
+            target_event['summary'] = f"{target_event.get('summary', '')} i {user_name}"
+            set_event_participant_emails(target_event, emails + [user_email])
+            request = service.events().update(calendarId=calendar_id, eventId=target_event['id'], body=target_event)
+            pending[day.isoformat()] = (day, 'joined', target_event)
+            for organizer in emails[:1]:
+                join_organizers.setdefault(organizer, []).append(day)
+
+        batch.add(request, request_id=day.isoformat())
+
+    if not pending:
+        return result
+
+    def run_batch():
+        # Ponowienie całego batcha: błędy z poprzedniej próby już nie obowiązują
+        failed_ids.clear()
+        return batch.execute()
+
+    call_api("calendar", run_batch)
+
+    for request_id, (day, kind, body) in pending.items():
+        if request_id in failed_ids:
+            result['failed'].append(day)
+        else:
+            result[kind].append(day)
+            record_event_write(calendar_id, body)
+
+    def dates_list(days):
+        return "\n".join(f"- <b {style_b}>{x.strftime('%d-%m-%Y')}</b>" for x in days)
+
+    hours_str = f"<b {style_b}>{hour}:00 - {hour+1}:00</b>"
+    if second_preacher_obj and result['booked']:
+        subj = "Służba przy wózku - Nowe terminy"
+        body = (f"Cześć!\n\n"
+                f"{user_name} {verb_signed} Ciebie do współpracy w kolejnych tygodniach.\n"
+                f"Godzina: {hours_str}\n"
+                f"Daty:\n{dates_list(result['booked'])}\n\n"
+                f"Do zobaczenia!")
+        send_notification_email(second_preacher_obj['Email'], subj, body)
+
+    for organizer, days in join_organizers.items():
+        days = [x for x in days if x in result['joined']]
+        if days:
+            subj = "Służba przy wózku - Ktoś dołączył!"
+            body = (f"Cześć!\n\n"
+                    f"{user_name} {verb_joined} do Ciebie do współpracy.\n"
+                    f"Godzina: {hours_str}\n"
+                    f"Daty:\n{dates_list(days)}\n\n"
+                    f"Do zobaczenia!")
+            send_notification_email(organizer, subj, body)
+
+    return result
+
+def cancel_booking(date_obj, hour, delete_entirely=False, df_users=None, calendar_id=None):
     """Usuwa użytkownika z TYTUŁU, identyfikując go przez BAZĘ DANYCH (odporne na zmianę imienia)."""
+    calendar_id = calendar_id or CALENDAR_ID
     service = get_calendar_service()
     
     my_email = st.session_state['user_email'].strip().lower()
@@ -461,9 +1640,12 @@ def cancel_booking(date_obj, hour, delete_entirely=False):
     start_dt = datetime.datetime.combine(d, datetime.time(hour, 0), tzinfo=tz)
     end_dt = start_dt + datetime.timedelta(hours=1)
     
-    events = service.events().list(
-        calendarId=CALENDAR_ID, timeMin=start_dt.isoformat(), timeMax=end_dt.isoformat(), singleEvents=True
-    ).execute().get('items', [])
+    events_future = submit_task(execute_api, service.events().list(
+        calendarId=calendar_id, timeMin=start_dt.isoformat(), timeMax=end_dt.isoformat(), singleEvents=True
+    ))
+    if df_users is None:
+        df_users = get_users_db()
+    events = events_future.result().get('items', [])
     
     target_event = None
     for ev in events:
@@ -475,12 +1657,20 @@ def cancel_booking(date_obj, hour, delete_entirely=False):
     title = target_event.get('summary', '')
     
     parts = re.split(r'\s+(?:i|\+|&)\s+', title)
-    
-    df_users = get_users_db()
+
+    # Kolejność emaili w polu strukturalnym odpowiada kolejności nazwisk w tytule
+    participants = get_event_participant_emails(target_event)
+    if participants is not None and len(participants) != len(parts):
+        participants = None
     
     my_part_index = -1
+
+    if participants is not None and my_email in participants:
+        my_part_index = participants.index(my_email)
     
     for i, part in enumerate(parts):
+        if my_part_index != -1:
+            break
         found_emails, _ = get_participants_from_title(part, df_users)
         
         if my_email in found_emails:
@@ -499,9 +1689,12 @@ def cancel_booking(date_obj, hour, delete_entirely=False):
         return False
 
     remaining_names = [parts[i] for i in range(len(parts)) if i != my_part_index]
+    remaining_emails = None
+    if participants is not None:
+        remaining_emails = [participants[i] for i in range(len(participants)) if i != my_part_index]
     
     def send_broadcast_alert(excluded_list):
-        others = get_emails_for_day(d, exclude_hour=hour, exclude_emails=excluded_list)
+        others = get_emails_for_day(d, exclude_hour=hour, exclude_emails=excluded_list, df_users=df_users, calendar_id=calendar_id)
         if others:
             subj = f"Służba przy wózku - Zmiana w grafiku"
             body = (f"Cześć!\n\n"
@@ -513,14 +1706,26 @@ def cancel_booking(date_obj, hour, delete_entirely=False):
                 send_notification_email(recipient, subj, body)
 
     if (len(parts) == 1) or delete_entirely:
-        service.events().delete(calendarId=CALENDAR_ID, eventId=target_event['id']).execute()
+        try:
+            # 404/410 po ponowieniu: pierwsza próba już usunęła wydarzenie
+            execute_api(service.events().delete(calendarId=calendar_id, eventId=target_event['id']),
+                        done_statuses=(404, 410))
+            record_event_delete(calendar_id, target_event)
+        except ServiceUnavailableError:
+            raise
+        except Exception as e:
+            print(f"Błąd delete: {e}")
+            return False
 
         partner_email_to_exclude = None
         partner_email_to_notify = None
 
         if len(remaining_names) > 0:
             partner_name_str = remaining_names[0]
-            partner_emails, _ = get_participants_from_title(partner_name_str, df_users)
+            if remaining_emails is not None:
+                partner_emails = remaining_emails[:1]
+            else:
+                partner_emails, _ = get_participants_from_title(partner_name_str, df_users)
             
             if partner_emails:
                 partner_email_to_notify = partner_emails[0]
@@ -545,9 +1750,20 @@ def cancel_booking(date_obj, hour, delete_entirely=False):
     else:
         new_title = " i ".join(remaining_names)
         target_event['summary'] = new_title
-        service.events().update(calendarId=CALENDAR_ID, eventId=target_event['id'], body=target_event).execute()
+        if remaining_emails is not None:
+            partner_emails = remaining_emails
+        else:
+            partner_emails, _ = get_participants_from_title(new_title, df_users)
+        set_event_participant_emails(target_event, partner_emails)
+        try:
+            execute_api(service.events().update(calendarId=calendar_id, eventId=target_event['id'], body=target_event))
+            record_event_write(calendar_id, target_event)
+        except ServiceUnavailableError:
+            raise
+        except Exception as e:
+            print(f"Błąd update: {e}")
+            return False
         
-        partner_emails, _ = get_participants_from_title(new_title, df_users)
         if partner_emails:
             subj = "Służba przy wózku - Zmiana w grafiku"
             msg = (f"Cześć!\n\n"
@@ -559,66 +1775,590 @@ def cancel_booking(date_obj, hour, delete_entirely=False):
             
         return True
 
-def get_user_upcoming_events(days_ahead=30):
-    """Pobiera listę dyżurów od dzisiaj na 30 dni w przód (wg Imienia i Nazwiska)."""
-    service = get_calendar_service()
-    my_email = st.session_state['user_email'].strip().lower()
+# --- INDEKS UCZESTNIKÓW (EMAIL -> WYDARZENIA) ---
+
+class ParticipantIndex:
+    """
+    Odwrotny indeks nadchodzących dyżurów: email -> klucze (kalendarz, id wydarzenia).
+    Budowany jednym odczytem zakresu na kalendarz i poprawiany przy własnych zapisach,
+    więc "Twoje zapisy" to wyszukanie w słowniku zamiast parsowania całego grafiku.
+    """
+
+    def __init__(self):
+        self.events = {}      # klucz -> (start, tytuł, emaile)
+        self.by_email = {}    # email -> set(kluczy)
+        self.built = {}       # kalendarz -> (czas budowy, horyzont, odcisk bazy)
+        self.touched = {}     # kalendarz -> {klucz: czas ostatniej lokalnej zmiany}
+        self.lock = threading.Lock()
+        self.stats = {'lookups': 0, 'rebuilds': 0, 'updates': 0}
+
+    def _drop(self, key):
+        entry = self.events.pop(key, None)
+        if entry:
+            for email in entry[2]:
+                keys = self.by_email.get(email)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.by_email[email]
+
+    def _put(self, key, entry):
+        self.events[key] = entry
+        for email in entry[2]:
+            self.by_email.setdefault(email, set()).add(key)
+
+    def is_fresh(self, calendar_id, fingerprint, horizon, ttl):
+        with self.lock:
+            built = self.built.get(calendar_id)
+        return (built is not None and time.time() - built[0] < ttl
+                and built[1] >= horizon and built[2] == fingerprint)
+
+    def rebuild(self, calendar_id, entries, fingerprint, horizon, started_at):
+        """Podmienia wpisy kalendarza; zmiany lokalne nowsze niż odczyt (started_at) zostają."""
+        with self.lock:
+            touched = self.touched.get(calendar_id, {})
+            recent = {key for key, t in touched.items() if t >= started_at}
+            for key in [k for k in self.events if k[0] == calendar_id and k not in recent]:
+                self._drop(key)
+            for key, entry in entries.items():
+                if key not in recent:
+                    self._put(key, entry)
+            self.touched[calendar_id] = {key: touched[key] for key in recent}
+            self.built[calendar_id] = (time.time(), horizon, fingerprint)
+            self.stats['rebuilds'] += 1
+
+    def upsert(self, calendar_id, event):
+        """Po własnym zapisie: uczestnicy z pola strukturalnego wydarzenia."""
+        with self.lock:
+            if calendar_id not in self.built:
+                return
+            key = (calendar_id, event['id'])
+            self.touched.setdefault(calendar_id, {})[key] = time.time()
+            self._drop(key)
+            emails = get_event_participant_emails(event)
+            start_str = event.get('start', {}).get('dateTime')
+            if emails and start_str:
+                start = datetime.datetime.fromisoformat(start_str).astimezone(ZoneInfo("Europe/Warsaw"))
+                self._put(key, (start, event.get('summary', ''), tuple(emails)))
+            self.stats['updates'] += 1
+
+    def remove(self, calendar_id, event_id):
+        with self.lock:
+            if calendar_id not in self.built:
+                return
+            key = (calendar_id, event_id)
+            self.touched.setdefault(calendar_id, {})[key] = time.time()
+            self._drop(key)
+            self.stats['updates'] += 1
+
+    def invalidate(self, calendar_id=None):
+        """Wymusza przebudowę przy następnym odczycie (np. po synchronizacji bazy)."""
+        with self.lock:
+            if calendar_id is None:
+                self.built.clear()
+            else:
+                self.built.pop(calendar_id, None)
+
+    def lookup(self, email, start, end):
+        """Lista (start, kalendarz, tytuł) dyżurów osoby w [start, end), posortowana po czasie."""
+        with self.lock:
+            self.stats['lookups'] += 1
+            found = [(self.events[key][0], key[0], self.events[key][1]) for key in self.by_email.get(email, ())]
+        return sorted(item for item in found if start <= item[0] < end)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            return {**self.stats, 'events': len(self.events), 'emails': len(self.by_email),
+                    'age_s': {cal: round(now - built[0], 1) for cal, built in self.built.items()}}
+
+@st.cache_resource
+def get_participant_index():
+    return ParticipantIndex()
+
+def get_participant_index_settings():
+    cfg = dict(st.secrets.get("participant_index", {}))
+    return {
+        'horizon_days': int(cfg.get("horizon_days", 365)),
+        'ttl': float(cfg.get("ttl", 300)),
+    }
+
+def refresh_participant_index(df_users, days_ahead):
+    """
+    Przebudowuje indeks dla kalendarzy, których wpis jest starszy niż ttl, nie sięga
+    `days_ahead` dni albo powstał na innej wersji bazy. Kalendarze czytane równolegle.
+    """
+    settings = get_participant_index_settings()
+    index = get_participant_index()
     tz = ZoneInfo("Europe/Warsaw")
+    fingerprint = users_fingerprint(df_users)
+
+    today = datetime.datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    horizon = (today + datetime.timedelta(days=max(days_ahead, settings['horizon_days']))).date()
+    time_max = datetime.datetime.combine(horizon, datetime.time(23, 59, 59), tzinfo=tz)
+
+    stale = [cal for cal in dict.fromkeys(LOCATIONS.values())
+             if not index.is_fresh(cal, fingerprint, horizon, settings['ttl'])]
+    started_at = time.time()
+    futures = {cal: submit_task(list_all_events, today.isoformat(), time_max.isoformat(), calendar_id=cal)
+               for cal in stale}
+
+    for calendar_id, events_future in futures.items():
+        table = build_event_table(events_future.result(), df_users)
+        mask = ((table['hour'] >= 0) & (table['shift_start'] < 0) & (table['title'] != '')
+                & (table['emails'].str.len() > 0)).to_numpy()
+        entries = {
+            (calendar_id, event_id): (start, title, emails)
+            for event_id, start, title, emails in zip(
+                table['id'][mask], table['start'][mask], table['title'][mask], table['emails'][mask])
+        }
+        index.rebuild(calendar_id, entries, fingerprint, horizon, started_at)
+
+# --- LOKALNA KOPIA KALENDARZA (SQLITE) ---
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    calendar_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    date TEXT,
+    hour INTEGER NOT NULL,
+    start TEXT,
+    title TEXT NOT NULL,
+    body TEXT NOT NULL,
+    resolved_with TEXT,
+    PRIMARY KEY (calendar_id, event_id)
+);
+CREATE INDEX IF NOT EXISTS events_by_slot ON events (calendar_id, date, hour);
+CREATE TABLE IF NOT EXISTS event_participants (
+    calendar_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    PRIMARY KEY (calendar_id, event_id, position)
+);
+CREATE INDEX IF NOT EXISTS participants_by_email ON event_participants (email);
+CREATE TABLE IF NOT EXISTS sync_state (
+    calendar_id TEXT PRIMARY KEY,
+    cursor TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    range_min TEXT NOT NULL,
+    range_max TEXT NOT NULL
+);
+"""
+
+def get_store_settings():
+    cfg = dict(st.secrets.get("store", {}))
+    return {
+        'path': str(cfg.get("path", "")),
+        'sync_interval': float(cfg.get("sync_interval", 15)),
+        'days_back': int(cfg.get("days_back", 30)),
+        'days_ahead': int(cfg.get("days_ahead", 365)),
+    }
 
-    now = datetime.datetime.now(tz)
-    start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
+class CalendarStore:
+    """
+    Wydarzenia z Kalendarza zapisane w SQLite: tabela events z indeksem (kalendarz, data,
+    godzina), event_participants z indeksem po emailu i kursor synchronizacji per kalendarz.
+    Plik przetrwa restart, więc po wdrożeniu wystarczy dociągnąć zmiany (updatedMin).
+    """
 
-    end_date = start_date + datetime.timedelta(days=days_ahead)
-    end_date = end_date.replace(hour=23, minute=59, second=59)
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(STORE_SCHEMA)
+
+    def sync_state(self, calendar_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT cursor, synced_at, range_min, range_max FROM sync_state WHERE calendar_id = ?", (calendar_id,)
+            ).fetchone()
+        return dict(zip(('cursor', 'synced_at', 'range_min', 'range_max'), row)) if row else None
+
+    def save_events(self, calendar_id, events, deleted_ids=(), replace=False, state=None):
+        """Zapisuje wydarzenia (upsert), usuwa odwołane; replace=True czyści najpierw cały kalendarz."""
+        rows = []
+        for event in events:
+            start = event.get('start', {})
+            start_dt = None
+            if start.get('dateTime'):
+                try:
+                    start_dt = datetime.datetime.fromisoformat(start['dateTime']).astimezone(ZoneInfo("Europe/Warsaw"))
+                except ValueError:
+                    start_dt = None
+            day = start_dt.date().isoformat() if start_dt else start.get('date')
+            rows.append((calendar_id, event['id'], day, start_dt.hour if start_dt else -1,
+                         start_dt.isoformat() if start_dt else None, event.get('summary', ''), json.dumps(event)))
+        ids = [(calendar_id, event_id) for event_id in deleted_ids] + [(calendar_id, r[1]) for r in rows]
+
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM events WHERE calendar_id = ?", (calendar_id,))
+                self.conn.execute("DELETE FROM event_participants WHERE calendar_id = ?", (calendar_id,))
+            else:
+                self.conn.executemany("DELETE FROM events WHERE calendar_id = ? AND event_id = ?", ids)
+                self.conn.executemany("DELETE FROM event_participants WHERE calendar_id = ? AND event_id = ?", ids)
+            self.conn.executemany(
+                "INSERT INTO events (calendar_id, event_id, date, hour, start, title, body) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            if state is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (calendar_id, cursor, synced_at, range_min, range_max) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (calendar_id, state['cursor'], state['synced_at'], state['range_min'], state['range_max'])
+                )
 
-    events_result = service.events().list(
-        calendarId=CALENDAR_ID, 
-        timeMin=start_date.isoformat(), 
-        timeMax=end_date.isoformat(),
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
+    def ensure_participants(self, calendar_id, df_users):
+        """Rozpoznaje uczestników wydarzeń zapisanych bez nich albo na innej wersji bazy ACL."""
+        fingerprint = users_fingerprint(df_users)
+        with self.lock:
+            pending = self.conn.execute(
+                "SELECT body FROM events WHERE calendar_id = ? AND hour >= 0 "
+                "AND (resolved_with IS NULL OR resolved_with != ?)", (calendar_id, fingerprint)
+            ).fetchall()
+        if not pending:
+            return
+
+        table = build_event_table([json.loads(body) for (body,) in pending], df_users)
+        table = table[table['shift_start'] < 0]
+        exploded = table[['id', 'emails']].explode('emails').dropna()
+        positions = exploded.groupby(level=0).cumcount()
+        rows = [(calendar_id, event_id, int(pos), email)
+                for event_id, pos, email in zip(exploded['id'], positions, exploded['emails'])]
+        ids = [(calendar_id, json.loads(body)['id']) for (body,) in pending]
+
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM event_participants WHERE calendar_id = ? AND event_id = ?", ids)
+            self.conn.executemany(
+                "INSERT INTO event_participants (calendar_id, event_id, position, email) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.executemany(
+                "UPDATE events SET resolved_with = ? WHERE calendar_id = ? AND event_id = ?",
+                [(fingerprint, cal, event_id) for cal, event_id in ids]
+            )
+
+    def day_events(self, calendar_id, day):
+        """Wydarzenia dnia w kolejności startu (całodniowe najpierw), jak orderBy=startTime."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT body FROM events WHERE calendar_id = ? AND date = ? ORDER BY start IS NOT NULL, start",
+                (calendar_id, day.isoformat())
+            ).fetchall()
+        return [json.loads(body) for (body,) in rows]
+
+    def upcoming_for_email(self, email, first_day, last_day, calendar_ids):
+        """Lista (start, kalendarz, tytuł) dyżurów osoby w zakresie dat, po indeksie emaili."""
+        marks = ",".join("?" * len(calendar_ids))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT e.start, e.calendar_id, e.title FROM event_participants p "
+                "JOIN events e ON e.calendar_id = p.calendar_id AND e.event_id = p.event_id "
+                f"WHERE p.email = ? AND e.date BETWEEN ? AND ? AND e.calendar_id IN ({marks}) "
+                "ORDER BY e.start",
+                (email, first_day.isoformat(), last_day.isoformat(), *calendar_ids)
+            ).fetchall()
+        return [(datetime.datetime.fromisoformat(start), cal, title) for start, cal, title in rows]
+
+    def day_emails(self, calendar_id, day, exclude_hour=None):
+        """Emaile osób zapisanych danego dnia (poza godziną exclude_hour)."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT p.email FROM events e "
+                "JOIN event_participants p ON p.calendar_id = e.calendar_id AND p.event_id = e.event_id "
+                "WHERE e.calendar_id = ? AND e.date = ? AND e.hour >= 0 AND e.hour != ?",
+                (calendar_id, day.isoformat(), -1 if exclude_hour is None else exclude_hour)
+            ).fetchall()
+        return [email for (email,) in rows]
+
+    def snapshot(self):
+        with self.lock:
+            events = self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            participants = self.conn.execute("SELECT COUNT(*) FROM event_participants").fetchone()[0]
+            states = self.conn.execute("SELECT calendar_id, cursor, synced_at FROM sync_state").fetchall()
+        now = time.time()
+        return {'path': self.path, 'events': events, 'participants': participants,
+                'sync': {cal: {'cursor': cursor, 'age_s': round(now - synced_at, 1)} for cal, cursor, synced_at in states}}
+
+@st.cache_resource
+def get_calendar_store():
+    """Lokalna kopia kalendarza albo None, gdy [store] path nie jest ustawione."""
+    path = get_store_settings()['path']
+    return CalendarStore(path) if path else None
+
+def sync_calendar_store(calendar_id, until=None):
+    """
+    Dociąga zmiany z Kalendarza do lokalnej kopii: pierwszy raz (albo gdy zapytanie
+    wychodzi poza zapisany zakres) cały zakres, potem tylko zmienione od kursora
+    (updatedMin + showDeleted). Nie częściej niż co [store] sync_interval sekund.
+    """
+    store = get_calendar_store()
+    settings = get_store_settings()
+    tz = ZoneInfo("Europe/Warsaw")
+    today = datetime.datetime.now(tz).date()
+    until = until or today
+    state = store.sync_state(calendar_id)
 
-    events = events_result.get('items', [])
-    my_events = []
-    
-    df_users = get_users_db()
+    full = state is None or state['range_max'] < until.isoformat()
+    if not full and time.time() - state['synced_at'] < settings['sync_interval']:
+        return
 
-    for event in events:
-        title = event.get('summary', '')
-        if not title: continue
-        
-        found_emails, _ = get_participants_from_title(title, df_users)
+    # Margines na rozjazd zegarów - zmiany z ostatniej minuty przyjdą ponownie (upsert)
+    cursor = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)).isoformat()
+    if full:
+        range_min = (today - datetime.timedelta(days=settings['days_back'])).isoformat()
+        range_max = max(until, today + datetime.timedelta(days=settings['days_ahead'])).isoformat()
+    else:
+        range_min, range_max = state['range_min'], state['range_max']
+    time_min = datetime.datetime.combine(datetime.date.fromisoformat(range_min), datetime.time(0, 0), tzinfo=tz).isoformat()
+    time_max = datetime.datetime.combine(datetime.date.fromisoformat(range_max), datetime.time(23, 59, 59), tzinfo=tz).isoformat()
+    new_state = {'cursor': cursor, 'synced_at': time.time(), 'range_min': range_min, 'range_max': range_max}
+
+    if not full:
+        try:
+            changed = list_all_events(time_min, time_max, calendar_id=calendar_id,
+                                      updatedMin=state['cursor'], showDeleted=True)
+        except Exception as e:
+            # 410 Gone: kursor za stary - trzeba pobrać wszystko od nowa
+            if getattr(getattr(e, 'resp', None), 'status', None) != 410:
+                raise
+            full = True
+        else:
+            store.save_events(calendar_id, [ev for ev in changed if ev.get('status') != 'cancelled'],
+                              deleted_ids=[ev['id'] for ev in changed if ev.get('status') == 'cancelled'],
+                              state=new_state)
+            return
+
+    store.save_events(calendar_id, list_all_events(time_min, time_max, calendar_id=calendar_id),
+                      replace=True, state=new_state)
+
+def sync_store_or_stale(calendar_id, until=None):
+    """Synchronizuje kopię; gdy Google nie odpowiada, a kopia istnieje, zwraca True (dane mogą być nieaktualne)."""
+    try:
+        sync_calendar_store(calendar_id, until)
+        return False
+    except Exception as e:
+        if get_calendar_store().sync_state(calendar_id) is None:
+            if isinstance(e, ServiceUnavailableError):
+                raise
+            raise ServiceUnavailableError("calendar", get_circuit_breaker("calendar").retry_after()) from e
+        print(f"Serwuję lokalną kopię kalendarza {calendar_id}: {e}")
+        return True
+
+def event_day(event):
+    """Dzień (czas warszawski) początku wydarzenia - także całodniowego; None, gdy brak daty."""
+    start = event.get('start', {})
+    try:
+        if start.get('dateTime'):
+            return datetime.datetime.fromisoformat(start['dateTime']).astimezone(ZoneInfo("Europe/Warsaw")).date()
+        if start.get('date'):
+            return datetime.date.fromisoformat(start['date'])
+    except ValueError:
+        pass
+    return None
+
+def record_event_write(calendar_id, event):
+    """
+    Po własnym zapisie: aktualizuje indeks uczestników i lokalną kopię bez odczytu
+    z Google, a rozgrzany grafik tego dnia wyrzuca (następny odczyt będzie świeży).
+    """
+    get_participant_index().upsert(calendar_id, event)
+    day = event_day(event)
+    if day is not None:
+        get_schedule_cache().discard((calendar_id, day.isoformat()))
+        publish_invalidation("day", calendar_id, day, event=event)
+    store = get_calendar_store()
+    if store is not None and store.sync_state(calendar_id) is not None:
+        store.save_events(calendar_id, [event])
+
+def record_event_delete(calendar_id, event):
+    get_participant_index().remove(calendar_id, event['id'])
+    day = event_day(event)
+    if day is not None:
+        get_schedule_cache().discard((calendar_id, day.isoformat()))
+        publish_invalidation("day", calendar_id, day, deleted_id=event['id'])
+    store = get_calendar_store()
+    if store is not None and store.sync_state(calendar_id) is not None:
+        store.save_events(calendar_id, [], deleted_ids=[event['id']])
+
+def get_user_upcoming_events(days_ahead=30, df_users=None):
+    """
+    Dyżury zalogowanej osoby od dzisiaj na `days_ahead` dni ze wszystkich lokalizacji.
+    Czyta z lokalnej kopii (SQLite), jeśli jest włączona, a w przeciwnym razie
+    z indeksu uczestników (przebudowywanego tylko, gdy jest nieświeży).
+    """
+    my_email = st.session_state['user_email'].strip().lower()
+    tz = ZoneInfo("Europe/Warsaw")
+
+    start_date = datetime.datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    end_date = start_date + datetime.timedelta(days=days_ahead + 1)
+    location_names = {cal: name for name, cal in reversed(list(LOCATIONS.items()))}
+    calendar_ids = list(location_names)
+
+    store = get_calendar_store()
+    if store is not None:
+        last_day = (end_date - datetime.timedelta(days=1)).date()
+        futures = [submit_task(sync_store_or_stale, cal, last_day) for cal in calendar_ids]
+        if df_users is None:
+            df_users = get_users_db()
+        for future in futures:
+            future.result()
+        for cal in calendar_ids:
+            store.ensure_participants(cal, df_users)
+        found = store.upcoming_for_email(my_email, start_date.date(), last_day, calendar_ids)
+    else:
+        if df_users is None:
+            df_users = get_users_db()
+        refresh_participant_index(df_users, days_ahead)
+        found = get_participant_index().lookup(my_email, start_date, end_date)
+
+    my_events = []
+    for dt_obj, calendar_id, title in found:
+        row = {
+            "Data": dt_obj.strftime("%d-%m-%Y"),
+            "Godzina": f"{dt_obj.hour}:00 - {dt_obj.hour + 1}:00",
+        }
+        if len(LOCATIONS) > 1:
+            row["Lokalizacja"] = location_names.get(calendar_id, calendar_id)
+        row["Szczegóły (Kto)"] = title
+        my_events.append(row)
 
-        if my_email in found_emails:
-            start_str = event['start'].get('dateTime')
-            if not start_str: continue 
-            
-            dt_obj = datetime.datetime.fromisoformat(start_str).astimezone(tz)
-            date_str = dt_obj.strftime("%d-%m-%Y") 
-            time_str = f"{dt_obj.hour}:00 - {dt_obj.hour + 1}:00"
-
-            my_events.append({
-                "Data": date_str,
-                "Godzina": time_str,
-                "Szczegóły (Kto)": title
-            })
-            
     return pd.DataFrame(my_events)
 
-def load_users():
-    df = get_users_db()
+# --- REJESTR UŻYTKOWNIKÓW (WSPÓLNY DLA PROCESU) ---
+
+# Jak ttl read_users_sheet - rejestr nie jest starszy niż arkusz, który odczytałaby sesja
+USER_REGISTRY_TTL = USERS_SHEET_TTL
+
+class UserRecord:
+    """Jeden głosiciel. __slots__ i internowane napisy: rekordy są współdzielone przez wszystkie sesje."""
+
+    __slots__ = ('email', 'key', 'first_name', 'last_name', 'full_name', 'role', 'gender', 'favorites')
+
+    def __init__(self, email, first_name, last_name, role, gender, favorites):
+        self.email = sys.intern(email)
+        self.key = sys.intern(email.strip().lower())
+        self.first_name = sys.intern(first_name)
+        self.last_name = sys.intern(last_name)
+        self.full_name = sys.intern(f"{first_name} {last_name}")
+        self.role = sys.intern(role)
+        self.gender = sys.intern(gender)
+        self.favorites = tuple(sys.intern(e.strip().lower()) for e in favorites.split(',') if '@' in e)
+
+    def as_row(self):
+        """Słownik w układzie wiersza arkusza - dla book_event/book_recurring (drugi głosiciel)."""
+        return {'Email': self.email, 'Imię': self.first_name, 'Nazwisko': self.last_name,
+                'Rola': self.role, 'Płeć': self.gender}
+
+class UserRegistry:
+    """
+    Niezmienny rejestr bazy ACL: rekordy w kolejności arkusza i słowniki email / "Imię Nazwisko" -> rekord.
+    `frame` to wspólna ramka dla funkcji kalendarza - tylko do odczytu; zmiany robimy na kopii (with_favorites).
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        # Baza ze snapshotu: tylko do wyświetlania, bez zapisów całej ramki
+        self.from_snapshot = bool(frame.attrs.get('from_snapshot', False))
+        self.records = tuple(
+            UserRecord(str(email), first, last, str(role), str(gender), str(fav))
+            for email, first, last, role, gender, fav in zip(
+                frame['Email'], frame['Imię'], frame['Nazwisko'], frame['Rola'], frame['Płeć'], frame['Ulubione']
+            )
+        )
+        self.by_email = {}
+        self.by_full_name = {}
+        for record in self.records:
+            # Jak wcześniejsze maski + iloc[0]: przy duplikatach wygrywa pierwszy wiersz
+            self.by_email.setdefault(record.key, record)
+            self.by_full_name.setdefault(record.full_name, record)
+        self.full_names = tuple(record.full_name for record in self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, email):
+        return self.by_email.get(str(email).strip().lower()) if email else None
+
+    def with_favorites(self, email, favorites):
+        """Kopia ramki do zapisu w arkuszu z nową listą ulubionych jednej osoby."""
+        frame = self.frame.copy()
+        frame.loc[frame['Email'].astype(str).str.strip().str.lower() == str(email).strip().lower(), 'Ulubione'] = ",".join(favorites)
+        return frame
+
+class UserRegistryCache:
+    """Jeden rejestr na proces, wydawany sesjom przez referencję; przebudowa po ttl lub invalidate()."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.registry = None
+        self.built_at = 0.0
+        self.last_read = None
+        self.lock = threading.Lock()
+        self.stats = {'builds': 0, 'reuses': 0}
+
+    def get(self, build, touch=True):
+        """touch=False: odczyt zadania w tle - nie liczy się jako użycie przez sesję."""
+        with self.lock:
+            if touch:
+                self.last_read = time.monotonic()
+            if self.registry is not None and time.monotonic() - self.built_at < self.ttl:
+                self.stats['reuses'] += 1
+                return self.registry
+
+        frame = build()
+        registry = UserRegistry(frame)
+        if frame.empty or registry.from_snapshot:
+            # Błąd odczytu arkusza albo snapshot - nie zapamiętujemy; prawdziwą bazę
+            # wstawi odświeżenie w tle (refresh_users_cache) albo następny rerun
+            return registry
+        with self.lock:
+            self.registry = registry
+            self.built_at = time.monotonic()
+            self.stats['builds'] += 1
+        return registry
+
+    def invalidate(self):
+        with self.lock:
+            self.registry = None
+
+    def idle_for(self):
+        """Sekundy od ostatniego odczytu rejestru przez sesję (inf, gdy jeszcze żadnego nie było)."""
+        with self.lock:
+            return float('inf') if self.last_read is None else time.monotonic() - self.last_read
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'users': len(self.registry) if self.registry is not None else 0}
+
+@st.cache_resource
+def get_user_registry_cache():
+    return UserRegistryCache(USER_REGISTRY_TTL)
+
+def build_users_frame():
+    df = get_users_db(allow_snapshot=True)
     if df.empty:
         return df
 
+    from_snapshot = df.attrs.get('from_snapshot', False)
     df = df.dropna(subset=['Imię', 'Nazwisko'])
     df['Imię'] = df['Imię'].astype(str)
     df['Nazwisko'] = df['Nazwisko'].astype(str)
+    df.attrs['from_snapshot'] = from_snapshot
     return df
 
+def load_users():
+    """Wspólny rejestr użytkowników (UserRegistry) zamiast osobnej kopii DataFrame w każdej sesji."""
+    return get_user_registry_cache().get(build_users_frame)
+
 
 def send_notification_email(to_email, subject, body):
     """Wysyła e-mail HTML używając SMTP Gmaila."""
+    import smtplib
+    from email.message import EmailMessage
+
     try:
         sender = st.secrets["email"]["sender_address"]
         password = st.secrets["email"]["app_password"]
@@ -674,114 +2414,1017 @@ def send_notification_email(to_email, subject, body):
         print(f"Błąd wysyłania e-maila: {e}")
         return False
 
+NEW_USER_DEFAULTS = {'Rola': 'reader', 'Typ': 'user', 'Imię': '', 'Nazwisko': '', 'Płeć': 'M', 'Ulubione': ''}
+
+def list_calendar_acl_emails(calendar_id=None):
+    """Emaile użytkowników z uprawnień kalendarza - wszystkie strony ACL (nextPageToken)."""
+    service = get_calendar_service()
+    emails = set()
+    page_token = None
+    while True:
+        result = execute_api(service.acl().list(calendarId=calendar_id or CALENDAR_ID, pageToken=page_token))
+        for item in result.get('items', []):
+            if item.get('scope', {}).get('type') == 'user':
+                emails.add(item.get('scope', {}).get('value', '').lower().strip())
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return emails
+
+@st.cache_resource
+def get_gspread_client():
+    """Klient gspread z tych samych credentials co połączenie z Arkuszem (publiczne API, bez prywatnych metod st-gsheets)."""
+    import gspread
+    return gspread.service_account_from_dict(dict(st.secrets["connections"]["gsheets"]))
+
+def open_acl_worksheet():
+    """Arkusz ACL otwarty po kluczu (albo adresie) z secrets.sheet_id."""
+    client = get_gspread_client()
+    spreadsheet = client.open_by_url(SHEET_ID) if SHEET_ID.startswith("http") else client.open_by_key(SHEET_ID)
+    return spreadsheet.worksheet("ACL")
+
+def read_acl_emails(worksheet):
+    """
+    Nagłówek i kolumna Email prosto z arkusza ACL - bez cache'u i snapshotu.
+    Rzuca ValueError, gdy arkusz nie ma kolumny Email albo żadnej osoby: takiej
+    bazy nie wolno porównywać z ACL (wszyscy zostaliby dopisani drugi raz).
+    """
+    header = call_api("sheets", worksheet.row_values, 1)
+    if 'Email' not in header:
+        raise ValueError("arkusz ACL nie ma kolumny Email")
+    emails = call_api("sheets", worksheet.col_values, header.index('Email') + 1)
+    if not any(str(e).strip() for e in emails[1:]):
+        raise ValueError("arkusz ACL jest pusty")
+    return header, emails
+
+def apply_acl_diff(worksheet, header, emails, to_add, to_remove):
+    """
+    Zapisuje w arkuszu ACL tylko różnicę: usunięte osoby znikają jednym batch_update
+    (zakresy wierszy od końca, żeby numery się nie przesuwały), nowe dochodzą jednym
+    append_rows. Numery wierszy bierzemy z kolumny Email (read_acl_emails), nie z ramki
+    get_users_db (ta jest przefiltrowana i posortowana).
+    """
+    if to_remove:
+        rows = [i for i, e in enumerate(emails) if i > 0 and str(e).strip().lower() in to_remove]
+
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][1] == row:
+                ranges[-1][1] = row + 1
+            else:
+                ranges.append([row, row + 1])
+        requests = [
+            {'deleteDimension': {'range': {'sheetId': worksheet.id, 'dimension': 'ROWS',
+                                           'startIndex': start, 'endIndex': end}}}
+            for start, end in reversed(ranges)
+        ]
+        if requests:
+            call_api("sheets", worksheet.spreadsheet.batch_update, {'requests': requests})
+
+    if to_add:
+        new_rows = [[email if col == 'Email' else NEW_USER_DEFAULTS.get(col, '') for col in header] for email in to_add]
+        call_api("sheets", worksheet.append_rows, new_rows, value_input_option='RAW')
+
 def sync_users_with_calendar():
     """
     Synchronizuje Arkusz (ACL) z uprawnieniami Kalendarza Google.
+    Zapisuje tylko różnicę (dopisane/usunięte wiersze); gdy bazy są zgodne - żadnego zapisu.
     Zwraca (bool, message).
     """
-    service = get_calendar_service()
-    
     try:
         # 1. POBIERZ Z KALENDARZA
-        acl_result = service.acl().list(calendarId=CALENDAR_ID).execute()
-        calendar_emails = set()
-        
-        for item in acl_result.get('items', []):
-            if item.get('scope', {}).get('type') == 'user':
-                email = item.get('scope', {}).get('value', '').lower().strip()
-                calendar_emails.add(email)
+        calendar_emails = list_calendar_acl_emails()
 
-        # 2. POBIERZ Z ARKUSZA
-        df_sheet = get_users_db()
-        df_sheet['Email_Norm'] = df_sheet['Email'].astype(str).str.lower().str.strip()
-        sheet_emails = set(df_sheet['Email_Norm'].unique())
+        # 2. POBIERZ Z ARKUSZA - bezpośrednio; nieudany lub pusty odczyt przerywa synchronizację
+        worksheet = call_api("sheets", open_acl_worksheet)
+        header, emails = read_acl_emails(worksheet)
+        sheet_emails = {str(e).strip().lower() for e in emails[1:] if str(e).strip()}
         
         my_bot_email = dict(st.secrets["connections"]["gsheets"])["client_email"].lower()
+        ignored = {e.lower() for e in IGNORED_EMAILS} | {my_bot_email}
         
-        to_add = calendar_emails - sheet_emails
-        to_remove = {e for e in (sheet_emails - calendar_emails) if e != my_bot_email}
+        to_add = sorted(calendar_emails - sheet_emails - ignored)
+        to_remove = {e for e in (sheet_emails - calendar_emails) if e not in ignored}
         
         if not to_add and not to_remove:
             return True, "Bazy są zgodne."
 
-        if to_remove:
-            df_sheet = df_sheet[~df_sheet['Email_Norm'].isin(to_remove)]
-        
-        new_rows = []
-        for email in to_add:
-            new_rows.append({
-                'Email': email,
-                'Rola': 'reader',
-                'Typ': 'user',
-                'Imię': '',
-                'Nazwisko': '',
-                'Płeć': 'M',
-                'Ulubione': ''
-            })
-            
-        if new_rows:
-            df_new = pd.DataFrame(new_rows)
-            if df_sheet.empty:
-                df_sheet = df_new
-            else:
-                df_sheet = pd.concat([df_sheet, df_new], ignore_index=True)
-        
-        if 'Email_Norm' in df_sheet.columns:
-            del df_sheet['Email_Norm']
-            
-        update_user_db(df_sheet)
+        apply_acl_diff(worksheet, header, emails, to_add, to_remove)
+        st.cache_data.clear()
+        get_user_registry_cache().invalidate()
+        publish_invalidation("users")
+        get_participant_index().invalidate()
         return True, f"Zaktualizowano! Dodano: {len(to_add)}, Usunięto: {len(to_remove)}"
 
     except Exception as e:
         return False, f"Błąd synchronizacji: {e}"
 
-def get_emails_for_day(date_obj, exclude_hour=None, exclude_emails=None):
+def get_emails_for_day(date_obj, exclude_hour=None, exclude_emails=None, df_users=None, calendar_id=None):
     """Pobiera emaile innych osób dyżurujących tego dnia (identyfikacja po Tytule)."""
-    service = get_calendar_service()
-    tz = ZoneInfo("Europe/Warsaw")
-    
     if isinstance(date_obj, datetime.datetime):
         d = date_obj.date()
     else:
         d = date_obj
         
-    start_of_day = datetime.datetime.combine(d, datetime.time(0, 0), tzinfo=tz)
-    end_of_day = datetime.datetime.combine(d, datetime.time(23, 59, 59), tzinfo=tz)
-
-    events = service.events().list(
-        calendarId=CALENDAR_ID, 
-        timeMin=start_of_day.isoformat(), 
-        timeMax=end_of_day.isoformat(),
-        singleEvents=True
-    ).execute().get('items', [])
-    
-    unique_emails = set()
     if exclude_emails is None: exclude_emails = []
+
+    store = get_calendar_store()
+    if store is not None:
+        calendar_id = calendar_id or CALENDAR_ID
+        sync_future = submit_task(sync_store_or_stale, calendar_id, d)
+        if df_users is None:
+            df_users = get_users_db()
+        sync_future.result()
+        store.ensure_participants(calendar_id, df_users)
+        return [e for e in store.day_emails(calendar_id, d, exclude_hour) if e not in exclude_emails]
+
+    events_future = submit_task(fetch_day_events, d, calendar_id)
     
-    df_users = get_users_db()
-    
-    for event in events:
-        start_str = event['start'].get('dateTime')
-        if not start_str: continue
-        
-        dt_obj = datetime.datetime.fromisoformat(start_str).astimezone(tz)
-        if exclude_hour is not None and dt_obj.hour == exclude_hour:
+    if df_users is None:
+        df_users = get_users_db()
+    table = build_event_table(events_future.result(), df_users)
+
+    timed = table[(table['hour'] >= 0) & (table['hour'] != (-1 if exclude_hour is None else exclude_hour))]
+    emails = timed['emails'].explode().dropna()
+    return list(set(emails[~emails.isin(exclude_emails)]))
+
+# --- WSPÓLNY CACHE MIĘDZY REPLIKAMI ---
+
+def get_shared_cache_settings():
+    cfg = dict(st.secrets.get("shared_cache", {}))
+    return {
+        'backend': str(cfg.get("backend", "")),  # "" (wyłączony), "memory", "sqlite"
+        'path': str(cfg.get("path", "wozki_cache.sqlite3")),
+        'ttl': float(cfg.get("ttl", 60)),
+    }
+
+class CacheBackend(ABC):
+    """
+    Wspólny cache replik: wartości JSON z ttl oraz komunikaty unieważnień.
+    poll() zwraca komunikaty opublikowane od poprzedniego wywołania (także własne).
+    replica_id żyje razem z obiektem (cache_resource), a nie z przebiegiem skryptu -
+    po nim apply_invalidations pomija własne komunikaty.
+    """
+
+    def __init__(self):
+        self.replica_id = uuid.uuid4().hex
+
+    @abstractmethod
+    def get(self, key):
+        """Wartość spod klucza albo None (brak lub po ttl)."""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Zapisuje wartość JSON na `ttl` sekund."""
+
+    @abstractmethod
+    def delete(self, key):
+        """Usuwa klucz (brak klucza to nie błąd)."""
+
+    @abstractmethod
+    def publish(self, message):
+        """Rozsyła komunikat unieważnienia do wszystkich replik."""
+
+    @abstractmethod
+    def poll(self):
+        """Komunikaty opublikowane od poprzedniego wywołania."""
+
+    def snapshot(self):
+        return {'backend': type(self).__name__}
+
+class MemoryCacheBackend(CacheBackend):
+    """W pamięci procesu - jedna replika albo testy."""
+
+    def __init__(self):
+        super().__init__()
+        self.entries = {}
+        self.messages = deque()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.entries.pop(key, None)
+                return None
+            return json.loads(entry[1])
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, json.dumps(value))
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def publish(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+    def poll(self):
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+        return messages
+
+    def snapshot(self):
+        with self.lock:
+            return {'backend': 'memory', 'entries': len(self.entries)}
+
+SHARED_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# Komunikaty starsze niż godzina nie są już potrzebne żadnej replice
+INVALIDATION_RETENTION = 3600
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Plik SQLite na wspólnym wolumenie (repliki na jednym hoście). Unieważnienia to wiersze
+    tabeli invalidations - każda replika czyta te o id większym niż ostatnio widziane.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SHARED_CACHE_SCHEMA)
+            # Historia sprzed startu repliki jej nie dotyczy - jej cache jest pusty
+            self.cursor = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl)
+            )
+
+    def delete(self, key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def publish(self, message):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO invalidations (message, created_at) VALUES (?, ?)", (json.dumps(message), now))
+            self.conn.execute("DELETE FROM invalidations WHERE created_at < ?", (now - INVALIDATION_RETENTION,))
+            self.conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+
+    def poll(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, message FROM invalidations WHERE id > ? ORDER BY id", (self.cursor,)
+            ).fetchall()
+            if rows:
+                self.cursor = rows[-1][0]
+        return [json.loads(message) for _, message in rows]
+
+    def snapshot(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {'backend': 'sqlite', 'path': self.path, 'entries': entries, 'cursor': self.cursor}
+
+@st.cache_resource
+def get_shared_cache():
+    """Wspólny cache replik albo None, gdy [shared_cache] backend nie jest ustawiony."""
+    settings = get_shared_cache_settings()
+    backend = settings['backend']
+    if backend == "memory":
+        return MemoryCacheBackend()
+    if backend == "sqlite":
+        return SQLiteCacheBackend(settings['path'])
+    if backend:
+        print(f"Nieznany backend wspólnego cache'u: {backend!r} (dostępne: memory, sqlite)")
+    return None
+
+def shared_day_key(calendar_id, day):
+    return f"day:{calendar_id}:{day.isoformat()}"
+
+def shared_cache_call(method, *args):
+    """Wywołanie wspólnego cache'u; awaria backendu nie blokuje aplikacji (działa jak chybienie)."""
+    shared = get_shared_cache()
+    if shared is None:
+        return None
+    try:
+        return getattr(shared, method)(*args)
+    except Exception as e:
+        print(f"Wspólny cache ({method}) niedostępny: {e}")
+        return None
+
+def publish_invalidation(kind, calendar_id=None, day=None, event=None, deleted_id=None):
+    """
+    Usuwa wspólny wpis dnia i powiadamia pozostałe repliki (kind: "day" albo "users").
+    Komunikat "day" niesie zapisane wydarzenie (albo id usuniętego), żeby inne repliki
+    poprawiły indeks uczestników tylko o to jedno wydarzenie.
+    """
+    shared = get_shared_cache()
+    if shared is None:
+        return
+    if kind == "day" and day is not None:
+        shared_cache_call("delete", shared_day_key(calendar_id, day))
+    shared_cache_call("publish", {
+        'origin': shared.replica_id, 'kind': kind, 'calendar_id': calendar_id,
+        'day': day.isoformat() if day is not None else None,
+        'event': event, 'deleted_id': deleted_id,
+    })
+
+def apply_invalidations():
+    """Stosuje unieważnienia z innych replik do lokalnych cache'y; zwraca liczbę zastosowanych."""
+    shared = get_shared_cache()
+    if shared is None:
+        return 0
+    applied = 0
+    for message in shared_cache_call("poll") or []:
+        if message.get('origin') == shared.replica_id:
             continue
+        if message.get('kind') == "day" and message.get('day'):
+            calendar_id = message['calendar_id']
+            get_schedule_cache().discard((calendar_id, message['day']))
+            # Tylko to jedno wydarzenie - bez przebudowy indeksu z całego horyzontu
+            if message.get('event'):
+                get_participant_index().upsert(calendar_id, message['event'])
+            elif message.get('deleted_id'):
+                get_participant_index().remove(calendar_id, message['deleted_id'])
+        elif message.get('kind') == "users":
+            read_users_sheet.clear()
+            get_user_registry_cache().invalidate()
+        applied += 1
+    return applied
+
+# --- STATYSTYKI SŁUŻBY ---
+
+WEEKDAY_FULL_NAMES = ['Poniedziałek', 'Wtorek', 'Środa', 'Czwartek', 'Piątek', 'Sobota', 'Niedziela']
+
+class MonthlyStatsCache:
+    """Agregaty zakończonych miesięcy (klucz: kalendarz, zakres, odcisk bazy) - raport liczy tylko brakujące."""
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            self.stats['hits' if value is not None else 'misses'] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'months': len(self.entries)}
+
+@st.cache_resource
+def get_stats_cache():
+    return MonthlyStatsCache()
+
+def month_ranges(start_date, end_date):
+    """Dzieli [start_date, end_date] na kawałki w granicach miesięcy kalendarzowych."""
+    ranges = []
+    first = start_date
+    while first <= end_date:
+        next_month = (first.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        last = min(end_date, next_month - datetime.timedelta(days=1))
+        ranges.append((first, last))
+        first = next_month
+    return ranges
+
+def compute_period_stats(events, df_users):
+    """
+    Agregaty jednego kawałka zakresu: tabela kolumnowa (uczestnicy rozpoznani hurtowo),
+    a reguły zajętości liczone raz dla całego kawałka.
+    Zwraca {'people': Series email -> godziny, 'slots': DataFrame (weekday, hour) -> liczniki}.
+    """
+    table = build_event_table(events, df_users)
+
+    bookings = table[(table['hour'] >= 0) & (table['shift_start'] < 0)]
+    people = bookings['emails'].explode().dropna().value_counts()
+
+    frame = occupancy_frame(table, '')
+    codes = frame['code'].to_numpy(dtype=int)
+    slots = pd.DataFrame({
+        'weekday': pd.to_datetime(frame['date']).dt.weekday.to_numpy() if len(frame) else np.array([], dtype=int),
+        'hour': frame['hour'].to_numpy(dtype=int),
+        'slots': 1,
+        'empty': (codes == OVERVIEW_FREE).astype(int),
+        'single': (codes == OVERVIEW_JOIN).astype(int),
+        'full': (codes == OVERVIEW_FULL).astype(int),
+    }).groupby(['weekday', 'hour']).sum()
+    return {'people': people, 'slots': slots}
+
+def build_service_report(start_date, end_date, df_users, calendar_ids=None):
+    """
+    Raport godzin służby i obsady dyżurów dla zakresu dat (wszystkie lokalizacje).
+    Zakres dzielony na miesiące: zakończone miesiące biorą agregaty z pamięci,
+    brakujące czytane naraz przez bramkę (fetch_ranges). Zwraca słownik tabel do wyświetlenia/CSV.
+    """
+    calendar_ids = calendar_ids or list(dict.fromkeys(LOCATIONS.values()))
+    fingerprint = users_fingerprint(df_users)
+    today = datetime.date.today()
+    cache = get_stats_cache()
+
+    parts, pending = [], []
+    for calendar_id in calendar_ids:
+        for first, last in month_ranges(start_date, end_date):
+            key = (calendar_id, first, last, fingerprint)
+            cached = cache.get(key) if last < today else None
+            if cached is not None:
+                parts.append(cached)
+            else:
+                pending.append(key)
+
+    ranges = [day_ranges(first, last, (last - first).days + 1, calendar_id)[0] for calendar_id, first, last, _ in pending]
+    for key, events in zip(pending, get_calendar_gateway().fetch_ranges(ranges, orderBy='startTime')):
+        result = compute_period_stats(events, df_users)
+        if key[2] < today:
+            cache.put(key, result)
+        parts.append(result)
+
+    people = pd.concat([p['people'] for p in parts]).groupby(level=0).sum() if parts else pd.Series(dtype=int)
+    slots = pd.concat([p['slots'] for p in parts]).groupby(level=[0, 1]).sum() if parts else pd.DataFrame()
+
+    names = pd.Series(
+        (df_users['Imię'].astype(str) + ' ' + df_users['Nazwisko'].astype(str)).to_numpy(),
+        index=df_users['Email'].astype(str).str.strip().str.lower()
+    )
+    names = names[~names.index.duplicated()]
+    people_df = pd.DataFrame({
+        'Imię i nazwisko': names.reindex(people.index).fillna('').to_numpy(),
+        'Email': people.index,
+        'Godziny': people.to_numpy(dtype=int),
+    }).sort_values(['Godziny', 'Imię i nazwisko'], ascending=[False, True], ignore_index=True)
+
+    if slots.empty:
+        empty_hours = pd.DataFrame(columns=['Godzina', 'Dyżurów', 'Puste', 'Jedna osoba', 'Pełne', '% pustych'])
+        return {'people': people_df, 'hours': empty_hours, 'weekdays': pd.DataFrame(), 'coverage': pd.DataFrame()}
+
+    def summarize(df):
+        return pd.DataFrame({
+            'Dyżurów': df['slots'], 'Puste': df['empty'], 'Jedna osoba': df['single'], 'Pełne': df['full'],
+            '% pustych': (100 * df['empty'] / df['slots']).round(1),
+        })
 
+    by_hour = summarize(slots.groupby(level='hour').sum())
+    by_hour.insert(0, 'Godzina', [f"{h}:00 - {h + 1}:00" for h in by_hour.index])
+    by_weekday = summarize(slots.groupby(level='weekday').sum())
+    by_weekday.insert(0, 'Dzień', [WEEKDAY_FULL_NAMES[d] for d in by_weekday.index])
+
+    coverage = (100 * slots['empty'] / slots['slots']).round(0).unstack('hour')
+    coverage.index = [WEEKDAY_NAMES[d] for d in coverage.index]
+    coverage.columns = [f"{h}:00" for h in coverage.columns]
+
+    return {
+        'people': people_df,
+        'hours': by_hour.sort_values('% pustych', ascending=False).reset_index(drop=True),
+        'weekdays': by_weekday.reset_index(drop=True),
+        'coverage': coverage,
+    }
+
+def report_to_csv(df, index=False):
+    """CSV z BOM-em, żeby Excel poprawnie pokazał polskie znaki."""
+    return df.to_csv(index=index).encode('utf-8-sig')
+
+# --- SZYBKI START (SNAPSHOT NA DYSKU) ---
+
+SNAPSHOT_MAGIC = b"WZKS"
+SNAPSHOT_VERSION = 1
+
+def get_snapshot_settings():
+    """
+    Sekcja [snapshot]. Snapshot zapisuje tylko rozgrzewanie grafiku w harmonogramie,
+    więc bez [scheduler] enabled = true ścieżka jest ignorowana - inaczej przy każdym
+    starcie wczytywalibyśmy plik, którego nic już nie odświeża.
+    """
+    cfg = dict(st.secrets.get("snapshot", {}))
+    return {
+        'path': str(cfg.get("path", "")) if get_scheduler_settings()['enabled'] else "",
+        'weeks': int(cfg.get("weeks", 2)),
+        'max_age': float(cfg.get("max_age", 6 * 3600)),  # starszy snapshot jest pomijany przy starcie
+    }
+
+def encode_snapshot(payload):
+    """Nagłówek WZKS + bajt wersji + JSON skompresowany zlib."""
+    raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + zlib.compress(raw, 6)
+
+def decode_snapshot(data):
+    header = len(SNAPSHOT_MAGIC) + 1
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("To nie jest plik snapshotu")
+    if data[len(SNAPSHOT_MAGIC)] != SNAPSHOT_VERSION:
+        raise ValueError(f"Nieobsługiwana wersja snapshotu: {data[len(SNAPSHOT_MAGIC)]}")
+    return json.loads(zlib.decompress(data[header:]).decode('utf-8'))
+
+def save_snapshot():
+    """
+    Zapisuje bazę użytkowników i rozgrzany grafik na [snapshot] weeks tygodni
+    (z lokalną kopią SQLite grafik już jest na dysku - wtedy tylko baza).
+    Zapis atomowy: plik tymczasowy + os.replace.
+    """
+    settings = get_snapshot_settings()
+    if not settings['path']:
+        return None
+
+    users = read_users_sheet()
+    today = datetime.date.today()
+    keys = [(cal, (today + datetime.timedelta(days=i)).isoformat())
+            for cal in dict.fromkeys(LOCATIONS.values()) for i in range(settings['weeks'] * 7)]
+    schedule = {}
+    if get_calendar_store() is None:
+        for (cal, day), events in get_schedule_cache().entries_for(keys).items():
+            schedule.setdefault(cal, {})[day] = events
+
+    payload = {
+        'saved_at': time.time(),
+        'users': {'columns': [str(c) for c in users.columns],
+                  'rows': users.astype(object).where(users.notna(), None).values.tolist()},
+        'schedule': schedule,
+    }
+    data = encode_snapshot(payload)
+    tmp_path = settings['path'] + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, settings['path'])
+    return len(data)
+
+class WarmStart:
+    """Zawartość snapshotu wczytana przy starcie procesu; baza użytkowników oddawana tylko raz."""
+
+    def __init__(self, payload):
+        self.lock = threading.Lock()
+        self.users = None
+        self.saved_at = None
+        if payload:
+            self.saved_at = payload.get('saved_at')
+            users = payload.get('users') or {}
+            if users.get('columns'):
+                self.users = pd.DataFrame(users.get('rows', []), columns=users['columns'])
+
+    def take_users(self):
+        with self.lock:
+            users, self.users = self.users, None
+            return users
+
+@st.cache_resource
+def get_warm_start():
+    """
+    Raz na proces: wczytuje snapshot i wypełnia nim ScheduleCache (stale-while-revalidate).
+    Snapshot starszy niż [snapshot] max_age jest pomijany - lepiej odczyt z Google niż grafik sprzed dni.
+    """
+    settings = get_snapshot_settings()
+    path = settings['path']
+    payload = None
+    if path and os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                payload = decode_snapshot(f.read())
+        except Exception as e:
+            print(f"Pomijam uszkodzony snapshot {path}: {e}")
+    if payload and time.time() - float(payload.get('saved_at') or 0) > settings['max_age']:
+        print(f"Pomijam przeterminowany snapshot {path}")
+        payload = None
+    warm = WarmStart(payload)
+    if payload and payload.get('schedule'):
+        entries = {(cal, day): events for cal, days in payload['schedule'].items() for day, events in days.items()}
+        get_schedule_cache().load_warm(entries, warm.saved_at)
+    return warm
+
+# --- ZADANIA W TLE (HARMONOGRAM) ---
+
+def get_scheduler_settings():
+    """
+    Sekcja [scheduler]: harmonogram trzeba włączyć jawnie (enabled = true), a cykliczna
+    synchronizacja ACL, która usuwa i dopisuje wiersze arkusza, to osobna zgoda (acl_sync = true).
+    """
+    cfg = dict(st.secrets.get("scheduler", {}))
+    return {
+        'enabled': bool(cfg.get("enabled", False)),
+        'acl_sync': bool(cfg.get("acl_sync", False)),
+        'acl_sync_interval': float(cfg.get("acl_sync_interval", 3600)),
+        'users_refresh_interval': float(cfg.get("users_refresh_interval", USERS_SHEET_TTL)),
+        'users_refresh_idle': float(cfg.get("users_refresh_idle", 300)),
+        'warm_interval': float(cfg.get("warm_interval", 60)),
+        'warm_days': int(cfg.get("warm_days", 14)),
+        'schedule_max_age': float(cfg.get("schedule_max_age", 90)),
+    }
+
+class BackgroundScheduler:
+    """
+    Zadania okresowe w jednym wątku demona na proces. Zadania nie rysują UI -
+    czasy, wyniki i błędy ostatnich uruchomień są w snapshot() (Diagnostyka).
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def add_job(self, name, func, interval):
+        with self.lock:
+            self.jobs[name] = {
+                'func': func, 'interval': interval, 'next_run': time.time(), 'runs': 0, 'running': False,
+                'last_run': None, 'last_duration': None, 'last_result': None, 'last_error': None,
+            }
+
+    def start(self):
+        """Uruchamia wątek, jeśli jeszcze nie działa (bezpieczne przy każdym rerunie)."""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.thread = threading.Thread(target=self._loop, name="wozki-scheduler", daemon=True)
+            self.thread.start()
+            return True
+
+    def run_now(self, name):
+        with self.lock:
+            self.jobs[name]['next_run'] = 0
+        self.wakeup.set()
+
+    def _run(self, name):
+        with self.lock:
+            job = self.jobs[name]
+            job['running'] = True
+        started = time.time()
+        result, error = None, None
+        try:
+            result = job['func']()
+        except Exception as e:
+            error = str(e)
+            print(f"Błąd zadania w tle {name}: {e}")
+        with self.lock:
+            job.update(
+                running=False, runs=job['runs'] + 1, last_run=started,
+                last_duration=round(time.time() - started, 3), last_error=error,
+                last_result=None if result is None else str(result)[:200],
+                next_run=time.time() + job['interval'],
+            )
+
+    def _loop(self):
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                due = [name for name, job in self.jobs.items() if job['next_run'] <= time.time()]
+            for name in due:
+                self._run(name)
+            with self.lock:
+                next_run = min((job['next_run'] for job in self.jobs.values()), default=time.time() + 60)
+            self.wakeup.wait(max(0.0, next_run - time.time()))
+
+    def snapshot(self):
+        tz = ZoneInfo("Europe/Warsaw")
+        with self.lock:
+            now = time.time()
+            return {
+                'running': self.thread is not None and self.thread.is_alive(),
+                'jobs': {
+                    name: {
+                        'interval_s': job['interval'], 'runs': job['runs'], 'running': job['running'],
+                        'last_run': (datetime.datetime.fromtimestamp(job['last_run'], tz).strftime("%d-%m-%Y %H:%M:%S")
+                                     if job['last_run'] else None),
+                        'last_duration_s': job['last_duration'], 'last_result': job['last_result'],
+                        'last_error': job['last_error'], 'next_in_s': round(max(0.0, job['next_run'] - now), 1),
+                    }
+                    for name, job in self.jobs.items()
+                },
+            }
+
+def scheduled_acl_sync():
+    success, msg = sync_users_with_calendar()
+    if not success:
+        raise RuntimeError(msg)
+    return msg
+
+def refresh_users_cache(idle_after=None):
+    """
+    Odczytuje arkusz ACL z wyprzedzeniem, zanim wpis w cache (USERS_SHEET_TTL) wygaśnie dla użytkowników.
+    idle_after: z harmonogramu - pomija odczyt, gdy żadna sesja nie czytała bazy od tylu sekund.
+    """
+    registry_cache = get_user_registry_cache()
+    idle = registry_cache.idle_for()
+    if idle_after is not None and idle > idle_after:
+        return "pominięte - brak sesji" if idle == float('inf') else f"pominięte - brak sesji od {int(idle)} s"
+    read_users_sheet.clear()
+    registry_cache.invalidate()
+    return f"{len(registry_cache.get(build_users_frame, touch=False))} osób"
+
+def warm_schedule(days):
+    """
+    Grafik na `days` dni naprzód dla każdej lokalizacji jednym odczytem zakresu:
+    z lokalną kopią SQLite - synchronizacja kopii, bez niej - wpisy ScheduleCache per dzień.
+    Przy okazji odświeża indeks uczestników ("Twoje zapisy") i zapisuje snapshot na dysk.
+    """
+    tz = ZoneInfo("Europe/Warsaw")
+    today = datetime.datetime.now(tz).date()
+    all_days = [today + datetime.timedelta(days=i) for i in range(days)]
+    store = get_calendar_store()
+    cache = get_schedule_cache()
+
+    for calendar_id in dict.fromkeys(LOCATIONS.values()):
+        if store is not None:
+            sync_calendar_store(calendar_id, all_days[-1])
+            continue
+        time_min = datetime.datetime.combine(all_days[0], datetime.time(0, 0), tzinfo=tz).isoformat()
+        time_max = datetime.datetime.combine(all_days[-1], datetime.time(23, 59, 59), tzinfo=tz).isoformat()
+        by_day = {}
+        for event in list_all_events(time_min, time_max, calendar_id=calendar_id, orderBy='startTime'):
+            by_day.setdefault(event_day(event), []).append(event)
+        for day in all_days:
+            cache.put((calendar_id, day.isoformat()), by_day.get(day, []))
+
+    refresh_participant_index(get_users_db(), 30)
+    saved = save_snapshot()
+    summary = f"{len(all_days)} dni × {len(dict.fromkeys(LOCATIONS.values()))} kal."
+    return summary if saved is None else f"{summary}, snapshot {saved} B"
+
+@st.cache_resource
+def get_scheduler():
+    settings = get_scheduler_settings()
+    scheduler = BackgroundScheduler()
+    if settings['acl_sync']:
+        scheduler.add_job("synchronizacja-acl", scheduled_acl_sync, settings['acl_sync_interval'])
+    scheduler.add_job("baza-uzytkownikow", lambda: refresh_users_cache(settings['users_refresh_idle']),
+                      settings['users_refresh_interval'])
+    scheduler.add_job("rozgrzewanie-grafiku", lambda: warm_schedule(settings['warm_days']), settings['warm_interval'])
+    return scheduler
+
+def start_background_jobs():
+    """Raz na proces uruchamia harmonogram; kolejne reruny tylko sprawdzają, że działa."""
+    settings = get_scheduler_settings()
+    if not settings['enabled']:
+        return
+    get_schedule_cache().max_age = settings['schedule_max_age']
+    get_scheduler().start()
+
+# --- PROFILOWANIE ---
+
+PROFILE_TAGS = {}
+
+def profile_tag(**tags):
+    """Oznacza bieżący rerun (gałąź menu, wykonana akcja) na potrzeby profilera."""
+    PROFILE_TAGS.update({k: v for k, v in tags.items() if v})
+
+def get_profiling_settings():
+    """
+    Ustawienia profilera z sekcji [profiling] w secrets.toml.
+    Zmienne środowiskowe WOZKI_PROFILE (np. '1' lub '0.1' = 10% rerunów)
+    i WOZKI_PROFILE_DIR mają pierwszeństwo przed sekretami.
+    """
+    cfg = dict(st.secrets.get("profiling", {}))
+    enabled = bool(cfg.get("enabled", False))
+    sample_rate = float(cfg.get("sample_rate", 1.0))
+
+    env_rate = os.environ.get("WOZKI_PROFILE")
+    if env_rate:
+        try:
+            sample_rate = float(env_rate)
+        except ValueError:
+            sample_rate = 1.0
+        enabled = sample_rate > 0
+
+    return {
+        'enabled': enabled,
+        'sample_rate': min(max(sample_rate, 0.0), 1.0),
+        'dir': os.environ.get("WOZKI_PROFILE_DIR") or cfg.get("dir", "profiles"),
+        'keep': int(cfg.get("keep", 50)),
+        'interval': float(cfg.get("interval", 0.005)),
+    }
+
+class StackSampler:
+    """Próbkuje stos wątku skryptu i zlicza ścieżki w formacie collapsed (flame graph)."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.counts.items())
+
+def _profile_slug(value):
+    return re.sub(r'\W+', '-', str(value).strip().lower()).strip('-') or "brak"
+
+def dump_profile(profiler, sampler, settings):
+    """Zapisuje pstats i collapsed stacks do katalogu, usuwając najstarsze zrzuty."""
+    try:
+        out_dir = settings['dir']
+        os.makedirs(out_dir, exist_ok=True)
+
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        branch = _profile_slug(PROFILE_TAGS.get('branch'))
+        action = _profile_slug(PROFILE_TAGS.get('action'))
+        base = os.path.join(out_dir, f"{stamp}_{branch}_{action}")
+
+        profiler.dump_stats(f"{base}.pstats")
+        with open(f"{base}.collapsed", "w", encoding="utf-8") as f:
+            f.write(sampler.collapsed())
+
+        runs = sorted({os.path.splitext(name)[0] for name in os.listdir(out_dir)
+                       if name.endswith((".pstats", ".collapsed"))})
+        for old in runs[:-settings['keep']] if settings['keep'] > 0 else []:
+            for ext in (".pstats", ".collapsed"):
+                path = os.path.join(out_dir, old + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+        return base
+    except Exception as e:
+        print(f"Błąd zapisu profilu: {e}")
+        return None
+
+def run_profiled(func):
+    """Uruchamia func (np. main) pod cProfile i samplerem, jeśli profilowanie jest włączone."""
+    settings = get_profiling_settings()
+    if not settings['enabled'] or random.random() >= settings['sample_rate']:
+        return func()
+
+    PROFILE_TAGS.clear()
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident(), settings['interval'])
+    sampler.start()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        # st.stop() i st.rerun() rzucają wyjątki - zrzut robimy i tak
+        profiler.disable()
+        sampler.stop()
+        dump_profile(profiler, sampler, settings)
+
+class BackfillProgress:
+    """Postęp migracji uczestników (jedna na proces): liczniki pod blokadą, snapshot() dla UI."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {'running': False, 'checked': 0, 'total': 0, 'migrated': 0, 'skipped': 0,
+                      'error': None, 'finished_at': None}
+
+    def start(self):
+        """Zeruje liczniki; False, jeśli migracja już trwa."""
+        with self.lock:
+            if self.state['running']:
+                return False
+            self.state = {'running': True, 'checked': 0, 'total': 0, 'migrated': 0, 'skipped': 0,
+                          'error': None, 'finished_at': None}
+            return True
+
+    def update(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.state[name] = value if name == 'total' else self.state[name] + value
+
+    def finish(self, error=None):
+        with self.lock:
+            self.state.update(running=False, error=error, finished_at=time.time())
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.state)
+
+@st.cache_resource
+def get_backfill_progress():
+    return BackfillProgress()
+
+def backfill_participant_properties(days_back=365, days_ahead=365, df_users=None, progress=None):
+    """
+    Jednorazowa migracja: dopisuje extendedProperties.private.participants do wydarzeń
+    utworzonych przed wprowadzeniem tego pola (we wszystkich lokalizacjach). Wydarzenia, w których nie da się
+    jednoznacznie rozpoznać każdej osoby z tytułu, są pomijane.
+    progress (BackfillProgress) dostaje liczbę wydarzeń i postęp na bieżąco.
+    Zwraca (zmigrowane, pominięte).
+    """
+    if df_users is None:
+        df_users = get_users_db()
+
+    tz = ZoneInfo("Europe/Warsaw")
+    today = datetime.datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    time_min = (today - datetime.timedelta(days=days_back)).isoformat()
+    time_max = (today + datetime.timedelta(days=days_ahead)).isoformat()
+
+    service = get_calendar_service()
+    migrated, skipped = 0, 0
+
+    futures = [(cal, submit_task(list_all_events, time_min, time_max, calendar_id=cal))
+               for cal in dict.fromkeys(LOCATIONS.values())]
+    events = [(cal, event) for cal, events_future in futures for event in events_future.result()]
+    if progress is not None:
+        progress.update(total=len(events))
+
+    fingerprint = users_fingerprint(df_users)
+    for calendar_id, event in events:
+        if progress is not None:
+            progress.update(checked=1)
         title = event.get('summary', '')
-        
-        found_emails, _ = get_participants_from_title(title, df_users)
-        
-        for e in found_emails:
-            if e not in exclude_emails:
-                unique_emails.add(e)
-                
-    return list(unique_emails)
+        if 'dateTime' not in event.get('start', {}) or parse_hours_from_title(title)[0]:
+            continue
+        if get_event_participant_emails(event) is not None:
+            continue
+
+        ordered = []
+        for part in re.split(r'\s+(?:i|\+|&|,)\s+', title):
+            found, unknown = get_participants_from_title(part, df_users, fingerprint)
+            if len(found) != 1 or unknown:
+                ordered = None
+                break
+            ordered.append(found[0])
+
+        if not ordered:
+            skipped += 1
+            if progress is not None:
+                progress.update(skipped=1)
+            continue
+
+        body = {}
+        set_event_participant_emails(body, ordered)
+        execute_api(service.events().patch(calendarId=calendar_id, eventId=event['id'], body=body))
+        migrated += 1
+        if progress is not None:
+            progress.update(migrated=1)
+
+    return migrated, skipped
+
+def start_backfill(df_users):
+    """
+    Zleca migrację uczestników do puli - setki patchy przez limiter nie blokują sesji.
+    Zwraca False, gdy migracja już trwa (także z innej sesji).
+    """
+    progress = get_backfill_progress()
+    if not progress.start():
+        return False
+
+    def run():
+        try:
+            backfill_participant_properties(df_users=df_users, progress=progress)
+            progress.finish()
+        except Exception as e:
+            print(f"Błąd migracji uczestników: {e}")
+            progress.finish(str(e))
+
+    submit_task(run)
+    return True
+
+def backfill_status_panel():
+    """Postęp migracji; fragment odpytuje co 2 s, dopóki migracja trwa, a po niej odświeża stronę."""
+    progress = get_backfill_progress().snapshot()
+    if progress['running']:
+        st.session_state['backfill_polling'] = True
+        checked, total = progress['checked'], progress['total']
+        st.progress(checked / total if total else 0.0,
+                    text=f"Migracja uczestników: {checked}/{total} wydarzeń (zmigrowano {progress['migrated']})")
+        return
+    if st.session_state.pop('backfill_polling', False):
+        # Koniec migracji: pełny rerun wyłącza odpytywanie i odblokowuje przycisk
+        st.rerun()
+    if progress['error']:
+        st.error(f"Migracja przerwana: {progress['error']}")
+    elif progress['finished_at']:
+        st.success(f"Zmigrowano: {progress['migrated']}, pominięto (nierozpoznane): {progress['skipped']}")
 
 @st.dialog("Potwierdzenie tożsamości")
 def login_dialog(user_row, ls):
     """Wyświetla okno modalne z potwierdzeniem logowania."""
-    st.markdown(f"Czy nazywasz się **{user_row['Imię']} {user_row['Nazwisko']}**?")
+    st.markdown(f"Czy nazywasz się **{user_row.full_name}**?")
     
     col1, col2 = st.columns(2)
     
@@ -792,10 +3435,10 @@ def login_dialog(user_row, ls):
     if col2.button("Kontynuuj", type="primary", use_container_width=True):
         # --- LOGIKA LOGOWANIA (Przeniesiona z main) ---
         st.session_state.update({
-            'user_email': user_row['Email'], 
-            'user_name': f"{user_row['Imię']} {user_row['Nazwisko']}", 
-            'user_role': user_row['Rola'], 
-            'user_gender': user_row.get('Płeć', 'M')
+            'user_email': user_row.email,
+            'user_name': user_row.full_name,
+            'user_role': user_row.role,
+            'user_gender': user_row.gender
         })
         # Czyścimy cache
         if 'available_slots_cache' in st.session_state:
@@ -805,7 +3448,7 @@ def login_dialog(user_row, ls):
         # Resetujemy formularz
         st.session_state['request_type_radio'] = "Zapis"
         # Zapisujemy w przeglądarce
-        ls.setItem(STORAGE_USER, user_row['Email'])
+        ls.setItem(STORAGE_USER, user_row.email)
 
         st.session_state['just_logged_in'] = True
         
@@ -814,62 +3457,42 @@ def login_dialog(user_row, ls):
 
 def main():
 
-    if not check_password():
+    ls = bootstrap_session()
+    if ls is None:
+        profile_tag(branch="start")
+        st.caption("Wczytywanie...")
         return
 
-    ls = LocalStorage()
-    
+    if not check_password(ls):
+        profile_tag(branch="logowanie")
+        return
+
+    # Po zalogowaniu: ekran hasła nie płaci za start wątków i ich importy
+    start_background_jobs()
+    # Zapisy i zmiany bazy zrobione na innych replikach
+    apply_invalidations()
+
     # 1. POBIERANIE BAZY UŻYTKOWNIKÓW
-    df_users = load_users()
+    users = load_users()
     
-    if df_users.empty:
+    if not len(users):
         st.error("Nie udało się załadować listy użytkowników z Arkusza ACL.")
         st.stop()
 
-    components.html("""
-    <script>
-        function disableKeyboardOnMobile() {
-            const inputs = window.parent.document.querySelectorAll('div[data-baseweb="base-input"] input');
-            inputs.forEach(input => {
-                if(input.type !== 'password'){
-                    input.setAttribute('readonly', 'readonly');
-                    input.setAttribute('inputmode', 'none');
-                }
-            });
-        }
-        setInterval(disableKeyboardOnMobile, 500);
-    </script>
-    """, height=0)
+    # Wspólna ramka tylko do odczytu - funkcje kalendarza jej nie modyfikują
+    df_users = users.frame
+    all_full_names = list(users.full_names)
 
-    components.html("""
-    <script>
-        function disableKeyboardOnMobile() {
-            const inputs = window.parent.document.querySelectorAll('div[data-baseweb="select"] input');
-            inputs.forEach(input => {
-                input.setAttribute('readonly', 'readonly');
-                input.setAttribute('inputmode', 'none');
-            });
-        }
-        setInterval(disableKeyboardOnMobile, 500);
-    </script>
-    """, height=0)
-        
-    df_users['Imię'] = df_users['Imię'].astype(str).str.strip()
-    df_users['Nazwisko'] = df_users['Nazwisko'].astype(str).str.strip()
-    
-    all_full_names = [f"{i} {n}" for i, n in zip(df_users['Imię'], df_users['Nazwisko'])]
+    stored_email = st.session_state.pop('stored_email', None)
 
-    stored_email = ls.getItem(STORAGE_USER)
-    
+    # Bez st.rerun(): selectbox niżej od razu dostaje odtworzoną osobę
     if stored_email and not st.session_state.get('user_email'):
-        user_match = df_users[df_users['Email'] == stored_email]
-        if not user_match.empty:
-            found_user = user_match.iloc[0]
-            st.session_state['user_email'] = found_user['Email']
-            st.session_state['user_name'] = f"{found_user['Imię']} {found_user['Nazwisko']}"
-            st.session_state['user_role'] = found_user['Rola']
-            st.session_state['user_gender'] = found_user.get('Płeć', 'M')
-            st.rerun()
+        found_user = users.get(stored_email)
+        if found_user is not None:
+            st.session_state['user_email'] = found_user.email
+            st.session_state['user_name'] = found_user.full_name
+            st.session_state['user_role'] = found_user.role
+            st.session_state['user_gender'] = found_user.gender
     
     pre_selected_index = None
     if 'user_name' in st.session_state:
@@ -908,14 +3531,10 @@ def main():
     
     # OBSŁUGA WYBORU UŻYTKOWNIKA
     if selected_full_name:
-        mask = (df_users['Imię'] + ' ' + df_users['Nazwisko']) == selected_full_name
-        matching_users = df_users[mask]
+        user_data = users.by_full_name.get(selected_full_name)
         
-        if not matching_users.empty:
-            user_data = matching_users.iloc[0]
-            new_email = user_data['Email']
-
-            if st.session_state.get('user_email') != new_email:
+        if user_data is not None:
+            if st.session_state.get('user_email') != user_data.email:
                 login_dialog(user_data, ls)
                 st.title("Służba przy wózku 📝")
                 st.caption("Gdańsk Ujeścisko - Wschód")
@@ -934,6 +3553,8 @@ def main():
         st.info("⬅️ Aby rozpocząć, wybierz siebie z listy w panelu po lewej stronie.")
         st.stop()
     
+    mark_interactive()
+
     menu = ["Nowe zgłoszenie"]
     allowed_roles = ['owner', 'writer', 'admin']
     current_role = str(st.session_state.get('user_role', '')).strip().lower()
@@ -942,6 +3563,7 @@ def main():
         menu.append("Ustawienia")
 
     choice = st.sidebar.radio("Menu", menu)
+    profile_tag(branch=choice)
 
     if choice == "Nowe zgłoszenie":
         st.title("Służba przy wózku 📝")
@@ -951,9 +3573,15 @@ def main():
         
         today = datetime.date.today()
         
-        with st.expander(f"📅 Twoje zapisy na najbliższe 30 dni", expanded=False):
+        with st.expander(f"📅 Twoje najbliższe zapisy", expanded=False):
+            my_events_days = st.radio("Zakres", [30, 90, 365], format_func=lambda x: f"{x} dni",
+                                      horizontal=True, key="my_events_range")
             with st.spinner("Pobieram Twoje zapisy..."):
-                df_my_events = get_user_upcoming_events()
+                try:
+                    df_my_events = get_user_upcoming_events(my_events_days, df_users=df_users)
+                except ServiceUnavailableError as e:
+                    st.warning(str(e))
+                    df_my_events = pd.DataFrame()
             
             if not df_my_events.empty:
                 st.dataframe(
@@ -963,6 +3591,7 @@ def main():
                     column_config={
                         "Data": st.column_config.TextColumn("Data", width="small"),
                         "Godzina": st.column_config.TextColumn("Godzina", width="small"),
+                        "Lokalizacja": st.column_config.TextColumn("Lokalizacja", width="small"),
                         "Szczegóły (Kto)": st.column_config.TextColumn("Kto pełni służbę", width="large"),
                     }
                 )
@@ -970,98 +3599,73 @@ def main():
                 st.info("Nie masz jeszcze żadnych zapisów.")
         
         with st.expander("📝 Formularz zgłoszeniowy", expanded=True):
-            st.selectbox("Lokalizacja", ["Piotrkowska"], index=0, disabled=True)
+            location = st.selectbox("Lokalizacja", list(LOCATIONS), index=0, disabled=len(LOCATIONS) < 2)
+            location_calendar = LOCATIONS[location]
             request_type = st.radio("Rodzaj zgłoszenia", ["Zapis", "Rezygnacja"], horizontal=True, key="request_type_radio")
 
+        profile_tag(action=request_type, location=location)
+
+        # Grafik i wyniki wyszukiwania dotyczą jednej lokalizacji - po zmianie pobieramy od nowa
+        if st.session_state.get('last_location') != location:
+            st.session_state['last_location'] = location
+            for key in ('last_fetched_date', 'overview_cache', 'next_slots_cache'):
+                st.session_state.pop(key, None)
+
         if request_type == "Zapis":
             st.subheader("📅 Zapis na służbę przy wózku")
 
-            icon_empty_grey = "data:image/svg+xml;utf8,%3Csvg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 24 24' fill='none' stroke='%239ca3af' stroke-width='2' stroke-linecap='round' stroke-linejoin='round'%3E%3Cpath d='M20.84 4.61a5.5 5.5 0 0 0-7.78 0L12 5.67l-1.06-1.06a5.5 5.5 0 0 0-7.78 7.78l1.06 1.06L12 21.23l7.78-7.78 1.06-1.06a5.5 5.5 0 0 0 0-7.78z'%3E%3C/path%3E%3C/svg%3E"
-            
-            icon_empty_purple = "data:image/svg+xml;utf8,%3Csvg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 24 24' fill='none' stroke='%235d3b87' stroke-width='2' stroke-linecap='round' stroke-linejoin='round'%3E%3Cpath d='M20.84 4.61a5.5 5.5 0 0 0-7.78 0L12 5.67l-1.06-1.06a5.5 5.5 0 0 0-7.78 7.78l1.06 1.06L12 21.23l7.78-7.78 1.06-1.06a5.5 5.5 0 0 0 0-7.78z'%3E%3C/path%3E%3C/svg%3E"
-            
-            icon_filled_purple = "data:image/svg+xml;utf8,%3Csvg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 24 24' fill='%235d3b87' stroke='%235d3b87' stroke-width='2' stroke-linecap='round' stroke-linejoin='round'%3E%3Cpath d='M20.84 4.61a5.5 5.5 0 0 0-7.78 0L12 5.67l-1.06-1.06a5.5 5.5 0 0 0-7.78 7.78l1.06 1.06L12 21.23l7.78-7.78 1.06-1.06a5.5 5.5 0 0 0 0-7.78z'%3E%3C/path%3E%3C/svg%3E"
-
-            st.markdown(f"""
-            <style>
-            /* 
-               1. SELEKTOR IZOLOWANY 
-               Działa TYLKO na przycisk, który jest w kolumnie obok znacznika #heart-marker.
-               Nie zepsuje innych przycisków w aplikacji.
-            */
-            div[data-testid="stColumn"]:has(span#heart-marker) button {{
-                border: none !important;
-                background-color: transparent !important;
-                box-shadow: none !important;
-                padding: 0 !important;
-                margin: 0 !important;
-                height: 100%;
-                width: 100%;
-                min-height: 42px;
-                
-                /* Tło SVG */
-                background-repeat: no-repeat !important;
-                background-position: center !important;
-                /* Zmniejszone do 22px, żeby nie ucinało po bokach */
-                background-size: 22px 22px !important; 
-            }}
-            
-            /* Ukrywamy tekst wewnątrz TEGO KONKRETNEGO przycisku */
-            div[data-testid="stColumn"]:has(span#heart-marker) button p {{
-                display: none !important;
-            }}
-
-            /* --- LOGIKA STANÓW DLA SERCA --- */
-
-            div[data-testid="stElementContainer"]{{
-                min-width: 1.375rem;
-            }}
-            /* STAN: BRAK (type="secondary") */
-            div[data-testid="stColumn"]:has(span#heart-marker) button[kind="secondary"] {{
-                background-image: url("{icon_empty_grey}") !important;
-                transition: background-image 0.2s;
-            }}
-            /* Hover */
-            div[data-testid="stColumn"]:has(span#heart-marker) button[kind="secondary"]:hover {{
-                background-image: url("{icon_empty_purple}") !important;
-            }}
-
-            /* STAN: ULUBIONE (type="primary") */
-            div[data-testid="stColumn"]:has(span#heart-marker) button[kind="primary"] {{
-                background-image: url("{icon_filled_purple}") !important;
-            }}
-            /* Reset tła systemowego primary */
-            div[data-testid="stColumn"]:has(span#heart-marker) button[kind="primary"]:hover,
-            div[data-testid="stColumn"]:has(span#heart-marker) button[kind="primary"]:focus {{
-                background-color: transparent !important;
-            }}
-
-            /* STAN: DISABLED */
-            div[data-testid="stColumn"]:has(span#heart-marker) button[disabled] {{
-                background-image: url("{icon_empty_grey}") !important;
-                opacity: 0.3 !important;
-                pointer-events: none !important;
-            }}
-
-            /* 2. FIX NA MOBILE */
-            @media (max-width: 640px) {{
-                [data-testid="stColumn"] [data-testid="stHorizontalBlock"] {{
-                    flex-direction: row !important;
-                    flex-wrap: nowrap !important;
-                }}
-                [data-testid="stColumn"] [data-testid="stHorizontalBlock"] > [data-testid="stColumn"]:first-child {{
-                    width: 80% !important;
-                    min-width: 80% !important;
-                    flex: 1 1 auto !important;
-                }}
-                [data-testid="stColumn"] [data-testid="stHorizontalBlock"] > [data-testid="stColumn"]:last-child {{
-                    width: 20% !important;
-                    min-width: 20% !important;
-                    flex: 1 1 auto !important;
-                }}
-            }}
-            </style>
-            """, unsafe_allow_html=True)
+            me = users.get(st.session_state['user_email'])
+            my_favorites = list(me.favorites) if me is not None else []
+
+            with st.expander("🗓️ Przegląd wolnych terminów na najbliższe tygodnie", expanded=False):
+                overview_weeks = st.select_slider("Liczba tygodni", options=[4, 5, 6, 7, 8], value=4)
+                overview_key = (overview_weeks, today)
+
+                if st.button("Pokaż przegląd", icon=":material/calendar_month:"):
+                    profile_tag(action="przeglad-tygodni")
+                    with st.spinner("Sprawdzam grafik na najbliższe tygodnie..."):
+                        try:
+                            matrix = get_availability_matrix(today, overview_weeks, df_users=df_users,
+                                                             calendar_id=location_calendar)
+                            st.session_state['overview_cache'] = (overview_key, format_availability_overview(matrix))
+                        except ServiceUnavailableError as e:
+                            st.error(str(e))
+
+                cached_overview = st.session_state.get('overview_cache')
+                if cached_overview and cached_overview[0] == overview_key:
+                    st.caption("🟢 wolne · 🤝 można dołączyć · ⛔ pełne · ✅ Twój dyżur · puste - brak dyżuru")
+                    st.dataframe(cached_overview[1], use_container_width=True)
+
+            with st.expander("🔎 Znajdź najbliższy wolny termin", expanded=False):
+                c_limit, c_fav = st.columns(2)
+                with c_limit:
+                    search_limit = st.number_input("Liczba propozycji", min_value=1, max_value=10, value=3)
+                with c_fav:
+                    favorites_only = st.checkbox("Tylko z ulubionymi", value=False, disabled=not my_favorites)
+                search_key = (search_limit, favorites_only, today)
+
+                if st.button("Szukaj", icon=":material/search:"):
+                    profile_tag(action="szukaj-terminu")
+                    with st.spinner("Przeszukuję grafik..."):
+                        try:
+                            found_slots = find_next_slots(today, my_favorites, limit=search_limit,
+                                                          favorites_only=favorites_only, df_users=df_users,
+                                                          calendar_id=location_calendar)
+                            st.session_state['next_slots_cache'] = (search_key, found_slots)
+                        except ServiceUnavailableError as e:
+                            st.error(str(e))
+
+                cached_search = st.session_state.get('next_slots_cache')
+                if cached_search and cached_search[0] == search_key:
+                    if not cached_search[1]:
+                        st.info("Nie znaleziono wolnych terminów w najbliższych tygodniach.")
+                    else:
+                        email_to_name = {key: record.full_name for key, record in users.by_email.items()}
+                        st.dataframe(pd.DataFrame([{
+                            "Data": f"{WEEKDAY_NAMES[m['date'].weekday()]} {m['date'].strftime('%d-%m-%Y')}",
+                            "Godzina": f"{m['hour']}:00 - {m['hour'] + 1}:00",
+                            "Status": "🟢 Wolne" if m['partner'] is None else f"❤️ Dołącz do: {email_to_name.get(m['partner'], m['partner'])}",
+                        } for m in cached_search[1]]), hide_index=True, use_container_width=True)
 
             # --- UKŁAD HYBRYDOWY ---
             c_main_left, c_main_right = st.columns([0.5, 0.5])
@@ -1070,26 +3674,20 @@ def main():
                 selected_date = st.date_input("Wybierz datę", min_value=datetime.date.today(), format="DD-MM-YYYY")
 
             # --- LOGIKA DANYCH ---
-            current_user_idx = df_users.index[df_users['Email'] == st.session_state['user_email']].tolist()[0]
-            fav_raw = df_users.at[current_user_idx, 'Ulubione']
-            current_fav_string = str(fav_raw) if pd.notna(fav_raw) else ""
-            my_favorites = [e.strip().lower() for e in current_fav_string.split(',') if '@' in e]
 
-            other_users_df = df_users[df_users['Email'] != st.session_state['user_email']]
-            
             fav_list = []
             regular_list = []
             name_to_email_map = {}
 
-            for index, row in other_users_df.iterrows():
-                display_name = f"{row['Imię']} {row['Nazwisko']}"
-                email = row['Email'].strip().lower()
-                name_to_email_map[display_name] = email
+            for record in users.records:
+                if record is me:
+                    continue
+                name_to_email_map[record.full_name] = record.key
                 
-                if email in my_favorites:
-                    fav_list.append(display_name)
+                if record.key in my_favorites:
+                    fav_list.append(record.full_name)
                 else:
-                    regular_list.append(display_name)
+                    regular_list.append(record.full_name)
             
             final_options = ["Brak"]
             
@@ -1112,21 +3710,18 @@ def main():
                     
                     selected_email = name_to_email_map.get(second_preacher_name)
                     
-                    if selected_email:
+                    # Bez własnego wiersza w bazie (me is None) nie ma gdzie zapisać ulubionych
+                    if selected_email and me is not None:
                         
                         if selected_email in my_favorites:
                             if st.button(" ", type="primary", help="Usuń z ulubionych"):
                                 my_favorites.remove(selected_email)
-                                new_fav_str = ",".join(my_favorites)
-                                df_users.at[current_user_idx, 'Ulubione'] = new_fav_str
-                                update_user_db(df_users)
+                                update_user_db(users.with_favorites(me.email, my_favorites))
                                 st.rerun()
                         else:
                             if st.button(" ", type="secondary", help="Dodaj do ulubionych"):
                                 my_favorites.append(selected_email)
-                                new_fav_str = ",".join(my_favorites)
-                                df_users.at[current_user_idx, 'Ulubione'] = new_fav_str
-                                update_user_db(df_users)
+                                update_user_db(users.with_favorites(me.email, my_favorites))
                                 st.rerun()
                     else:
                         st.button(" ", disabled=True)
@@ -1135,11 +3730,21 @@ def main():
                 if st.session_state.get('last_fetched_date') != selected_date:
                     with st.spinner("Sprawdzam grafik..."):
                         d = datetime.datetime.combine(selected_date, datetime.time(0,0))
-                        fetched_slots, _ = get_slots_for_day(d)
+                        try:
+                            fetched_slots, _ = get_slots_for_day(d, df_users=df_users, calendar_id=location_calendar)
+                        except ServiceUnavailableError as e:
+                            st.error(str(e))
+                            st.stop()
                         st.session_state['available_slots_cache'] = fetched_slots
                         st.session_state['last_fetched_date'] = selected_date
+                        st.session_state['available_slots_stale'] = st.session_state.get('schedule_stale', False)
                 
                 available_slots = st.session_state.get('available_slots_cache', {})
+
+                if st.session_state.get('available_slots_stale'):
+                    st.warning("⚠️ Kalendarz Google chwilowo nie odpowiada - grafik może być nieaktualny.")
+                    # Przy następnym rerunie spróbujemy ponownie (odświeżenie trwa w tle)
+                    del st.session_state['last_fetched_date']
                 
                 if not available_slots:
                     st.warning("Brak wolnych terminów w tym dniu")
@@ -1176,23 +3781,47 @@ def main():
                     elif is_joining and can_proceed:
                          st.info(f"ℹ️ Dołączasz do: {slot_status.replace('Dołącz do: ', '')}")
 
+                    c_rec, c_weeks = st.columns([0.6, 0.4], vertical_alignment="bottom")
+                    with c_rec:
+                        weekday_name = ['poniedziałek', 'wtorek', 'środę', 'czwartek', 'piątek', 'sobotę', 'niedzielę'][selected_date.weekday()]
+                        recurring = st.checkbox(f"🔁 Zapisz co tydzień ({weekday_name}, {selected_hour}:00)", value=False)
+                    with c_weeks:
+                        recurring_weeks = st.number_input("Liczba tygodni", min_value=2, max_value=12, value=8, disabled=not recurring)
+
                     if st.button("✅ Zapisz się", disabled=not can_proceed):
+                        profile_tag(action="zapisz-cyklicznie" if recurring else "zapisz")
                         with st.spinner("Zapisywanie..."):
                             d_booking = datetime.datetime.combine(selected_date, datetime.time(0,0))
                             
                             sec_data = None
-                            if second_preacher_name != "Brak":
-                                mask_sec = (df_users['Imię'] + ' ' + df_users['Nazwisko']) == second_preacher_name
-                                sec_match = df_users[mask_sec]
-                                if not sec_match.empty:
-                                    sec_data = sec_match.iloc[0].to_dict()
+                            sec_record = users.by_full_name.get(second_preacher_name)
+                            if sec_record is not None:
+                                sec_data = sec_record.as_row()
                             
-                            success = book_event(d_booking, selected_hour, sec_data)
+                            try:
+                                if recurring:
+                                    summary = book_recurring(d_booking, selected_hour, recurring_weeks, sec_data,
+                                                             df_users=df_users, calendar_id=location_calendar)
+                                    success = bool(summary['booked'] or summary['joined'])
+                                    for day, reason in summary['skipped']:
+                                        st.warning(f"{day.strftime('%d-%m-%Y')}: pominięto ({reason})")
+                                    for day in summary['failed']:
+                                        st.error(f"{day.strftime('%d-%m-%Y')}: nie udało się zapisać")
+                                    if success:
+                                        st.info(f"Zapisano terminów: {len(summary['booked']) + len(summary['joined'])} z {recurring_weeks}")
+                                else:
+                                    success = book_event(d_booking, selected_hour, sec_data, df_users=df_users,
+                                                         calendar_id=location_calendar)
+                            except ServiceUnavailableError as e:
+                                st.error(str(e))
+                                st.stop()
                             if success:
                                 st.success("Pomyślnie zapisano!")
                                 if 'last_fetched_date' in st.session_state:
                                     del st.session_state['last_fetched_date']
-                                time.sleep(1.5)
+                                st.session_state.pop('overview_cache', None)
+                                st.session_state.pop('next_slots_cache', None)
+                                time.sleep(3 if recurring else 1.5)
                                 st.rerun()
                             else:
                                 st.error("Wystąpił błąd podczas zapisu.")
@@ -1205,7 +3834,14 @@ def main():
             if cancel_date:
                 with st.spinner("Szukam Twoich terminów..."):
                     d = datetime.datetime.combine(cancel_date, datetime.time(0,0))
-                    _, my_hours = get_slots_for_day(d)
+                    try:
+                        _, my_hours = get_slots_for_day(d, df_users=df_users, calendar_id=location_calendar)
+                    except ServiceUnavailableError as e:
+                        st.error(str(e))
+                        st.stop()
+
+                if st.session_state.get('schedule_stale'):
+                    st.warning("⚠️ Pokazuję zapamiętany grafik (Kalendarz Google nie odpowiada albo trwa odświeżanie) - lista może być nieaktualna.")
                 
                 if not my_hours:
                     st.info("Nie masz żadnych terminów w tym dniu.")
@@ -1223,16 +3859,18 @@ def main():
                     check_end = check_start + datetime.timedelta(hours=1)
                     
                     service = get_calendar_service()
-                    check_events = service.events().list(
-                        calendarId=CALENDAR_ID, 
-                        timeMin=check_start.isoformat(), 
-                        timeMax=check_end.isoformat(), 
-                        singleEvents=True
-                    ).execute().get('items', [])
+                    try:
+                        check_events = execute_api(service.events().list(
+                            calendarId=location_calendar, 
+                            timeMin=check_start.isoformat(), 
+                            timeMax=check_end.isoformat(), 
+                            singleEvents=True
+                        )).get('items', [])
+                    except ServiceUnavailableError:
+                        check_events = []
                     
                     for ev in check_events:
-                        title = ev.get('summary', '')
-                        found_emails, _ = get_participants_from_title(title, df_users)
+                        found_emails, _ = get_event_participants(ev, df_users)
                         
                         if st.session_state['user_email'] in found_emails:
                             if len(found_emails) > 1:
@@ -1249,8 +3887,14 @@ def main():
                         )
                     
                     if st.button("⛔ Odwołaj służbę"):
+                        profile_tag(action="odwolaj")
                         with st.spinner("Usuwanie..."):
-                            success = cancel_booking(d, hour_to_cancel, delete_entirely=delete_entirely)
+                            try:
+                                success = cancel_booking(d, hour_to_cancel, delete_entirely=delete_entirely,
+                                                         df_users=df_users, calendar_id=location_calendar)
+                            except ServiceUnavailableError as e:
+                                st.error(str(e))
+                                st.stop()
                             if success:
                                 if delete_entirely:
                                     st.success("Całe wydarzenie zostało usunięte.")
@@ -1282,26 +3926,95 @@ def main():
         
         st.subheader("Lista głosicieli")
 
+        scheduler_settings = get_scheduler_settings()
+        # Przycisk zleca synchronizację harmonogramowi tylko, gdy ten ma zadanie ACL
+        scheduler_on = scheduler_settings['enabled'] and scheduler_settings['acl_sync']
         if st.button("Odśwież dane", icon=":material/sync:"):
-            with st.spinner("Synchronizuję z Kalendarzem Google..."):
-                success, msg = sync_users_with_calendar()
-                
-                if success:
-                    st.cache_data.clear()
+            profile_tag(action="synchronizacja")
+            if scheduler_on:
+                # Synchronizacja idzie w wątku harmonogramu - strona nie czeka na Kalendarz i Arkusz
+                get_scheduler().run_now("synchronizacja-acl")
+                st.toast("Synchronizacja uruchomiona w tle.", icon="🔄")
+            else:
+                with st.spinner("Synchronizuję z Kalendarzem Google..."):
+                    success, msg = sync_users_with_calendar()
                     
-                    if "Zaktualizowano" in msg:
-                        st.success(msg)
+                    if success:
+                        st.cache_data.clear()
+                        get_user_registry_cache().invalidate()
+                        
+                        if "Zaktualizowano" in msg:
+                            st.success(msg)
+                        else:
+                            st.info("Dane są aktualne.")
+                            time.sleep(1)
+                        st.rerun()
                     else:
-                        st.info("Dane są aktualne.")
-                        time.sleep(1)
-                    st.rerun()
-                else:
-                    st.error(msg)
+                        st.error(msg)
+
+        if scheduler_on:
+            acl_job = get_scheduler().snapshot()['jobs']['synchronizacja-acl']
+            if acl_job['running']:
+                st.caption("🔄 Synchronizacja w toku...")
+            elif acl_job['last_run']:
+                outcome = acl_job['last_error'] or acl_job['last_result']
+                st.caption(f"Ostatnia synchronizacja: {acl_job['last_run']} ({acl_job['last_duration_s']} s) - {outcome}")
             
+        backfill_running = get_backfill_progress().snapshot()['running']
+        if st.button("Migruj uczestników wydarzeń", icon=":material/database:", disabled=backfill_running):
+            profile_tag(action="migracja-uczestnikow")
+            backfill_running = start_backfill(df_users)
+        st.fragment(backfill_status_panel, run_every=2 if backfill_running else None)()
+
+        with st.expander("📈 Statystyki służby", expanded=False):
+            today = datetime.date.today()
+            quarter_start = datetime.date(today.year, 3 * ((today.month - 1) // 3) + 1, 1)
+            report_range = st.date_input("Zakres", value=(quarter_start, today), format="DD-MM-YYYY", key="stats_range")
+
+            if st.button("Generuj raport", icon=":material/query_stats:"):
+                profile_tag(action="raport-statystyk")
+                if len(report_range) != 2:
+                    st.warning("Wybierz datę początkową i końcową.")
+                else:
+                    with st.spinner("Liczę statystyki..."):
+                        try:
+                            st.session_state['stats_report'] = (report_range, build_service_report(*report_range, df_users))
+                        except ServiceUnavailableError as e:
+                            st.error(str(e))
+
+            cached_report = st.session_state.get('stats_report')
+            if cached_report and cached_report[0] == tuple(report_range):
+                report = cached_report[1]
+                span = f"{report_range[0].isoformat()}_{report_range[1].isoformat()}"
+
+                st.markdown("**Godziny służby na osobę**")
+                st.dataframe(report['people'], hide_index=True, use_container_width=True)
+                st.download_button("Pobierz CSV (osoby)", report_to_csv(report['people']),
+                                   file_name=f"godziny_{span}.csv", mime="text/csv")
+
+                st.markdown("**Najczęściej puste godziny**")
+                st.dataframe(report['hours'], hide_index=True, use_container_width=True)
+                st.download_button("Pobierz CSV (godziny)", report_to_csv(report['hours']),
+                                   file_name=f"godziny_puste_{span}.csv", mime="text/csv")
+
+                if not report['weekdays'].empty:
+                    st.markdown("**Dni tygodnia**")
+                    st.dataframe(report['weekdays'], hide_index=True, use_container_width=True)
+                    st.markdown("**% pustych godzin (dzień × godzina)**")
+                    st.dataframe(report['coverage'], use_container_width=True)
+                    st.download_button("Pobierz CSV (obsada)", report_to_csv(report['coverage'], index=True),
+                                       file_name=f"obsada_{span}.csv", mime="text/csv")
+
+        with st.expander("📊 Diagnostyka", expanded=False):
+            st.json(collect_metrics())
+
         edited_df = st.data_editor(df_users, num_rows="dynamic")
         
         if st.button("Zapisz zmiany w bazie"):
+            profile_tag(action="zapis-bazy")
+            # data_editor zwraca nową ramkę bez attrs - flagę snapshotu przenosimy z rejestru
+            edited_df.attrs['from_snapshot'] = users.from_snapshot
             update_user_db(edited_df)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_profiled(main)
\ No newline at end of file
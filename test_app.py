@@ -1,6 +1,13 @@
 import pytest
+import os
+import re
+import subprocess
+import sys
 from unittest.mock import MagicMock, patch
 import datetime
+from zoneinfo import ZoneInfo
+import time
+import threading
 import pandas as pd
 import app  
 
@@ -156,4 +163,1019 @@ def test_cancel_booking_delete_all(mock_service, mock_session_state, mock_users_
     app.cancel_booking(datetime.date(2030, 1, 1), 10, delete_entirely=True)
     
     # Powinien być DELETE
-    mock_service.events().delete.assert_called_once()
\ No newline at end of file
+    mock_service.events().delete.assert_called_once()
+
+def test_book_and_cancel_survive_lost_response(mock_service, mock_session_state, mock_users_db):
+    """Timeout po udanym zapisie: ponowiony insert dostaje 409, ponowiony delete 404 - oba to sukces."""
+    mock_service.events().list().execute.return_value = {'items': []}
+    mock_service.events().insert().execute.side_effect = [TimeoutError(), make_http_error(409, "duplicate")]
+    with patch('app.time.sleep'), patch('app.record_event_write') as mock_write:
+        assert app.book_event(datetime.date(2030, 1, 1), 10) is True
+    mock_write.assert_called_once()
+
+    event = {'id': 'e1', 'summary': 'Testowy User', 'start': {'dateTime': '...'}}
+    mock_service.events().list().execute.return_value = {'items': [event]}
+    mock_service.events().delete().execute.side_effect = [TimeoutError(), make_http_error(404, "notFound")]
+    with patch('app.time.sleep'), patch('app.record_event_delete') as mock_delete:
+        app.cancel_booking(datetime.date(2030, 1, 1), 10, delete_entirely=True)
+    mock_delete.assert_called_once()
+
+# --- TESTY PROFILERA ---
+
+def test_run_profiled_dumps_and_rotates(tmp_path):
+    """Każdy profilowany rerun zostawia pstats + collapsed, a katalog jest rotowany."""
+    settings = {'profiling': {'enabled': True, 'dir': str(tmp_path), 'keep': 2, 'interval': 0.001}}
+
+    def fake_main():
+        app.profile_tag(branch="Nowe zgłoszenie", action="Zapis")
+        time.sleep(0.02)
+        return "ok"
+
+    with patch.dict(app.st.secrets, settings):
+        for _ in range(3):
+            assert app.run_profiled(fake_main) == "ok"
+
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert len(files) == 4
+    assert all("_nowe-zgłoszenie_zapis." in name for name in files)
+
+    collapsed = next(tmp_path.glob("*.collapsed")).read_text(encoding="utf-8")
+    assert "fake_main" in collapsed
+
+def test_run_profiled_disabled(tmp_path):
+    with patch.dict(app.st.secrets, {'profiling': {'enabled': False, 'dir': str(tmp_path)}}):
+        assert app.run_profiled(lambda: 42) == 42
+    assert list(tmp_path.iterdir()) == []
+
+# --- TESTY LIMITERA I PONOWIEŃ ---
+
+def make_http_error(status, reason=""):
+    from googleapiclient.errors import HttpError
+    resp = MagicMock(status=status, reason=reason)
+    content = f'{{"error": {{"errors": [{{"reason": "{reason}"}}]}}}}'.encode()
+    return HttpError(resp, content)
+
+def test_execute_api_retries_rate_limit():
+    request = MagicMock()
+    request.execute.side_effect = [make_http_error(403, "rateLimitExceeded"), make_http_error(429), {'items': []}]
+
+    with patch('app.time.sleep') as mock_sleep:
+        assert app.execute_api(request) == {'items': []}
+
+    assert request.execute.call_count == 3
+    assert mock_sleep.call_count >= 2
+
+def test_execute_api_does_not_retry_client_errors():
+    request = MagicMock()
+    request.execute.side_effect = make_http_error(404, "notFound")
+
+    with patch('app.time.sleep'), pytest.raises(Exception):
+        app.execute_api(request)
+
+    assert request.execute.call_count == 1
+
+def test_execute_api_done_status_after_retry_is_success():
+    """Odpowiedź zginęła, ale zapis doszedł: 409 przy ponowieniu to sukces, przy pierwszej próbie - błąd."""
+    request = MagicMock()
+    request.execute.side_effect = [TimeoutError(), make_http_error(409, "duplicate")]
+    with patch('app.time.sleep'):
+        assert app.execute_api(request, done_statuses=(409,)) is None
+    assert request.execute.call_count == 2
+
+    request = MagicMock()
+    request.execute.side_effect = make_http_error(409, "duplicate")
+    with patch('app.time.sleep'), pytest.raises(Exception):
+        app.execute_api(request, done_statuses=(409,))
+
+def test_token_bucket_throttles_after_burst():
+    bucket = app.TokenBucket(rate=10, capacity=2)
+    with patch('app.time.sleep') as mock_sleep:
+        for _ in range(3):
+            bucket.acquire()
+
+    assert mock_sleep.call_count == 1
+    assert bucket.snapshot()['throttled'] == 1
+
+# --- TESTY BEZPIECZNIKA I ZAPAMIĘTANEGO GRAFIKU ---
+
+@pytest.fixture
+def fresh_resilience():
+    """Czyści współdzielone limitery, bezpieczniki i kopię grafiku przed i po teście."""
+    def clear():
+        app.get_rate_limiters().clear()
+        app.get_circuit_breakers().clear()
+        app.get_schedule_cache().entries.clear()
+    clear()
+    yield
+    clear()
+
+def test_circuit_breaker_fails_fast_when_open(fresh_resilience):
+    request = MagicMock()
+    request.execute.side_effect = make_http_error(503)
+
+    with patch('app.time.sleep'):
+        for _ in range(3):
+            with pytest.raises(Exception):
+                app.execute_api(request)
+        calls = request.execute.call_count
+
+        # Bezpiecznik otwarty: kolejne wywołanie nie dotyka API
+        with pytest.raises(app.ServiceUnavailableError):
+            app.execute_api(request)
+
+    assert request.execute.call_count == calls
+    assert app.get_circuit_breaker("calendar").state == "open"
+
+def test_get_slots_serves_stale_schedule(fresh_resilience, mock_service, mock_session_state, mock_users_db):
+    main_event = {'id': 'main', 'summary': 'Dyżur 10:00-12:00', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}}
+    mock_service.events().list().execute.return_value = {'items': [main_event]}
+
+    slots, _ = app.get_slots_for_day(datetime.date(2030, 1, 1))
+    assert mock_session_state['schedule_stale'] is False
+
+    mock_service.events().list().execute.side_effect = make_http_error(404)
+    with patch.object(app.ScheduleCache, 'refresh_in_background') as mock_refresh:
+        stale_slots, _ = app.get_slots_for_day(datetime.date(2030, 1, 1))
+
+    assert stale_slots == slots
+    assert mock_session_state['schedule_stale'] is True
+    mock_refresh.assert_called_once()
+
+def test_get_slots_without_copy_raises_clear_error(fresh_resilience, mock_service, mock_session_state, mock_users_db):
+    mock_service.events().list().execute.side_effect = make_http_error(404)
+
+    with pytest.raises(app.ServiceUnavailableError):
+        app.get_slots_for_day(datetime.date(2030, 1, 2))
+
+# --- TESTY SINGLE-FLIGHT ---
+
+def test_single_flight_coalesces_concurrent_calls():
+    import threading
+    flight = app.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return ['wynik']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("klucz", slow_fetch))) for _ in range(5)]
+    threads[0].start()
+    started.wait(2)
+    for t in threads[1:]:
+        t.start()
+    while flight.snapshot()['shared'] < 4:
+        time.sleep(0.001)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [['wynik']] * 5
+
+# --- TESTY RÓWNOLEGŁYCH ODCZYTÓW ---
+
+def test_get_slots_reuses_passed_users_db(mock_service, mock_session_state, mock_users_db):
+    """Gdy baza jest już w ręku, get_slots_for_day nie pyta o nią ponownie."""
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'main', 'summary': 'Dyżur 10:00-11:00', 'start': {'dateTime': '2030-01-03T10:00:00+01:00'}},
+    ]}
+
+    with patch('app.get_users_db') as mock_get_users:
+        slots, _ = app.get_slots_for_day(datetime.date(2030, 1, 3), df_users=mock_users_db)
+
+    mock_get_users.assert_not_called()
+    assert slots == {10: "Wolne"}
+
+# --- TESTY UCZESTNIKÓW W extendedProperties ---
+
+def test_book_event_writes_participant_emails(mock_service, mock_session_state):
+    mock_service.events().list().execute.return_value = {'items': []}
+    partner = {'Imię': 'Jan', 'Nazwisko': 'Nowak', 'Email': 'Jan@Other.com'}
+
+    with patch('app.send_notification_email'):
+        app.book_event(datetime.date(2030, 1, 1), 10, partner)
+
+    body = mock_service.events().insert.call_args[1]['body']
+    assert body['extendedProperties']['private']['participants'] == 'ja@test.com,jan@other.com'
+
+def test_book_event_join_appends_participant(mock_service, mock_session_state):
+    existing = {
+        'id': 'e1', 'summary': 'Jan Nowak', 'start': {'dateTime': '...'},
+        'extendedProperties': {'private': {'participants': 'jan@other.com'}}
+    }
+    mock_service.events().list().execute.return_value = {'items': [existing]}
+
+    with patch('app.get_users_db') as mock_get_users, patch('app.send_notification_email') as mock_email:
+        assert app.book_event(datetime.date(2030, 1, 1), 10) is True
+
+    mock_get_users.assert_not_called()
+    body = mock_service.events().update.call_args[1]['body']
+    assert body['extendedProperties']['private']['participants'] == 'jan@other.com,ja@test.com'
+    assert mock_email.call_args[0][0] == 'jan@other.com'
+
+def test_event_participants_prefer_structured_field(mock_users_db):
+    event = {'summary': 'J. N.', 'extendedProperties': {'private': {'participants': 'jan@other.com'}}}
+    assert app.get_event_participants(event, mock_users_db) == (['jan@other.com'], False)
+
+    # Tytuł zmieniony ręcznie (więcej osób niż w polu) - wracamy do parsowania
+    event['summary'] = 'Jan Nowak i Testowy User'
+    emails, _ = app.get_event_participants(event, mock_users_db)
+    assert sorted(emails) == ['ja@test.com', 'jan@other.com']
+
+def test_cancel_booking_uses_structured_field(mock_service, mock_session_state, mock_users_db):
+    event = {
+        'id': 'e1', 'summary': 'Jan Nowak i Testowy User', 'start': {'dateTime': '...'},
+        'extendedProperties': {'private': {'participants': 'jan@other.com,ja@test.com'}}
+    }
+    mock_service.events().list().execute.return_value = {'items': [event]}
+
+    with patch('app.send_notification_email'):
+        assert app.cancel_booking(datetime.date(2030, 1, 1), 10) is True
+
+    body = mock_service.events().update.call_args[1]['body']
+    assert body['summary'] == 'Jan Nowak'
+    assert body['extendedProperties']['private']['participants'] == 'jan@other.com'
+
+def test_backfill_participant_properties(mock_service, mock_users_db):
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'main', 'summary': 'Dyżur 10:00-12:00', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e1', 'summary': 'Testowy User i Jan Nowak', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e2', 'summary': 'Obcy Człowiek', 'start': {'dateTime': '2030-01-01T11:00:00+01:00'}},
+    ]}
+
+    assert app.backfill_participant_properties(df_users=mock_users_db) == (1, 1)
+
+    patch_kwargs = mock_service.events().patch.call_args[1]
+    assert patch_kwargs['eventId'] == 'e1'
+    assert patch_kwargs['body']['extendedProperties']['private']['participants'] == 'ja@test.com,jan@other.com'
+
+def test_backfill_runs_in_pool_with_progress(mock_service, mock_users_db):
+    """Migracja idzie przez pulę (submit_task), a postęp jest widoczny dla wszystkich sesji."""
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'e1', 'summary': 'Testowy User i Jan Nowak', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e2', 'summary': 'Obcy Człowiek', 'start': {'dateTime': '2030-01-01T11:00:00+01:00'}},
+    ]}
+    progress = app.BackfillProgress()
+    queued = []
+    submit = app.submit_task
+
+    def queue_job(func, *args, **kwargs):
+        # Samo zadanie migracji wstrzymujemy; jego odczyty idą do puli jak zwykle
+        if args or kwargs:
+            return submit(func, *args, **kwargs)
+        queued.append(func)
+
+    with patch('app.get_backfill_progress', return_value=progress), patch('app.submit_task', side_effect=queue_job):
+        assert app.start_backfill(mock_users_db) is True
+        assert progress.snapshot()['running']
+        assert app.start_backfill(mock_users_db) is False
+        queued[0]()
+
+    state = progress.snapshot()
+    assert len(queued) == 1
+    assert not state['running'] and state['error'] is None
+    assert (state['checked'], state['total'], state['migrated'], state['skipped']) == (2, 2, 1, 1)
+
+# --- TESTY PAMIĘCI PODRĘCZNEJ TYTUŁÓW ---
+
+def test_title_resolution_is_memoized(mock_users_db):
+    app.get_title_cache().entries.clear()
+
+    with patch('app.resolve_participants_from_title', wraps=app.resolve_participants_from_title) as mock_resolve:
+        first = app.get_participants_from_title("Jan  Nowak", mock_users_db)
+        second = app.get_participants_from_title("Jan Nowak", mock_users_db)
+        assert mock_resolve.call_count == 1
+
+        # Inna wersja bazy ACL - inny odcisk, wynik liczony od nowa
+        changed = mock_users_db.copy()
+        changed.loc[0, 'Email'] = 'jan@nowy.com'
+        third = app.get_participants_from_title("Jan Nowak", changed)
+        assert mock_resolve.call_count == 2
+
+    assert first == second == (['jan@other.com'], False)
+    assert third == (['jan@nowy.com'], False)
+    assert app.get_title_cache().snapshot()['hits'] >= 1
+
+def test_title_resolution_sees_in_place_edits(mock_users_db):
+    """Edycja ramki w miejscu zmienia odcisk - bez starych wyników z pamięci."""
+    app.get_title_cache().entries.clear()
+    frame = mock_users_db.copy()
+    assert app.get_participants_from_title("Jan Nowak", frame) == (['jan@other.com'], False)
+
+    frame.loc[0, 'Email'] = 'jan@nowy.com'
+    assert app.get_participants_from_title("Jan Nowak", frame) == (['jan@nowy.com'], False)
+    assert 'users_fingerprint' not in frame.attrs
+
+# --- TESTY PRZEGLĄDU DOSTĘPNOŚCI ---
+
+def test_availability_matrix(mock_service, mock_session_state, mock_users_db):
+    """Jedno zapytanie na cały zakres, te same reguły co get_slots_for_day."""
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'm1', 'summary': 'Dyżur 10:00-13:00', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e1', 'summary': 'Jan Nowak', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e2', 'summary': 'Testowy User', 'start': {'dateTime': '2030-01-01T11:00:00+01:00'}},
+        {'id': 'm2', 'summary': 'Dyżur 9:00-10:00', 'start': {'date': '2030-01-03'}},
+        {'id': 'e3', 'summary': 'Jan Nowak i Obcy Człowiek', 'start': {'dateTime': '2030-01-03T09:00:00+01:00'}},
+    ]}
+    mock_service.events().list.reset_mock()
+
+    matrix = app.get_availability_matrix(datetime.date(2030, 1, 1), weeks=1, df_users=mock_users_db, user_email='ja@test.com')
+
+    assert mock_service.events().list.call_count == 1
+    assert matrix.shape == (7, 24)
+    day1 = matrix.loc[datetime.date(2030, 1, 1)]
+    assert (day1[10], day1[11], day1[12]) == (app.OVERVIEW_JOIN, app.OVERVIEW_MINE, app.OVERVIEW_FREE)
+    assert matrix.loc[datetime.date(2030, 1, 3)][9] == app.OVERVIEW_FULL
+    assert (matrix.loc[datetime.date(2030, 1, 2)] == app.OVERVIEW_NONE).all()
+
+    view = app.format_availability_overview(matrix)
+    assert list(view.columns) == ["9:00", "10:00", "11:00", "12:00"]
+    assert view.loc["Wt 01-01", "10:00"] == "🤝"
+
+# --- TESTY WYSZUKIWANIA TERMINU ---
+
+def test_find_next_slots_stops_early(mock_service, mock_session_state, mock_users_db):
+    """Wolne godziny i godziny z ulubioną osobą; po znalezieniu limitu nie czyta dalszych tygodni."""
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'm1', 'summary': 'Dyżur 10:00-13:00', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e1', 'summary': 'Jan Nowak', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e2', 'summary': 'Jan Nowak i Obcy Człowiek', 'start': {'dateTime': '2030-01-01T11:00:00+01:00'}},
+    ]}
+    mock_service.events().list.reset_mock()
+
+    found = app.find_next_slots(datetime.date(2030, 1, 1), ['jan@other.com'], limit=2,
+                                df_users=mock_users_db, user_email='ja@test.com')
+
+    assert [(m['hour'], m['partner']) for m in found] == [(10, 'jan@other.com'), (12, None)]
+    assert mock_service.events().list.call_count == 1
+
+    favorites_only = app.find_next_slots(datetime.date(2030, 1, 1), ['jan@other.com'], limit=5, favorites_only=True,
+                                         max_weeks=1, df_users=mock_users_db, user_email='ja@test.com')
+    assert [m['hour'] for m in favorites_only] == [10]
+
+# --- TESTY ZAPISU CYKLICZNEGO ---
+
+def test_book_recurring_single_batch(mock_service, mock_session_state, mock_users_db):
+    """Jeden odczyt zakresu, jeden batch, jeden zbiorczy e-mail do partnera."""
+    def day(n):
+        return f"2030-01-{n:02d}"
+    items = []
+    for n in (1, 8, 15):
+        items.append({'id': f'm{n}', 'summary': 'Dyżur 10:00-12:00', 'start': {'dateTime': f'{day(n)}T10:00:00+01:00'}})
+    items.append({'id': 'e8', 'summary': 'Jan Nowak', 'start': {'dateTime': f'{day(8)}T10:00:00+01:00'}})
+    mock_service.events().list().execute.return_value = {'items': items}
+    mock_service.events().list.reset_mock()
+
+    batch = MagicMock()
+    mock_service.new_batch_http_request.return_value = batch
+    partner = {'Imię': 'Anna', 'Nazwisko': 'Nowa', 'Email': 'anna@test.com'}
+
+    with patch('app.send_notification_email') as mock_email:
+        result = app.book_recurring(datetime.date(2030, 1, 1), 10, 4, partner, df_users=mock_users_db)
+
+    assert mock_service.events().list.call_count == 1
+    assert batch.add.call_count == 2
+    batch.execute.assert_called_once()
+    assert result['booked'] == [datetime.date(2030, 1, 1), datetime.date(2030, 1, 15)]
+    assert [reason for _, reason in result['skipped']] == ["jest tylko 1 wolne miejsce", "brak dyżuru"]
+
+    mock_email.assert_called_once()
+    assert mock_email.call_args[0][0] == 'anna@test.com'
+    assert "01-01-2030" in mock_email.call_args[0][2] and "15-01-2030" in mock_email.call_args[0][2]
+
+def test_book_recurring_joins_event_shown_in_occupancy(mock_service, mock_session_state, mock_users_db):
+    """Dołączenie trafia w to samo wydarzenie co occupancy_frame (ostatnie), a ponowiony batch zapomina stare błędy."""
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'm1', 'summary': 'Dyżur 10:00-12:00', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'old', 'summary': 'Stary wpis', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+        {'id': 'e1', 'summary': 'Jan Nowak', 'start': {'dateTime': '2030-01-01T10:00:00+01:00'}},
+    ]}
+    table = app.build_event_table(mock_service.events().list().execute()['items'], mock_users_db)
+    shown = app.occupancy_frame(table, 'testowy@test.com')
+    expected_id = shown.loc[shown['hour'] == 10, 'event_id'].iloc[0]
+    assert expected_id == 'e1'
+
+    batch = MagicMock()
+
+    def flaky_execute():
+        # Pierwsza próba: callback zgłasza błąd, po czym połączenie się zrywa
+        if batch.execute.call_count == 1:
+            on_response = mock_service.new_batch_http_request.call_args.kwargs['callback']
+            on_response('2030-01-01', None, Exception("chwilowy błąd"))
+            raise TimeoutError()
+
+    batch.execute.side_effect = flaky_execute
+    mock_service.new_batch_http_request.return_value = batch
+
+    with patch('app.send_notification_email'), patch('app.time.sleep'):
+        result = app.book_recurring(datetime.date(2030, 1, 1), 10, 1, None, df_users=mock_users_db)
+
+    assert mock_service.events().update.call_args.kwargs['eventId'] == expected_id
+    assert result['joined'] == [datetime.date(2030, 1, 1)] and result['failed'] == []
+
+# --- TESTY WIELU LOKALIZACJI ---
+
+@pytest.fixture
+def fresh_participant_index():
+    """Pusty indeks uczestników tylko dla tego testu."""
+    with patch('app.get_participant_index', return_value=app.ParticipantIndex()) as mock_get:
+        yield mock_get.return_value
+
+def upcoming(days, hour):
+    """Data ISO za `days` dni o podanej godzinie (czas warszawski)."""
+    tz = ZoneInfo("Europe/Warsaw")
+    day = datetime.date.today() + datetime.timedelta(days=days)
+    return datetime.datetime.combine(day, datetime.time(hour, 0), tzinfo=tz).isoformat()
+
+def test_upcoming_events_merge_locations(mock_service, mock_session_state, mock_users_db, fresh_participant_index):
+    """Twoje zapisy: każdy kalendarz odpytany raz, wyniki połączone i posortowane po czasie."""
+    items = {
+        'cal-a': [{'id': 'a1', 'summary': 'Testowy User', 'start': {'dateTime': upcoming(2, 12)}}],
+        'cal-b': [
+            {'id': 'b1', 'summary': 'Testowy User i Jan Nowak', 'start': {'dateTime': upcoming(2, 9)}},
+            {'id': 'b2', 'summary': 'Jan Nowak', 'start': {'dateTime': upcoming(3, 9)}},
+        ],
+    }
+    mock_service.events().list.side_effect = lambda **kw: MagicMock(
+        execute=MagicMock(return_value={'items': items[kw['calendarId']]}))
+
+    with patch('app.LOCATIONS', {'Piotrkowska': 'cal-a', 'Rynek': 'cal-b'}):
+        df = app.get_user_upcoming_events(df_users=mock_users_db)
+
+    called = sorted(c.kwargs['calendarId'] for c in mock_service.events().list.call_args_list)
+    assert called == ['cal-a', 'cal-b']
+    assert list(df['Lokalizacja']) == ['Rynek', 'Piotrkowska']
+    assert list(df['Godzina']) == ['9:00 - 10:00', '12:00 - 13:00']
+
+# --- TESTY INDEKSU UCZESTNIKÓW ---
+
+def test_participant_index_serves_lookups_and_tracks_bookings(mock_service, mock_session_state, mock_users_db,
+                                                               fresh_participant_index):
+    """Po jednym odczycie zakresu kolejne zapytania i własne zapisy nie czytają grafiku."""
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'm1', 'summary': 'Dyżur 8:00-20:00', 'start': {'dateTime': upcoming(1, 8)}},
+        {'id': 'e1', 'summary': 'Testowy User', 'start': {'dateTime': upcoming(1, 10)}},
+        {'id': 'e2', 'summary': 'Jan Nowak', 'start': {'dateTime': upcoming(200, 10)}},
+    ]}
+    mock_service.events().list.reset_mock()
+
+    assert len(app.get_user_upcoming_events(30, df_users=mock_users_db)) == 1
+    assert len(app.get_user_upcoming_events(365, df_users=mock_users_db)) == 1
+    assert mock_service.events().list.call_count == 1
+
+    # Dołączenie do wydarzenia e2 trafia do indeksu bez ponownego odczytu
+    joined = {'id': 'e2', 'summary': 'Jan Nowak i Testowy User', 'start': {'dateTime': upcoming(200, 10)}}
+    app.set_event_participant_emails(joined, ['jan@other.com', 'ja@test.com'])
+    fresh_participant_index.upsert(app.CALENDAR_ID, joined)
+    fresh_participant_index.remove(app.CALENDAR_ID, 'e1')
+
+    df = app.get_user_upcoming_events(365, df_users=mock_users_db)
+    assert mock_service.events().list.call_count == 1
+    assert list(df['Szczegóły (Kto)']) == ['Jan Nowak i Testowy User']
+
+# --- TESTY TABELI WYDARZEŃ ---
+
+def test_occupancy_frame_covers_many_days(mock_users_db):
+    """Zajętość kilku dni liczona naraz z jednej tabeli, z tymi samymi regułami co dla dnia."""
+    events = [
+        {'id': 'm1', 'summary': 'Dyżur 8:00-10:00', 'start': {'date': '2030-01-01'}},
+        {'id': 'a', 'summary': 'Jan Nowak', 'start': {'dateTime': '2030-01-01T08:00:00+01:00'}},
+        {'id': 'm2', 'summary': 'Dyżur 9:00-11:00', 'start': {'dateTime': '2030-01-02T09:00:00+01:00'}},
+        {'id': 'b', 'summary': 'Testowy User', 'start': {'dateTime': '2030-01-02T09:00:00+01:00'}},
+        {'id': 'c', 'summary': 'Jan Nowak i Obcy Człowiek', 'start': {'dateTime': '2030-01-02T10:00:00+01:00'}},
+    ]
+    table = app.build_event_table(events, mock_users_db)
+    assert list(table['hour']) == [-1, 8, 9, 9, 10]
+    assert list(table['shift_start']) == [8, -1, 9, -1, -1]
+
+    frame = app.occupancy_frame(table, 'ja@test.com')
+    codes = {(d.day, h): c for d, h, c in zip(frame['date'], frame['hour'], frame['code'])}
+    assert codes == {
+        (1, 8): app.OVERVIEW_JOIN, (1, 9): app.OVERVIEW_FREE,
+        (2, 9): app.OVERVIEW_MINE, (2, 10): app.OVERVIEW_FULL,
+    }
+
+# --- TESTY LOKALNEJ KOPII KALENDARZA ---
+
+def test_calendar_store_serves_queries_and_applies_changes(tmp_path, mock_service, mock_session_state, mock_users_db):
+    """Pełny odczyt raz, potem zapytania z SQLite i przyrostowe zmiany (updatedMin)."""
+    store = app.CalendarStore(str(tmp_path / "calendar.sqlite3"))
+    events = [
+        {'id': 'm1', 'summary': 'Dyżur 8:00-12:00', 'start': {'dateTime': upcoming(1, 8)}},
+        {'id': 'e1', 'summary': 'Jan Nowak', 'start': {'dateTime': upcoming(1, 9)}},
+        {'id': 'e2', 'summary': 'Testowy User', 'start': {'dateTime': upcoming(1, 10)}},
+    ]
+    mock_service.events().list().execute.return_value = {'items': events}
+    mock_service.events().list.reset_mock()
+    day = datetime.date.today() + datetime.timedelta(days=1)
+
+    with patch('app.get_calendar_store', return_value=store):
+        slots, mine = app.get_slots_for_day(day, df_users=mock_users_db)
+        assert mine == [10] and slots[9] == "Dołącz do: Jan Nowak"
+        assert list(app.get_user_upcoming_events(30, df_users=mock_users_db)['Godzina']) == ['10:00 - 11:00']
+        assert app.get_emails_for_day(day, exclude_hour=10, df_users=mock_users_db) == ['jan@other.com']
+        assert mock_service.events().list.call_count == 1
+
+        # Po upływie interwału dociągamy tylko zmiany od kursora
+        store.conn.execute("UPDATE sync_state SET synced_at = 0")
+        mock_service.events().list().execute.return_value = {'items': [{'id': 'e1', 'status': 'cancelled'}]}
+        mock_service.events().list.reset_mock()
+        slots, _ = app.get_slots_for_day(day, df_users=mock_users_db)
+
+    assert mock_service.events().list.call_args.kwargs['showDeleted'] is True
+    assert 'updatedMin' in mock_service.events().list.call_args.kwargs
+    assert slots[9] == "Wolne"
+
+# --- TESTY STATYSTYK ---
+
+def test_service_report_aggregates_and_caches_months(mock_service, mock_users_db):
+    """Agregaty per osoba i godzina; zakończone miesiące drugi raz nie są czytane z Kalendarza."""
+    events = [
+        {'id': 'm1', 'summary': 'Dyżur 8:00-10:00', 'start': {'dateTime': '2024-01-01T08:00:00+01:00'}},
+        {'id': 'e1', 'summary': 'Jan Nowak i Testowy User', 'start': {'dateTime': '2024-01-01T08:00:00+01:00'}},
+        {'id': 'm2', 'summary': 'Dyżur 8:00-10:00', 'start': {'dateTime': '2024-01-08T08:00:00+01:00'}},
+        {'id': 'e2', 'summary': 'Jan Nowak', 'start': {'dateTime': '2024-01-08T09:00:00+01:00'}},
+    ]
+    mock_service.events().list().execute.return_value = {'items': events}
+    mock_service.events().list.reset_mock()
+
+    with patch('app.get_stats_cache', return_value=app.MonthlyStatsCache()):
+        report = app.build_service_report(datetime.date(2024, 1, 1), datetime.date(2024, 1, 31), mock_users_db)
+        app.build_service_report(datetime.date(2024, 1, 1), datetime.date(2024, 1, 31), mock_users_db)
+
+    assert mock_service.events().list.call_count == 1
+    assert dict(zip(report['people']['Email'], report['people']['Godziny'])) == {'jan@other.com': 2, 'ja@test.com': 1}
+    hours = report['hours'].set_index('Godzina')
+    assert hours.loc['8:00 - 9:00', 'Pełne'] == 1 and hours.loc['8:00 - 9:00', 'Puste'] == 1
+    assert hours.loc['9:00 - 10:00', '% pustych'] == 50.0
+    assert "Poniedziałek" in list(report['weekdays']['Dzień'])
+
+# --- TESTY SYNCHRONIZACJI ACL ---
+
+def test_sync_users_writes_only_the_diff(mock_service):
+    """ACL czytane ze wszystkich stron; arkusz dostaje append nowych i usunięcie zbędnych wierszy."""
+    def acl_page(emails, token=None):
+        page = {'items': [{'scope': {'type': 'user', 'value': e}} for e in emails]}
+        if token:
+            page['nextPageToken'] = token
+        return MagicMock(execute=MagicMock(return_value=page))
+    pages = {None: acl_page(['ja@test.com'], 'p2'), 'p2': acl_page(['Nowy@Test.com', 'bot@test.iam.gserviceaccount.com'])}
+    mock_service.acl().list.side_effect = lambda calendarId, pageToken=None: pages[pageToken]
+
+    worksheet = MagicMock(id=7)
+    worksheet.row_values.return_value = ['Email', 'Rola', 'Typ', 'Imię', 'Nazwisko', 'Płeć', 'Ulubione']
+    worksheet.col_values.return_value = ['Email', 'bot@test.iam.gserviceaccount.com', 'ja@test.com', 'jan@other.com']
+
+    with patch('app.get_sheets_connection') as mock_get_conn, patch('app.open_acl_worksheet', return_value=worksheet), \
+            patch('app.st.cache_data.clear'):
+        mock_conn = mock_get_conn.return_value
+        ok, _ = app.sync_users_with_calendar()
+
+    assert ok
+    mock_conn.update.assert_not_called()
+    worksheet.append_rows.assert_called_once_with([['nowy@test.com', 'reader', 'user', '', '', 'M', '']], value_input_option='RAW')
+    request = worksheet.spreadsheet.batch_update.call_args[0][0]['requests'][0]['deleteDimension']['range']
+    assert (request['sheetId'], request['startIndex'], request['endIndex']) == (7, 3, 4)
+
+def test_sync_users_noop_makes_no_writes(mock_service):
+    mock_service.acl().list().execute.return_value = {'items': [
+        {'scope': {'type': 'user', 'value': e}} for e in ['ja@test.com', 'jan@other.com']
+    ]}
+    worksheet = MagicMock()
+    worksheet.row_values.return_value = ['Email', 'Rola']
+    worksheet.col_values.return_value = ['Email', 'ja@test.com', 'jan@other.com']
+    with patch('app.get_sheets_connection') as mock_get_conn, patch('app.open_acl_worksheet', return_value=worksheet):
+        mock_conn = mock_get_conn.return_value
+        ok, msg = app.sync_users_with_calendar()
+
+    assert ok and msg == "Bazy są zgodne."
+    worksheet.append_rows.assert_not_called()
+    worksheet.spreadsheet.batch_update.assert_not_called()
+    mock_conn.update.assert_not_called()
+
+@pytest.mark.parametrize("failure", ["empty", "error"])
+def test_sync_users_refuses_unverified_sheet(mock_service, failure):
+    """Pusty albo nieudany odczyt arkusza nie może skończyć się dopisaniem całego ACL."""
+    mock_service.acl().list().execute.return_value = {'items': [
+        {'scope': {'type': 'user', 'value': 'ja@test.com'}}
+    ]}
+    worksheet = MagicMock()
+    worksheet.row_values.return_value = ['Email', 'Rola']
+    if failure == "empty":
+        worksheet.col_values.return_value = ['Email']
+    else:
+        worksheet.col_values.side_effect = ConnectionError("brak sieci")
+    with patch('app.open_acl_worksheet', return_value=worksheet), patch('app.call_api', side_effect=lambda api, f, *a, **k: f(*a, **k)):
+        ok, msg = app.sync_users_with_calendar()
+
+    assert not ok and msg.startswith("Błąd synchronizacji")
+    worksheet.append_rows.assert_not_called()
+    worksheet.spreadsheet.batch_update.assert_not_called()
+
+# --- TESTY ZADAŃ W TLE ---
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_background_scheduler_runs_jobs_and_records_times():
+    scheduler = app.BackgroundScheduler()
+    scheduler.add_job("ok", lambda: "gotowe", 3600)
+    scheduler.add_job("blad", MagicMock(side_effect=RuntimeError("brak sieci")), 3600)
+
+    assert scheduler.start() is True
+    assert scheduler.start() is False  # drugi rerun nie tworzy kolejnego wątku
+    assert wait_for(lambda: scheduler.snapshot()['jobs']['blad']['runs'] == 1)
+
+    scheduler.run_now("ok")
+    assert wait_for(lambda: scheduler.snapshot()['jobs']['ok']['runs'] == 2)
+    jobs = scheduler.snapshot()['jobs']
+    assert jobs['ok']['last_result'] == "gotowe" and jobs['ok']['last_duration_s'] is not None
+    assert jobs['blad']['last_error'] == "brak sieci"
+    assert jobs['ok']['next_in_s'] > 3000
+
+def test_scheduler_and_acl_sync_are_opt_in():
+    with patch.dict(app.st.secrets, {}, clear=False):
+        app.st.secrets.pop("scheduler", None)
+        settings = app.get_scheduler_settings()
+    assert settings['enabled'] is False and settings['acl_sync'] is False
+
+    with patch('app.get_scheduler_settings', return_value={**settings, 'enabled': True}):
+        jobs = app.get_scheduler.__wrapped__().snapshot()['jobs']
+    assert "synchronizacja-acl" not in jobs and "rozgrzewanie-grafiku" in jobs
+
+def test_users_refresh_runs_only_after_recent_session_reads():
+    """Zadanie w tle nie czyta arkusza, gdy nikt nie korzysta z bazy; jego własny odczyt się nie liczy."""
+    frame = pd.DataFrame({
+        'Email': ['jan@other.com'], 'Rola': ['reader'], 'Imię': ['Jan'], 'Nazwisko': ['Nowak'],
+        'Płeć': ['M'], 'Ulubione': [''],
+    })
+    registry_cache = app.UserRegistryCache(ttl=60)
+    with patch('app.get_user_registry_cache', return_value=registry_cache), \
+         patch('app.build_users_frame', return_value=frame), \
+         patch('app.read_users_sheet') as mock_sheet:
+        assert app.refresh_users_cache(idle_after=300).startswith("pominięte")
+        mock_sheet.clear.assert_not_called()
+
+        registry_cache.get(app.build_users_frame)
+        assert app.refresh_users_cache(idle_after=300) == "1 osób"
+        mock_sheet.clear.assert_called_once()
+
+        with patch('app.time.monotonic', return_value=time.monotonic() + 301):
+            assert app.refresh_users_cache(idle_after=300).startswith("pominięte")
+    assert app.get_scheduler_settings()['users_refresh_interval'] == app.USERS_SHEET_TTL
+
+def test_warmed_schedule_is_served_without_fetch(mock_service, mock_users_db, fresh_resilience):
+    day = datetime.date.today() + datetime.timedelta(days=1)
+    mock_service.events().list().execute.return_value = {'items': [
+        {'id': 'm1', 'summary': 'Dyżur 8:00-10:00', 'start': {'dateTime': upcoming(1, 8)}},
+    ]}
+    mock_service.events().list.reset_mock()
+    cache = app.get_schedule_cache()
+
+    with patch('app.refresh_participant_index'), patch.object(cache, 'max_age', 60):
+        app.warm_schedule(3)
+        assert mock_service.events().list.call_count == 1
+        events, stale = app.get_day_events(day)
+        assert mock_service.events().list.call_count == 1
+        assert [e['id'] for e in events] == ['m1'] and not stale
+
+        # Własny zapis tego dnia wyrzuca rozgrzany wpis
+        app.record_event_write(app.CALENDAR_ID, {'id': 'x', 'start': {'dateTime': upcoming(1, 9)}})
+        app.get_day_events(day)
+        assert mock_service.events().list.call_count == 2
+
+# --- TESTY SNAPSHOTU ---
+
+def test_snapshot_format_roundtrip_and_validation():
+    data = app.encode_snapshot({'a': 'zażółć', 'n': [1, None]})
+    assert data[:4] == b"WZKS" and data[4] == app.SNAPSHOT_VERSION
+    assert app.decode_snapshot(data) == {'a': 'zażółć', 'n': [1, None]}
+    with pytest.raises(ValueError):
+        app.decode_snapshot(b"XXXX" + data[4:])
+    with pytest.raises(ValueError):
+        app.decode_snapshot(data[:4] + bytes([99]) + data[5:])
+
+def test_snapshot_path_requires_scheduler():
+    """Snapshot zapisuje tylko harmonogram - bez niego ścieżka jest ignorowana."""
+    with patch.dict(app.st.secrets, {'snapshot': {'path': 'snap.bin'}}):
+        assert app.get_snapshot_settings()['path'] == ""
+        with patch.dict(app.st.secrets, {'scheduler': {'enabled': True}}):
+            assert app.get_snapshot_settings()['path'] == "snap.bin"
+
+def test_warm_start_serves_snapshot_then_revalidates(tmp_path, mock_service, mock_users_db):
+    """Po restarcie: baza i grafik ze snapshotu od razu (z ostrzeżeniem), odświeżenie w tle."""
+    settings = {'path': str(tmp_path / "snapshot.bin"), 'weeks': 1, 'max_age': 3600}
+    day = datetime.date.today() + datetime.timedelta(days=1)
+    events = [{'id': 'm1', 'summary': 'Dyżur 8:00-10:00', 'start': {'dateTime': upcoming(1, 8)}}]
+
+    before = app.ScheduleCache()
+    before.put((app.CALENDAR_ID, day.isoformat()), events)
+    with patch('app.get_snapshot_settings', return_value=settings), \
+         patch('app.read_users_sheet', return_value=mock_users_db), \
+         patch('app.get_schedule_cache', return_value=before):
+        assert app.save_snapshot() > 0
+
+    after = app.ScheduleCache()
+    app.get_warm_start.clear()
+    try:
+        with patch('app.get_snapshot_settings', return_value=settings), \
+             patch('app.get_schedule_cache', return_value=after), \
+             patch.object(after, 'refresh_in_background') as mock_refresh:
+            warm = app.get_warm_start()
+            served, stale = app.get_day_events(day)
+
+            assert list(warm.take_users()['Email']) == list(mock_users_db['Email'])
+            assert warm.take_users() is None
+            assert served == events and stale
+            mock_refresh.assert_called_once()
+            mock_service.events().list().execute.assert_not_called()
+
+        # Snapshot starszy niż max_age nie jest wczytywany wcale
+        app.get_warm_start.clear()
+        expired = app.ScheduleCache()
+        with patch('app.get_snapshot_settings', return_value={**settings, 'max_age': 3600}), \
+             patch('app.get_schedule_cache', return_value=expired), \
+             patch('app.time.time', return_value=time.time() + 7200):
+            assert app.get_warm_start().take_users() is None
+        assert expired.take_warm((app.CALENDAR_ID, day.isoformat())) is None
+    finally:
+        app.get_warm_start.clear()
+
+def test_snapshot_users_stay_out_of_sheet_cache_and_writes():
+    raw = pd.DataFrame({
+        'Email': ['jan@other.com', 'ja@test.com'], 'Rola': ['reader', 'reader'], 'Typ': ['user', 'user'],
+        'Imię': ['Jan', 'Testowy'], 'Nazwisko': ['Nowak', 'User'], 'Płeć': ['M', 'M'], 'Ulubione': ['', ''],
+    })
+    warm = app.WarmStart(None)
+    warm.users = raw.copy()
+
+    with patch('app.get_warm_start', return_value=warm), \
+         patch('app.read_users_sheet', side_effect=lambda: raw.copy()) as mock_read, \
+         patch('app.submit_task') as mock_submit:
+        frame = app.build_users_frame()
+        mock_read.assert_not_called()
+        mock_submit.assert_called_once_with(app.refresh_users_cache)
+        assert frame.attrs['from_snapshot'] is True
+
+        # Zwykłe odczyty (synchronizacja, funkcje kalendarza) zawsze idą do arkusza
+        assert app.build_users_frame().attrs['from_snapshot'] is False
+        mock_read.assert_called_once()
+
+    cache = app.UserRegistryCache(ttl=60)
+    users = cache.get(lambda: frame)
+    assert users.from_snapshot and cache.registry is None
+
+    with patch('app.get_sheets_connection') as mock_get_conn, patch('app.st.toast'):
+        app.update_user_db(users.with_favorites('ja@test.com', []))
+    mock_get_conn.return_value.update.assert_not_called()
+
+# --- TESTY SKRYPTU KLIENTA ---
+
+def test_client_script_installed_once_per_session(mock_session_state):
+    with patch('app.components.html') as mock_html:
+        app.install_client_script()
+        app.install_client_script()
+
+    mock_html.assert_called_once()
+    assert "MutationObserver" in app.CLIENT_SCRIPT
+    assert "setInterval" not in app.CLIENT_SCRIPT
+
+# --- TESTY PLIKÓW STATYCZNYCH ---
+
+def test_static_assets_are_versioned_and_complete():
+    url = app.static_url("app.css")
+    assert url.startswith("app/static/app.css?v=")
+
+    css = open(os.path.join(app.STATIC_DIR, "app.css"), encoding="utf-8").read()
+    icons = set(re.findall(r'url\("([^"]+)"\)', css))
+    assert icons and all(os.path.exists(os.path.join(app.STATIC_DIR, name)) for name in icons)
+    assert "data:image" not in open(app.__file__, encoding="utf-8").read()
+
+# --- TESTY STARTU SESJI ---
+
+def test_bootstrap_session_waits_for_storage_then_restores(mock_session_state):
+    mock_component = MagicMock(return_value=None)
+    with patch('app.local_storage_component', return_value=mock_component):
+        assert app.bootstrap_session() is None
+    mock_component.assert_called_once()
+
+    # Przeglądarka odesłała dane: jeden przebieg przywraca hasło i osobę
+    items = {app.STORAGE_AUTH: "true", app.STORAGE_USER: "jan@test.pl"}
+    mock_session_state[app.STORAGE_STATE_KEY] = items
+    mock_component = MagicMock()
+    with patch('app.local_storage_component', return_value=mock_component), patch('app.LocalStorage') as mock_ls:
+        mock_ls.return_value.getItem.side_effect = items.get
+        ls = app.bootstrap_session()
+        app.bootstrap_session()
+    mock_component.assert_not_called()
+    assert mock_ls.return_value.getItem.call_count == 2
+
+    assert app.check_password(ls) is True
+    assert mock_session_state['stored_email'] == "jan@test.pl"
+
+def test_bootstrap_session_without_private_component(mock_session_state):
+    """Gdy pakiet nie ma prywatnego komponentu, start sesji idzie przez publiczne LocalStorage."""
+    items = {app.STORAGE_AUTH: "true", app.STORAGE_USER: "jan@test.pl"}
+    with patch('app.local_storage_component', return_value=None), patch('app.LocalStorage') as mock_ls:
+        mock_ls.return_value.getItem.side_effect = items.get
+        ls = app.bootstrap_session()
+
+    mock_ls.assert_called_once_with(app.STORAGE_STATE_KEY)
+    assert ls is mock_ls.return_value
+    assert mock_session_state['password_correct'] is True
+
+def test_private_storage_component_only_for_tested_version():
+    app.local_storage_component.clear()
+    try:
+        with patch('importlib.metadata.version', return_value="9.9.9"):
+            assert app.local_storage_component() is None
+        app.local_storage_component.clear()
+        with patch('importlib.metadata.version', return_value=app.LOCAL_STORAGE_TESTED_VERSIONS[0]):
+            assert app.local_storage_component() is not None
+    finally:
+        app.local_storage_component.clear()
+
+def test_startup_time_recorded_once_for_restored_session(mock_session_state):
+    """Czas do interakcji: jedna próbka na sesję, liczba przebiegów od pierwszego do formularza."""
+    items = {app.STORAGE_AUTH: "true", app.STORAGE_USER: "jan@test.pl"}
+    timings = app.StartupTimings()
+    with patch('app.get_startup_timings', return_value=timings), \
+         patch('app.local_storage_component', return_value=MagicMock(return_value=None)), \
+         patch('app.LocalStorage') as mock_ls:
+        mock_ls.return_value.getItem.side_effect = items.get
+        assert app.bootstrap_session() is None
+        mock_session_state[app.STORAGE_STATE_KEY] = items
+        app.bootstrap_session()
+        app.mark_interactive()
+        app.bootstrap_session()
+        app.mark_interactive()
+
+    snapshot = timings.snapshot()
+    assert snapshot['sessions'] == 1 and snapshot['max_passes'] == 2
+
+# --- TESTY REJESTRU UŻYTKOWNIKÓW ---
+
+def test_user_registry_is_shared_and_read_only():
+    frame = pd.DataFrame({
+        'Email': ['Jan@Other.com', 'ja@test.com'],
+        'Imię': ['Jan', 'Testowy'],
+        'Nazwisko': ['Nowak', 'User'],
+        'Rola': ['reader', 'writer'],
+        'Płeć': ['M', 'K'],
+        'Ulubione': ['ja@test.com', ''],
+    })
+    cache = app.UserRegistryCache(ttl=60)
+    build = MagicMock(return_value=frame)
+
+    users = cache.get(build)
+    assert cache.get(build) is users
+    build.assert_called_once()
+
+    jan = users.get('jan@other.com')
+    assert users.by_full_name['Jan Nowak'] is jan
+    assert jan.favorites == ('ja@test.com',)
+    assert not hasattr(jan, '__dict__')
+    assert users.get('ja@test.com').as_row()['Płeć'] == 'K'
+
+    # Zapis ulubionych idzie na kopii - wspólna ramka zostaje bez zmian
+    updated = users.with_favorites('ja@test.com', ['jan@other.com'])
+    assert list(updated['Ulubione']) == ['ja@test.com', 'jan@other.com']
+    assert list(frame['Ulubione']) == ['ja@test.com', '']
+
+    cache.invalidate()
+    cache.get(build)
+    assert cache.snapshot() == {'builds': 2, 'reuses': 1, 'users': 2}
+
+# --- TESTY WSPÓLNEGO CACHE'U REPLIK ---
+
+def test_sqlite_cache_backend_shares_values_and_invalidations(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    replica_a = app.SQLiteCacheBackend(path)
+    replica_b = app.SQLiteCacheBackend(path)
+
+    replica_a.set("day:cal:2030-01-01", [{'id': 'e1'}], ttl=60)
+    assert replica_b.get("day:cal:2030-01-01") == [{'id': 'e1'}]
+    replica_a.set("stary", 1, ttl=-1)
+    assert replica_b.get("stary") is None
+
+    replica_a.publish({'kind': 'users'})
+    assert replica_b.poll() == [{'kind': 'users'}]
+    assert replica_b.poll() == []
+    # Nowa replika nie odtwarza historii sprzed swojego startu
+    assert app.SQLiteCacheBackend(path).poll() == []
+
+def test_invalidation_from_other_replica_reaches_local_caches(mock_service, mock_users_db, fresh_resilience):
+    shared = app.MemoryCacheBackend()
+    day = datetime.date.today() + datetime.timedelta(days=1)
+    shared.set(app.shared_day_key(app.CALENDAR_ID, day), [{'id': 'z-innej-repliki'}], ttl=60)
+    mock_service.events().list.reset_mock()
+
+    with patch('app.get_shared_cache', return_value=shared):
+        events, stale = app.get_day_events(day)
+        assert [e['id'] for e in events] == ['z-innej-repliki'] and not stale
+        mock_service.events().list.assert_not_called()
+
+        # Własny zapis: wpis wspólny usunięty, komunikat nie wraca do nadawcy
+        app.record_event_write(app.CALENDAR_ID, {'id': 'x', 'start': {'dateTime': upcoming(1, 9)}})
+        assert shared.get(app.shared_day_key(app.CALENDAR_ID, day)) is None
+        assert app.apply_invalidations() == 0
+
+        assert shared.replica_id == app.get_shared_cache().replica_id
+
+        # Zapis na innej replice: wpis dnia wypada, indeks dostaje tylko to wydarzenie (bez przebudowy)
+        key = (app.CALENDAR_ID, day.isoformat())
+        app.get_schedule_cache().put(key, [])
+        index = app.ParticipantIndex()
+        index.built[app.CALENDAR_ID] = (time.time(), None, 'odcisk')
+        event = {'id': 'obce', 'summary': 'Jan Nowak', 'start': {'dateTime': upcoming(1, 10)}}
+        app.set_event_participant_emails(event, ['jan@other.com'])
+        with patch('app.get_participant_index', return_value=index):
+            shared.publish({'origin': 'inna', 'kind': 'day', 'calendar_id': app.CALENDAR_ID,
+                            'day': day.isoformat(), 'event': event})
+            assert app.apply_invalidations() == 1
+            assert app.get_schedule_cache().get(key) is None
+            assert app.CALENDAR_ID in index.built
+            assert index.by_email['jan@other.com'] == {(app.CALENDAR_ID, 'obce')}
+
+            shared.publish({'origin': 'inna', 'kind': 'day', 'calendar_id': app.CALENDAR_ID,
+                            'day': day.isoformat(), 'deleted_id': 'obce'})
+            app.apply_invalidations()
+            assert 'jan@other.com' not in index.by_email
+
+# --- TESTY BRAMKI KALENDARZA ---
+
+def test_gateway_fetches_ranges_with_bounded_concurrency():
+    def slow_list(time_min, time_max, calendar_id=None, **params):
+        time.sleep(0.05)
+        return [{'id': f"{calendar_id}:{time_min[:10]}"}, {'id': 'wspolne'}]
+
+    ranges = app.day_ranges(datetime.date(2030, 1, 1), datetime.date(2030, 1, 20), 7, 'cal-a')
+    assert [(r[0][:10], r[1][:10]) for r in ranges] == [
+        ('2030-01-01', '2030-01-07'), ('2030-01-08', '2030-01-14'), ('2030-01-15', '2030-01-20')]
+
+    gateway = app.CalendarGateway(max_concurrency=2)
+    with patch('app.list_all_events', side_effect=slow_list) as mock_list:
+        results = gateway.fetch_ranges(ranges * 2, orderBy='startTime')
+
+    assert mock_list.call_count == 6
+    assert mock_list.call_args.kwargs['orderBy'] == 'startTime'
+    assert [r[0]['id'] for r in results] == ['cal-a:2030-01-01', 'cal-a:2030-01-08', 'cal-a:2030-01-15'] * 2
+    assert gateway.snapshot()['peak_in_flight'] == 2
+    assert gateway.snapshot()['in_flight'] == 0
+    assert [e['id'] for e in app.merge_event_lists(results[:2])] == ['cal-a:2030-01-01', 'wspolne', 'cal-a:2030-01-08']
+
+# --- TESTY CZASU STARTU ---
+
+IMPORT_BUDGET_MS = int(os.environ.get("WOZKI_IMPORT_BUDGET_MS", "1500"))
+HEAVY_MODULES = ("pandas", "numpy", "googleapiclient.discovery", "streamlit_gsheets", "smtplib")
+
+def test_import_stays_light_and_within_budget():
+    # Świeży interpreter: import app nie może ciągnąć ciężkich bibliotek (ekran logowania ich nie potrzebuje)
+    script = (
+        "import sys, time\n"
+        "t = time.perf_counter()\n"
+        "import app\n"
+        "ms = (time.perf_counter() - t) * 1000\n"
+        f"print(int(ms), ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    ).stdout.strip().splitlines()[-1]
+    elapsed_ms, _, loaded = out.partition(" ")
+
+    assert loaded == ""
+    assert int(elapsed_ms) < IMPORT_BUDGET_MS
+
+    # Leniwy moduł ładuje się przy pierwszym użyciu atrybutu
+    lazy = app.LazyModule("json")
+    assert lazy.dumps([1]) == "[1]"
+
+def test_lazy_module_imports_once_across_threads():
+    """Równoległe pierwsze użycie z kilku wątków importuje moduł tylko raz."""
+    import json as real_json
+    calls = []
+
+    def slow_import(name):
+        calls.append(name)
+        time.sleep(0.05)
+        return real_json
+
+    lazy = app.LazyModule("json")
+    with patch('app.importlib.import_module', side_effect=slow_import):
+        threads = [threading.Thread(target=lambda: lazy.dumps([1])) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert calls == ["json"]